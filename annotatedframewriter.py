@@ -27,13 +27,12 @@ class AnnotatedFrameWriter(BaseComponent):
             annotate(img, comp_reports)
         
         # The output directory structure should match input directory structure.
-        relpath_of_input_file = os.path.relpath(input_data['file'], input_directory)
+        relpath_of_input_file = self.input_relpath(input_data['file'], input_directory)
         relparent_of_input_file = os.path.dirname(relpath_of_input_file)
         inp_filename,inp_extension = os.path.splitext(os.path.basename(relpath_of_input_file))
         
+        # Directory is created by write_output() if needed.
         output_filedir = os.path.join(output_directory, relparent_of_input_file)
-        if not os.path.exists(output_filedir):
-            os.makedirs(output_filedir)
             
         output_filepath =  os.path.join(output_filedir,
             inp_filename + '-frame-' + str(input_data['frame']) + '-annotated.' + self.cfg['params']['format'])
@@ -41,7 +40,8 @@ class AnnotatedFrameWriter(BaseComponent):
         final_img = cv2.resize(img, (self.cfg['params']['size']['width'], self.cfg['params']['size']['height']))
             
         print(output_filepath)
-        imageio.imwrite(output_filepath, final_img)
+        self.write_output(output_filepath,
+            imageio.imwrite(imageio.RETURN_BYTES, final_img, format=self.cfg['params']['format']))
         
         return {'file':output_filepath}
                 
@@ -1,5 +1,6 @@
 from annotator import annotate
 from basecomponent import BaseComponent
+from videosegments import segment_suffix, existing_segment_files, concat_videos
 
 import imageio
 import cv2
@@ -11,6 +12,13 @@ class AnnotatedVideoWriter(BaseComponent):
     Unlike other components, design of this component has to be stateful - it opens output 
     video stream when it receives first frame and then keeps it open writing each frame to the video
     till completed notification is received.
+    
+    If the input is a segment of a long video, a partial video of only that segment's frames
+    is written, and the partial videos are concatenated in frame order by stitch_segments().
+    
+    If the pipeline samples video frames, the 'sampledframes' param decides what's written:
+        write : only the sampled frames (default)
+        hold  : every frame, annotated with the detections of the last sampled frame
     '''
     
     def __init__(self, cfg):
@@ -19,24 +27,34 @@ class AnnotatedVideoWriter(BaseComponent):
         self.output_video = None
         self.output_filepath = None
         
+        # (input file, segment) the output video is open for, and its last frame number.
+        self.output_video_key = None
+        self.last_frame = None
+        
+        
+    def accepts_held_frames(self):
+        return self.cfg['params'].get('sampledframes', 'write') == 'hold'
+        
         
     def execute(self, input_data, input_directory, output_directory):
         if not input_data['isvideo']:
             return {}
             
-        # Open output video stream if this is first frame.
-        if input_data['frame'] == 0:
-            # The output directory structure should match input directory structure.
-            relpath_of_input_file = os.path.relpath(input_data['file'], input_directory)
-            relparent_of_input_file = os.path.dirname(relpath_of_input_file)
-            inp_filename,inp_extension = os.path.splitext(os.path.basename(relpath_of_input_file))
+        # Open output video stream if this is first frame. A video that failed partway
+        # is never completed, so a writer still open for it, or for an earlier attempt
+        # at the same video, is discarded instead of appended to.
+        video = (input_data['file'], input_data.get('segment'))
+        if self.output_video is not None and (video != self.output_video_key or input_data['frame'] <= self.last_frame):
+            self.discard()
             
-            output_filedir = os.path.join(output_directory, relparent_of_input_file)
-            if not os.path.exists(output_filedir):
-                os.makedirs(output_filedir)
+        if self.output_video is None:
+            self.output_video_key = video
+            self.output_filepath = self.output_filepath_base(input_data['file'], input_directory, output_directory)
+            
+            if input_data.get('segment'):
+                self.output_filepath += segment_suffix(input_data['segment'])
                 
-            self.output_filepath =  os.path.join(output_filedir,
-                inp_filename + '-annotated.' + self.cfg['params']['format'])
+            self.output_filepath += '-annotated.' + self.cfg['params']['format']
 
             self.output_video = imageio.get_writer(self.output_filepath, 'ffmpeg')
             
@@ -59,6 +77,7 @@ class AnnotatedVideoWriter(BaseComponent):
         final_img = cv2.resize(img, (self.cfg['params']['size']['width'], self.cfg['params']['size']['height']))
             
         self.output_video.append_data(final_img)
+        self.last_frame = input_data['frame']
         
         return {'file': self.output_filepath}
                 
@@ -69,4 +88,46 @@ class AnnotatedVideoWriter(BaseComponent):
         
         self.output_video = None
         self.output_filepath = None
+        self.output_video_key = None
+        self.last_frame = None
+        
         
+    def failed(self, input_file, segment):
+        # Closed right away, so that processes forked for the next video, like frame
+        # decoders, don't inherit the pipe to its ffmpeg process and keep it from exiting.
+        if self.output_video_key == (input_file, segment):
+            self.discard()
+            
+            
+    def discard(self):
+        '''
+        Closes and deletes the unfinished output video, so that it isn't taken for a
+        finished one.
+        '''
+        output_filepath = self.output_filepath
+        print("Discarding unfinished " + output_filepath)
+        self.completed(None, None, None)
+        if os.path.exists(output_filepath):
+            os.remove(output_filepath)
+        
+        
+    @classmethod
+    def stitch_segments(cls, cfg, input_file, segments, input_directory, output_directory, output_sink=None):
+        
+        output_filepath_base = cls.output_filepath_base(input_file, input_directory, output_directory)
+        output_filepath = output_filepath_base + '-annotated.' + cfg['params']['format']
+        
+        segment_filepaths = existing_segment_files(input_file, [
+            output_filepath_base + segment_suffix(frame_range) + '-annotated.' + cfg['params']['format']
+            for frame_range in segments ])
+                
+        if not segment_filepaths:
+            return
+            
+        print(output_filepath)
+        concat_videos(segment_filepaths, output_filepath)
+        
+        for segment_filepath in segment_filepaths:
+            os.remove(segment_filepath)
+            
+        return {'file': output_filepath}
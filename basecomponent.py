@@ -1,8 +1,15 @@
+import os
+import os.path
+
 class BaseComponent(object):
     '''
     Base class for all components. Host for common helpers instead
     of repeating in each subclass.
     '''
+    
+    # Set by the pipeline if outputs are written into shards instead of files. See outputsink.py.
+    output_sink = None
+    
     def __init__(self, cfg):
         self.cfg = cfg
         self.name = cfg['name']
@@ -29,12 +36,162 @@ class BaseComponent(object):
         pass
         
         
+    def batch_size(self):
+        '''
+        Returns the number of inputs the component would like to process together in 
+        one execute_batch() call. The pipeline collects that many video frames, or photos,
+        when some component wants batches.
+        '''
+        return 1
+        
+        
+    def execute_batch(self, inputs, input_directory, output_directory):
+        '''
+        Executes the component on a list of input data of consecutive video frames or of
+        photos, and returns the list of outputs of each.
+        Components that can process multiple images more efficiently than one by one,
+        like a neural network's forward pass over a batch, override this. By default, 
+        execute() is called on each input in order.
+        '''
+        return [ self.execute(input_data, input_directory, output_directory) for input_data in inputs ]
+        
+        
+    @classmethod
+    def is_fork_safe(cls, cfg):
+        '''
+        Returns True if a component of this class created with cfg can be created once 
+        in the parent process and then used by all the forked pipeline processes.
+        That's the case for components that only read models after they're created. 
+        Components that keep state across inputs, like writers, or whose libraries
+        don't survive a fork, like TensorFlow sessions, are created in each process.
+        '''
+        return False
+        
+        
+    def is_cacheable(self):
+        '''
+        Returns True if the component's outputs are just 'reports' that depend only on
+        the image, its configuration, and the reports of the components in its inputs,
+        so that they can be stored in the result cache and reused for the same image.
+        That's not the case for writers, which have to write their outputs, or for 
+        components that keep state across frames, like a motion gate.
+        '''
+        return False
+        
+        
+    def planes(self):
+        '''
+        Returns names of the image planes this component reads from input data,
+        such as 'img', 'gray' or 'gray_equalized'. See framedata.py for all planes.
+        
+        Declared planes are computed once per frame ahead of time, along with decoding,
+        and shared by all components that read them. Planes that are not declared
+        are still available, but are computed when first accessed.
+        '''
+        return ['img']
+        
+        
+    def accepts_held_frames(self):
+        '''
+        When a pipeline samples video frames, components are executed only on
+        sampled frames. A component that returns True here is executed on every frame,
+        with the outputs of other components on the last sampled frame held for
+        the frames that are not sampled. input_data['sampled'] tells them apart.
+        '''
+        return False
         
         
     def completed(self, input_data, input_directory, output_directory):
         '''
         Some components need to know when processing of input file
         has completed.
+        
+        When a long video is split into segments processed by different pipelines,
+        input_data['segment'] is the (start_frame, end_frame) of the segment and 
+        completed() is called once at the end of each segment.
+        '''
+        pass
+        
+        
+    def failed(self, input_file, segment):
+        '''
+        Called instead of completed() when processing of input file, or of a segment
+        of it, failed partway, so that stateful components can discard and close what
+        they kept for it. The same file may be processed again later.
+        '''
+        pass
+        
+        
+    def close(self):
+        '''
+        Called when the pipeline is closed, after its last input file, so that components
+        can release resources they hold across input files.
         '''
         pass
+        
+        
+    @classmethod
+    def stitch_segments(cls, cfg, input_file, segments, input_directory, output_directory, output_sink=None):
+        '''
+        Called once in the executor process after all segments of a video have
+        been processed, so that stateful components that write one output per input
+        file can combine their per-segment outputs, in frame order, into the final output.
+        segments is the list of (start_frame, end_frame) tuples in frame order.
+        output_sink is the executor's output sink, if outputs are written into shards.
+        Per-segment outputs should be deleted only once the final output is flushed to it.
+        
+        Returns {'file': path of final output} if an output was written.
+        '''
+        pass
+        
+        
+    @staticmethod
+    def input_relpath(input_file, input_directory):
+        '''
+        Returns path of input file relative to the input directory. Files of a file list
+        that are outside its directory are relative to the root directory instead, so
+        that their outputs are still in the output directory.
+        '''
+        relpath_of_input_file = os.path.relpath(input_file, input_directory)
+        if relpath_of_input_file == os.pardir or relpath_of_input_file.startswith(os.pardir + os.sep):
+            relpath_of_input_file = os.path.abspath(input_file).lstrip(os.sep)
+        return relpath_of_input_file
+        
+        
+    @staticmethod
+    def output_filepath_base(input_file, input_directory, output_directory, create_directory=True):
+        '''
+        Returns output file path, without extension, for an input file.
+        The output directory structure should match input directory structure,
+        so any missing directories are created unless create_directory is False.
+        '''
+        relpath_of_input_file = BaseComponent.input_relpath(input_file, input_directory)
+        relparent_of_input_file = os.path.dirname(relpath_of_input_file)
+        inp_filename,inp_extension = os.path.splitext(os.path.basename(relpath_of_input_file))
+        
+        output_filedir = os.path.join(output_directory, relparent_of_input_file)
+        if create_directory and not os.path.exists(output_filedir):
+            # exist_ok because segments of the same video may be creating it
+            # concurrently in other processes.
+            os.makedirs(output_filedir, exist_ok=True)
+            
+        return os.path.join(output_filedir, inp_filename)
+        
+        
+    def write_output(self, output_filepath, data):
+        '''
+        Writes bytes of an output file, or queues them to be written to the pipeline's
+        output sink if there's one. Missing directories are created only when the output
+        is written as a file.
+        '''
+        if self.output_sink is not None:
+            self.output_sink.write(output_filepath, data)
+            return
+            
+        output_filedir = os.path.dirname(output_filepath)
+        if output_filedir and not os.path.exists(output_filedir):
+            os.makedirs(output_filedir, exist_ok=True)
+            
+        with open(output_filepath, 'wb') as f:
+            f.write(data)
     
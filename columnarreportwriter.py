@@ -0,0 +1,513 @@
+from jsonreportwriter import JSONReportWriter, report_header
+from videosegments import segment_suffix, existing_segment_files
+
+import array
+import io
+import json
+import os
+import os.path
+import struct
+import sys
+import time
+import zipfile
+
+import numpy as np
+
+
+# Columnar reports store the same results as JSON reports in a NumPy .npz file, with
+# one typed array per field instead of nested dicts, so that they're much smaller and
+# can be loaded - memory mapped - and filtered without parsing or creating Python
+# objects per detection.
+#
+#   - name: columnarreporter
+#     type: columnarreportwriter
+#     inputs: [coco-detector, cat-face-recognizer]
+#     params:
+#       compress: false     # true writes a smaller, zip-compressed .npz that can't be memory mapped.
+#
+# Existing JSON reports can be converted with
+#   python3 columnarreportwriter.py <report.json|report.jsonl> ...
+
+# Arrays with one element per label of each detected region, or per region without labels,
+# and their array module type codes.
+DETECTION_COLUMNS = [
+    ('frame', 'i'),         # frame number
+    ('component', 'h'),     # index in 'components' of meta
+    ('region', 'i'),        # index of the region in the component's report of the frame
+    ('label', 'i'),         # index in 'labels' of meta, or -1 if the region has no labels
+    ('confidence', 'f'),    # NaN if there's none
+    ('x1', 'i'),
+    ('y1', 'i'),
+    ('x2', 'i'),
+    ('y2', 'i')
+]
+
+NUMPY_TYPES = {'i' : np.int32, 'h' : np.int16, 'f' : np.float32, 'd' : np.float64, 'b' : np.bool_}
+
+# Keys of a frame report that are not component names.
+FRAME_KEYS = set(['frame', 'timestamp', 'inferred', 'carriedforward'])
+
+
+class ColumnarReportWriter(JSONReportWriter):
+    '''
+    Component to write the results of its input sources to a columnar .npz report, 1 per
+    input file. The frame reports are the same as JSONReportWriter's, but stored as arrays:
+
+        meta                        JSON of {'file', 'type', 'components', 'labels'} as uint8 bytes
+
+        frame_numbers, timestamps,  1 element per frame. timestamps are NaN for photos.
+        inferred
+
+        carriedforward_frame,       1 element per component carried forward on a frame
+        carriedforward_component
+
+        frame, component, region,   1 element per label of each detected region. See DETECTION_COLUMNS.
+        label, confidence,
+        x1, y1, x2, y2
+
+    Labels and components are stored once in meta and referred to by index. Keys other than
+    'label' and 'confidence' in labels, like the recognizer's 'method', are not stored.
+
+    Load reports with ColumnarReport.
+    '''
+    def __init__(self, cfg):
+        JSONReportWriter.__init__(self, cfg)
+
+        self.compress = (cfg.get('params') or {}).get('compress', False)
+
+        # ColumnarReportBuilders keyed by (input file, segment).
+        self.builders = {}
+
+
+    def execute(self, input_data, input_directory, output_directory):
+        key = (input_data['file'], input_data.get('segment'))
+        builder = self.builders.get(key)
+        if builder is None:
+            builder = ColumnarReportBuilder(report_header(input_data), self.cfg['inputs'])
+            self.builders[key] = builder
+
+        builder.add_frame(self.frame_report(input_data))
+
+        return {}
+
+
+    def completed(self, input_data, input_directory, output_directory):
+        builder = self.builders.pop((input_data['file'], input_data.get('segment')), None)
+        if builder is None:
+            return None
+
+        output_filepath = self.output_filepath(input_data, input_directory, output_directory) + '.npz'
+        print(output_filepath)
+
+        if self.writes_to_sink(input_data):
+            f = io.BytesIO()
+            save_columnar_report(f, builder.meta(), builder.arrays(), self.compress)
+            self.write_output(output_filepath, f.getvalue())
+        else:
+            save_columnar_report(output_filepath, builder.meta(), builder.arrays(), self.compress)
+
+        return {'file':output_filepath}
+
+
+    def failed(self, input_file, segment):
+        self.builders.pop((input_file, segment), None)
+
+
+    @classmethod
+    def stitch_segments(cls, cfg, input_file, segments, input_directory, output_directory, output_sink=None):
+
+        output_filepath = cls.output_filepath_base(input_file, input_directory, output_directory)
+
+        segment_filepaths = existing_segment_files(input_file, [
+            output_filepath + segment_suffix(frame_range) + '.npz' for frame_range in segments ])
+        if not segment_filepaths:
+            return None
+
+        reports = [ ColumnarReport(segment_filepath, mmap=False) for segment_filepath in segment_filepaths ]
+
+        meta, arrays = merge_columnar_reports(reports)
+
+        output_filepath += '.npz'
+        print(output_filepath)
+        compress = (cfg.get('params') or {}).get('compress', False)
+        if output_sink is not None:
+            f = io.BytesIO()
+            save_columnar_report(f, meta, arrays, compress)
+            output_sink.write(output_filepath, f.getvalue())
+            output_sink.flush()
+        else:
+            save_columnar_report(output_filepath, meta, arrays, compress)
+
+        # Only once the stitched report is written, so that segments are not lost.
+        for report in reports:
+            os.remove(report.path)
+
+        return {'file':output_filepath}
+
+
+
+class ColumnarReportBuilder(object):
+    '''
+    Collects frame reports of an input file into compact arrays.
+    '''
+    def __init__(self, header, components=()):
+        self.header = header
+
+        self.components = []
+        self.component_ids = {}
+        for comp in components:
+            self.component_id(comp)
+
+        self.labels = []
+        self.label_ids = {}
+
+        self.frame_numbers = array.array('i')
+        self.timestamps = array.array('d')
+        self.inferred = array.array('b')
+        self.carriedforward_frame = array.array('i')
+        self.carriedforward_component = array.array('h')
+
+        self.columns = [ (name, array.array(typecode)) for name, typecode in DETECTION_COLUMNS ]
+
+
+    def component_id(self, comp):
+        comp_id = self.component_ids.get(comp)
+        if comp_id is None:
+            comp_id = len(self.components)
+            self.components.append(comp)
+            self.component_ids[comp] = comp_id
+        return comp_id
+
+
+    def label_id(self, label):
+        label_id = self.label_ids.get(label)
+        if label_id is None:
+            label_id = len(self.labels)
+            self.labels.append(label)
+            self.label_ids[label] = label_id
+        return label_id
+
+
+    def add_frame(self, frame_report):
+        frame_num = frame_report.get('frame', 0)
+
+        self.frame_numbers.append(frame_num)
+        timestamp = frame_report.get('timestamp')
+        self.timestamps.append(float('nan') if timestamp is None else timestamp)
+        self.inferred.append(frame_report.get('inferred', True))
+
+        for comp in frame_report.get('carriedforward') or []:
+            self.carriedforward_frame.append(frame_num)
+            self.carriedforward_component.append(self.component_id(comp))
+
+        frame, component, region, label, confidence, x1, y1, x2, y2 = [ column for name, column in self.columns ]
+
+        for comp, comp_reports in frame_report.items():
+            if comp in FRAME_KEYS:
+                continue
+
+            comp_id = self.component_id(comp)
+
+            for region_num, r in enumerate(comp_reports or []):
+                rect = [ int(round(v)) for v in r['rect'] ]
+
+                # Labels are either dicts with optional confidence, or strings with the
+                # region's confidence.
+                labels = []
+                for l in r.get('labels') or []:
+                    if isinstance(l, dict):
+                        labels.append((self.label_id(l['label']), l.get('confidence', r.get('confidence'))))
+                    else:
+                        labels.append((self.label_id(l), r.get('confidence')))
+
+                if not labels:
+                    labels.append((-1, r.get('confidence')))
+
+                for label_id, label_confidence in labels:
+                    frame.append(frame_num)
+                    component.append(comp_id)
+                    region.append(region_num)
+                    label.append(label_id)
+                    confidence.append(float('nan') if label_confidence is None else label_confidence)
+                    x1.append(rect[0])
+                    y1.append(rect[1])
+                    x2.append(rect[2])
+                    y2.append(rect[3])
+
+
+    def meta(self):
+        meta = dict(self.header)
+        meta['components'] = list(self.components)
+        meta['labels'] = list(self.labels)
+        return meta
+
+
+    def arrays(self):
+        arrays = {
+            'frame_numbers' : np.asarray(self.frame_numbers, dtype=np.int32),
+            'timestamps' : np.asarray(self.timestamps, dtype=np.float64),
+            'inferred' : np.asarray(self.inferred, dtype=np.bool_),
+            'carriedforward_frame' : np.asarray(self.carriedforward_frame, dtype=np.int32),
+            'carriedforward_component' : np.asarray(self.carriedforward_component, dtype=np.int16)
+        }
+        for name, column in self.columns:
+            arrays[name] = np.asarray(column, dtype=NUMPY_TYPES[column.typecode])
+        return arrays
+
+
+
+class ColumnarReport(object):
+    '''
+    A columnar report loaded from a .npz file written by ColumnarReportWriter.
+
+    Arrays are attributes named as in the file, and are memory mapped unless mmap is False
+    or the file is compressed. For example, frames with a cat detected by coco-detector with
+    confidence > 0.6:
+
+        report = ColumnarReport('cats.npz')
+        mask = report.select(label='cat', component='coco-detector', min_confidence=0.6)
+        frames = np.unique(report.frame[mask])
+    '''
+    def __init__(self, path, mmap=True):
+        self.path = path
+
+        arrays = load_npz(path, mmap)
+
+        meta = json.loads(bytes(arrays.pop('meta')).decode('utf-8'))
+        self.file = meta['file']
+        self.type = meta['type']
+        self.components = meta['components']
+        self.labels = meta['labels']
+
+        self.array_names = sorted(arrays.keys())
+        for name, arr in arrays.items():
+            setattr(self, name, arr)
+
+
+    def __len__(self):
+        return len(self.frame)
+
+
+    def label_id(self, label):
+        '''
+        Returns the index of label in labels, or -1 if there's no such label.
+        '''
+        return self.labels.index(label) if label in self.labels else -1
+
+
+    def component_id(self, comp):
+        return self.components.index(comp) if comp in self.components else -1
+
+
+    def select(self, label=None, component=None, min_confidence=None, first_frame=None, last_frame=None):
+        '''
+        Returns a boolean mask of the detections matching all the given filters.
+        label and component can be names or lists of names.
+        '''
+        mask = np.ones(len(self), dtype=np.bool_)
+
+        if label is not None:
+            labels = [label] if isinstance(label, str) else label
+            # Not label_id(), whose -1 for unknown labels would match regions without labels.
+            mask &= np.isin(self.label, [ self.labels.index(l) for l in labels if l in self.labels ])
+
+        if component is not None:
+            components = [component] if isinstance(component, str) else component
+            mask &= np.isin(self.component, [ self.component_id(c) for c in components ])
+
+        if min_confidence is not None:
+            # NaN confidences never match.
+            mask &= self.confidence > min_confidence
+
+        if first_frame is not None:
+            mask &= self.frame >= first_frame
+
+        if last_frame is not None:
+            mask &= self.frame <= last_frame
+
+        return mask
+
+
+    def arrays(self):
+        return dict([ (name, getattr(self, name)) for name in self.array_names ])
+
+
+    def meta(self):
+        return {'file' : self.file, 'type' : self.type, 'components' : self.components, 'labels' : self.labels}
+
+
+    def to_report(self):
+        '''
+        Returns the report as a dict in the layout of a JSON report. Labels are dicts,
+        with confidence if there is one.
+        '''
+        frame_reports = []
+        frame_indexes = {}
+        for i in range(len(self.frame_numbers)):
+            frame_report = {'frame' : int(self.frame_numbers[i])}
+            if self.type == 'video':
+                frame_report['timestamp'] = None if np.isnan(self.timestamps[i]) else float(self.timestamps[i])
+            for comp in self.components:
+                frame_report[comp] = []
+            if self.type == 'video':
+                frame_report['inferred'] = bool(self.inferred[i])
+            frame_indexes[frame_report['frame']] = len(frame_reports)
+            frame_reports.append(frame_report)
+
+        for frame_num, comp_id in zip(self.carriedforward_frame, self.carriedforward_component):
+            frame_report = frame_reports[frame_indexes[int(frame_num)]]
+            frame_report.setdefault('carriedforward', []).append(self.components[comp_id])
+
+        last_region = None
+        for i in range(len(self)):
+            comp_reports = frame_reports[frame_indexes[int(self.frame[i])]][self.components[self.component[i]]]
+
+            region = (self.frame[i], self.component[i], self.region[i])
+            if region != last_region:
+                comp_reports.append({
+                    'rect' : [int(self.x1[i]), int(self.y1[i]), int(self.x2[i]), int(self.y2[i])],
+                    'labels' : []
+                })
+                last_region = region
+
+            if self.label[i] >= 0:
+                label = {'label' : self.labels[self.label[i]]}
+                if not np.isnan(self.confidence[i]):
+                    label['confidence'] = float(self.confidence[i])
+                comp_reports[-1]['labels'].append(label)
+
+        return {'file' : self.file, 'type' : self.type, 'frames' : frame_reports}
+
+
+
+def save_columnar_report(path, meta, arrays, compress=False):
+    '''
+    Writes a columnar report to path, or to a file object.
+    '''
+    arrays = dict(arrays)
+    arrays['meta'] = np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8)
+
+    if not isinstance(path, str):
+        save = np.savez_compressed if compress else np.savez
+        save(path, **arrays)
+        return
+
+    # Open file object, so that np.savez doesn't append another .npz to the path.
+    with open(path, 'wb') as f:
+        save_columnar_report(f, meta, arrays, compress)
+
+
+
+def load_npz(path, mmap=True):
+    '''
+    Returns dict of the arrays in a .npz file. Arrays stored uncompressed are memory
+    mapped if mmap is True, and read otherwise.
+    '''
+    arrays = {}
+    with open(path, 'rb') as f:
+        with zipfile.ZipFile(f) as zf:
+            for info in zf.infolist():
+                name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+
+                if not mmap or info.compress_type != zipfile.ZIP_STORED:
+                    with zf.open(info) as member:
+                        arrays[name] = np.lib.format.read_array(member, allow_pickle=False)
+                    continue
+
+                # A stored member's .npy data follows its local file header, whose
+                # name and extra field lengths are its last 4 bytes.
+                f.seek(info.header_offset)
+                name_length, extra_length = struct.unpack('<HH', f.read(30)[26:30])
+                f.seek(info.header_offset + 30 + name_length + extra_length)
+
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+                if int(np.prod(shape)) == 0:
+                    arrays[name] = np.empty(shape, dtype=dtype)
+                else:
+                    arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                        order='F' if fortran_order else 'C')
+
+    return arrays
+
+
+
+def merge_columnar_reports(reports):
+    '''
+    Returns (meta, arrays) of reports of consecutive segments of a video concatenated
+    in order, with labels and components renumbered.
+    '''
+    meta = reports[0].meta()
+    meta['components'] = []
+    meta['labels'] = []
+
+    parts = dict([ (name, []) for name in reports[0].array_names ])
+
+    for report in reports:
+        component_map = np.asarray([ merged_id(meta['components'], c) for c in report.components ] + [-1], dtype=np.int16)
+        label_map = np.asarray([ merged_id(meta['labels'], l) for l in report.labels ] + [-1], dtype=np.int32)
+
+        for name, arr in report.arrays().items():
+            if name in ('component', 'carriedforward_component'):
+                arr = component_map[arr]
+            elif name == 'label':
+                # -1 indexes the last element of the map, which is -1.
+                arr = label_map[arr]
+            parts[name].append(np.asarray(arr))
+
+    return meta, dict([ (name, np.concatenate(arrs)) for name, arrs in parts.items() ])
+
+
+
+def merged_id(names, name):
+    if name not in names:
+        names.append(name)
+    return names.index(name)
+
+
+
+def convert_json_report(report_filepath, npz_filepath, compress=False):
+    '''
+    Converts a .json or .jsonl report written by JSONReportWriter to a columnar report.
+    '''
+    with open(report_filepath, 'r') as f:
+        if report_filepath.endswith('.jsonl'):
+            builder = ColumnarReportBuilder(json.loads(f.readline()))
+            for line in f:
+                if line.strip():
+                    builder.add_frame(json.loads(line))
+        else:
+            report = json.load(f)
+            builder = ColumnarReportBuilder({'file' : report.get('file'), 'type' : report.get('type')})
+            for frame_report in report['frames']:
+                builder.add_frame(frame_report)
+
+    save_columnar_report(npz_filepath, builder.meta(), builder.arrays(), compress)
+
+
+
+if __name__ == '__main__':
+    # Converts JSON reports to columnar reports, and compares their sizes and load times:
+    #   python3 columnarreportwriter.py <report.json|report.jsonl> ...
+    for report_filepath in sys.argv[1:]:
+        npz_filepath = os.path.splitext(report_filepath)[0] + '.npz'
+        convert_json_report(report_filepath, npz_filepath)
+
+        start = time.time()
+        with open(report_filepath, 'r') as f:
+            if report_filepath.endswith('.jsonl'):
+                [ json.loads(line) for line in f ]
+            else:
+                json.load(f)
+        json_time = time.time() - start
+
+        start = time.time()
+        detections = len(ColumnarReport(npz_filepath))
+        npz_time = time.time() - start
+
+        print("%s -> %s: %d detections, %d -> %d bytes, loaded in %.4fs -> %.4fs" % (report_filepath, npz_filepath,
+            detections, os.path.getsize(report_filepath), os.path.getsize(npz_filepath), json_time, npz_time))
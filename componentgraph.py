@@ -0,0 +1,126 @@
+import concurrent.futures
+
+
+class ComponentGraph(object):
+    '''
+    The dependency graph of pipeline components, as defined by the 'inputs'
+    of each component. A component depends on every other component named in its
+    inputs ('files' is not a component), and on the motion gate named in its 'gate'.
+
+    Components whose dependencies have all completed are independent of each other,
+    and can be executed concurrently on the same image. For example, in example-pipeline.yml,
+    human-face-detector-haar and cat-face-detector-lbp both depend only on coco-detector.
+    '''
+
+    def __init__(self, components):
+        self.components = components
+
+        names = set([comp.name for comp in components])
+
+        # Names of components each component depends on, and names of
+        # components that depend on each component.
+        self.dependencies = {}
+        self.dependents = dict([ (comp.name, []) for comp in components ])
+
+        for comp in components:
+            deps = []
+            sources = list(comp.cfg.get('inputs') or [])
+            if comp.cfg.get('gate'):
+                sources.append(comp.cfg['gate'])
+
+            for source in sources:
+                if source == 'files':
+                    continue
+
+                if source not in names:
+                    print("Warning: {} has {} in inputs but there's no such component in pipeline".format(
+                        comp.name, source))
+                    continue
+
+                if source not in deps:
+                    deps.append(source)
+                    self.dependents[source].append(comp.name)
+
+            self.dependencies[comp.name] = deps
+
+        self.order = self._topological_order()
+
+
+    def _topological_order(self):
+        '''
+        Returns the components in an order where every component comes after
+        all its dependencies. Components are otherwise kept in their pipeline file order.
+        Raises ValueError if dependencies are cyclic.
+        '''
+        order = []
+        done = set()
+
+        remaining = list(self.components)
+        while remaining:
+            ready = [ comp for comp in remaining if all([ d in done for d in self.dependencies[comp.name] ]) ]
+            if not ready:
+                raise ValueError("Invalid pipeline file. Cyclic dependencies between components: " +
+                    ', '.join([comp.name for comp in remaining]))
+
+            # Take only the first ready component so that pipeline file order
+            # is preserved as far as possible.
+            comp = ready[0]
+            order.append(comp)
+            done.add(comp.name)
+            remaining.remove(comp)
+
+        return order
+
+
+    def is_chain(self):
+        '''
+        Returns True if no two components can ever be executed concurrently.
+        '''
+        return all([ len(self.dependencies[c.name]) == 1 and self.dependencies[c.name][0] == p.name
+            for p, c in zip(self.order, self.order[1:]) ])
+
+
+    def execute(self, execute_component, executor=None):
+        '''
+        Calls execute_component(comp) for every component once all its dependencies
+        have completed, and yields (comp, outputs) in order of completion.
+
+        If executor is a concurrent.futures executor, independent components run
+        concurrently in it. Otherwise, components run one by one in topological order.
+        '''
+        if executor is None:
+            for comp in self.order:
+                yield comp, execute_component(comp)
+            return
+
+        pending_deps = dict([ (name, len(deps)) for name, deps in self.dependencies.items() ])
+        components_by_name = dict([ (comp.name, comp) for comp in self.components ])
+
+        running = {}
+        for comp in self.order:
+            if pending_deps[comp.name] == 0:
+                running[executor.submit(execute_component, comp)] = comp
+
+        try:
+            while running:
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                # Keep topological order among components that finished together.
+                for future in sorted(finished, key=lambda f: self.order.index(running[f])):
+                    comp = running.pop(future)
+
+                    # Caller should see outputs of a component before its dependents
+                    # are started, so that outputs are available to them.
+                    yield comp, future.result()
+
+                    for name in self.dependents[comp.name]:
+                        pending_deps[name] -= 1
+                        if pending_deps[name] == 0:
+                            dependent = components_by_name[name]
+                            running[executor.submit(execute_component, dependent)] = dependent
+
+        finally:
+            # On an exception in a component, wait for other running components
+            # to finish before the exception propagates, because they may be
+            # using the same input data.
+            concurrent.futures.wait(running)
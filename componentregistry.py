@@ -0,0 +1,120 @@
+import importlib
+
+try:
+    import importlib.metadata as importlib_metadata
+except ImportError:
+    # Python < 3.8
+    importlib_metadata = None
+
+
+# Entry point group under which other packages can register their own component
+# types. For example, in a plugin package's setup.py:
+#
+#   entry_points={
+#       'deepvisualminer.components' : [ 'mydetector = mypackage.mydetector:MyDetector' ]
+#   }
+#
+# makes 'type: mydetector' usable in pipeline files.
+ENTRY_POINT_GROUP = 'deepvisualminer.components'
+
+
+class ComponentRegistry(object):
+    '''
+    Maps component type names used in pipeline files to component classes.
+
+    Types are registered as 'module:ClassName' strings, and a type's module is imported
+    only when a pipeline actually uses that type. So for example TensorFlow is never
+    loaded by pipelines without a deepdetector, and cv2.face is never loaded by
+    pipelines without a recognizer.
+
+    Besides registered types, a pipeline file can give the type as a 'module:ClassName'
+    or 'module.ClassName' path of any importable component class, and packages can add
+    types through the ENTRY_POINT_GROUP entry point group.
+    '''
+
+    def __init__(self, paths):
+        self.paths = dict(paths)
+        self.classes = {}
+        self.entry_points_loaded = False
+
+
+    def get(self, type_name, default=None):
+        '''
+        Returns the component class of type_name, importing its module if necessary,
+        or default if there's no such type.
+        Raises ImportError if the type is known but its module can't be imported.
+        '''
+        comp_class = self.classes.get(type_name)
+        if comp_class is not None:
+            return comp_class
+
+        path = self.paths.get(type_name)
+
+        if path is None:
+            self._load_entry_points()
+            path = self.paths.get(type_name)
+
+        if path is None and ('.' in type_name or ':' in type_name):
+            path = type_name
+
+        if path is None:
+            return default
+
+        comp_class = import_path(path)
+        self.classes[type_name] = comp_class
+        return comp_class
+
+
+    def __getitem__(self, type_name):
+        comp_class = self.get(type_name)
+        if comp_class is None:
+            raise KeyError(type_name)
+        return comp_class
+
+
+    def __contains__(self, type_name):
+        return self.get(type_name) is not None
+
+
+    def register(self, type_name, path_or_class):
+        '''
+        Registers a component type, given its class or its 'module:ClassName' path.
+        '''
+        if isinstance(path_or_class, str):
+            self.paths[type_name] = path_or_class
+            self.classes.pop(type_name, None)
+        else:
+            self.classes[type_name] = path_or_class
+
+
+    def _load_entry_points(self):
+        if self.entry_points_loaded or importlib_metadata is None:
+            return
+        self.entry_points_loaded = True
+
+        all_entry_points = importlib_metadata.entry_points()
+        if hasattr(all_entry_points, 'select'):
+            entry_points = all_entry_points.select(group=ENTRY_POINT_GROUP)
+        else:
+            # Python < 3.10
+            entry_points = all_entry_points.get(ENTRY_POINT_GROUP, [])
+
+        for ep in entry_points:
+            # Registered types take precedence over plugins.
+            self.paths.setdefault(ep.name, ep.value)
+
+
+
+def import_path(path):
+    '''
+    Imports and returns the object at 'module:name' or 'module.name' path.
+    '''
+    if ':' in path:
+        module_name, attr = path.split(':', 1)
+    else:
+        module_name, attr = path.rsplit('.', 1)
+
+    obj = importlib.import_module(module_name)
+    for part in attr.split('.'):
+        obj = getattr(obj, part)
+    return obj
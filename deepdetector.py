@@ -1,14 +1,20 @@
-import sys
-sys.path.append('/root/darkflow')
-
-from net.build import TFNet
 from basecomponent import BaseComponent
 from annotator import annotate
+from detectorbackends import create_backend, letterbox
+import modelserver
 
 class DeepDetector(BaseComponent):
     '''
     A DeepDetector uses a YOLOv2 convolutional neural network model for
     object detection.
+    
+    With batch_size param greater than 1, the pipeline passes it batches of upto 
+    batch_size video frames or photos, whose whole images are run through the network
+    in one forward pass.
+    
+    The network is run by a backend - see detectorbackends.py - in this process, or
+    with modelserver param, by model server processes shared by all pipeline processes.
+    See modelserver.py.
     '''
     
     def __init__(self, cfg):
@@ -16,26 +22,48 @@ class DeepDetector(BaseComponent):
         
         params = self.cfg['params']
         
-        tfnet_cfg = {
-            "model": params['model'],
-            "load": params['weights'], 
-            "config" : '/root/darkflow/cfg',
-            "verbalise" : True,
-            "threshold": 0.1
-        }
+        self.backend = None
+        if params.get('modelserver'):
+            self.backend = modelserver.client(self.name)
+            if self.backend is None:
+                print("Warning: {} is not connected to a model server. Loading model in this process.".format(self.name))
+                
+        if self.backend is None:
+            self.backend = create_backend(params)
+        
+        
+    @classmethod
+    def is_fork_safe(cls, cfg):
+        # A TensorFlow session doesn't survive a fork, and model server connections
+        # belong to a pipeline process. An OpenCV network is only read.
+        params = cfg['params']
+        return params.get('backend') == 'opencv-dnn' and not params.get('modelserver')
         
-        self.nn = TFNet(tfnet_cfg)
+        
+    def is_cacheable(self):
+        return True
+        
+        
+    def batch_size(self):
+        return self.cfg['params'].get('batch_size', 1)
         
         
     def execute(self, input_data, input_directory, output_directory):
+        return self.execute_batch([input_data], input_directory, output_directory)[0]
+        
+        
+    def execute_batch(self, inputs, input_directory, output_directory):
+        
+        # Detections of each input.
+        all_detections = [ [] for input_data in inputs ]
         
         # Check what configured inputs are - whether complete image or ROIs output by some
         # other components.
-        all_detections = []
         for source in self.cfg['inputs']:
             if source == 'files':
-                detections = self.detect_in_image(input_data)
-                all_detections.extend(detections)
+                # Whole images of all the inputs are run through the network together.
+                for detections, image_detections in zip(all_detections, self.detect_in_images(inputs)):
+                    detections.extend(image_detections)
                 
             else:
                 triggerlabels = self.cfg['params'].get('triggerlabels')
@@ -43,18 +71,27 @@ class DeepDetector(BaseComponent):
                     print("Warning: pipeline file specifies {} in inputs but there are no triggerlabels in params".format(source))
                     continue
                     
-                comp_outputs = input_data.get(source)
-                if comp_outputs:
-                    comp_reports = comp_outputs['reports']
-                    detections = self.detect_in_rois(input_data, comp_reports)
-                    all_detections.extend(detections)
+                for detections, roi_detections in zip(all_detections, self.detect_in_rois_of_inputs(inputs, source)):
+                    detections.extend(roi_detections)
+        
+        all_results = []
+        for detections in all_detections:
+            results = {
+                'reports' : self.to_reports(detections)
+            }
+            print(results)
+            all_results.append(results)
+            
+        return all_results
+        
         
+    def to_reports(self, detections):
         # Each detection is of the form 
         # {"label":"person", "confidence": 0.56, "topleft": {"x": 184, "y": 101}, "bottomright": {"x": 274, "y": 382}}
         # These should be transformed to our preferred JSON output documented in basecomponent.py
         
         reports = []
-        for d in all_detections:
+        for d in detections:
             r = {
                 'labels' : [
                     {
@@ -75,41 +112,121 @@ class DeepDetector(BaseComponent):
             
             reports.append(r)
             
-        results = {
-            'reports' : reports
-        }
-        
-           
-        print(results)
-        return results
+        return reports
         
         
 
 
     def detect_in_image(self, input_data):
         print("Deep detector starting " + input_data['file'])
-        detections = self.nn.return_predict(input_data['img'])
+        detections = self.backend.predict(input_data['img'])
         print("Deep detector completed"  + input_data['file'])
         return detections
 
 
 
-
+    def detect_in_images(self, inputs):
+        '''
+        Returns list of detections in the whole image of each input data, running upto
+        batch_size images through the network in one forward pass.
+        '''
+        if len(inputs) == 1:
+            return [self.detect_in_image(inputs[0])]
+            
+        all_detections = []
+        batch_size = self.batch_size()
+        for i in range(0, len(inputs), batch_size):
+            batch = inputs[i:i+batch_size]
+            print("Deep detector starting batch of %d images of %s" % (len(batch), batch[0]['file']))
+            all_detections.extend(self.backend.predict_batch([input_data['img'] for input_data in batch]))
+            print("Deep detector completed batch of %d images of %s" % (len(batch), batch[0]['file']))
+            
+        return all_detections
+        
+        
+        
+    def is_triggered_by(self, report):
+        triggerlabels = self.cfg['params']['triggerlabels']
+        return ('all' in triggerlabels) or any( [ l['label'] in triggerlabels for l in report['labels'] ] )
+        
+        
+        
+    def detect_in_rois_of_inputs(self, inputs, source):
+        '''
+        Returns list of detections in ROIs reported by source component, for each input data.
+        
+        ROIs of all the inputs are letterboxed to network's input size - scaled to fit
+        without distorting their aspect ratio and padded - and run through the network
+        together, upto roi_batch_size ROIs in one forward pass.
+        '''
+        roi_batch_size = self.cfg['params'].get('roi_batch_size', 16)
+        if roi_batch_size == 1:
+            return [ self.detect_in_rois(input_data, (input_data.get(source) or {}).get('reports') or [])
+                for input_data in inputs ]
+        
+        # (index of input, ROI rect, ROI image) of every ROI to detect in.
+        rois = []
+        for i, input_data in enumerate(inputs):
+            comp_outputs = input_data.get(source)
+            if not comp_outputs:
+                continue
+                
+            img = input_data['img']
+            for r in comp_outputs['reports']:
+                if self.is_triggered_by(r):
+                    rect = r['rect']
+                    roi = img[ rect[1]:rect[3], rect[0]:rect[2], :]
+                    if roi.size == 0:
+                        continue
+                        
+                    rois.append((i, rect, roi))
+        
+        net_width, net_height = self.backend.input_size()
+        
+        all_detections = [ [] for input_data in inputs ]
+        
+        for start in range(0, len(rois), roi_batch_size):
+            batch = rois[start:start+roi_batch_size]
+            print("Deep detector starting batch of %d ROIs" % len(batch))
+            
+            letterboxed = [ letterbox(roi, net_width, net_height) for i, rect, roi in batch ]
+            batch_detections = self.backend.predict_batch([ boxed_img for boxed_img, scale, pad_x, pad_y in letterboxed ])
+            
+            for (i, rect, roi), (boxed_img, scale, pad_x, pad_y), detections in zip(batch, letterboxed, batch_detections):
+                roi_height, roi_width = roi.shape[:2]
+                
+                # These detections are in letterboxed image. Remove padding and scaling to
+                # get ROI coordinates, and then add ROI origin to those coordinates to make them 
+                # full image coordinates.
+                for d in detections:
+                    for corner in ('topleft', 'bottomright'):
+                        x = int(round((d[corner]['x'] - pad_x) / scale))
+                        y = int(round((d[corner]['y'] - pad_y) / scale))
+                        d[corner]['x'] = min(max(x, 0), roi_width) + rect[0]
+                        d[corner]['y'] = min(max(y, 0), roi_height) + rect[1]
+                        
+                all_detections[i].extend(detections)
+                
+            print("Deep detector completed batch of %d ROIs" % len(batch))
+                
+        return all_detections
+        
+        
+        
     def detect_in_rois(self, input_data, comp_reports):
         img = input_data['img']
         roi_detections = []
         
         for r in comp_reports:
             
-            if ('all' in self.cfg['params']['triggerlabels']) or \
-                any( [ l['label'] in self.cfg['params']['triggerlabels'] for l in r['labels'] ] ) :
+            if self.is_triggered_by(r):
             
                 rect = r['rect']
                 x_offset = rect[0]
                 y_offset = rect[1]
                 roi = img[ rect[1]:rect[3], rect[0]:rect[2], :]
                 
-                detections = self.nn.return_predict(roi)
+                detections = self.backend.predict(roi)
                 # These detections in ROI are relative to ROI. So we must add ROI origin to
                 # those coordinates to make them full image coordinates.
                 for d in detections:
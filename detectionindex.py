@@ -0,0 +1,419 @@
+from basecomponent import BaseComponent
+
+import argparse
+import json
+import os
+import os.path
+import sqlite3
+import sys
+import threading
+import time
+
+
+# A detection index is a SQLite database of the detections and recognitions in a processed
+# corpus, indexed by label, component, confidence and file, so that questions like "which
+# frames have a cat with confidence > 0.6 that was recognized as X" are answered without
+# reading every report.
+#
+# It's written during a run by a detectionindexer component:
+#
+#   - name: indexer
+#     type: detectionindexer
+#     inputs: [coco-detector, cat-face-recognizer]
+#     params:
+#       path: detections.sqlite   # relative to the output directory
+#       batch_rows: 5000          # detections inserted per transaction
+#
+# or after a run, from the reports written by jsonreportwriter or columnarreportwriter:
+#
+#   python3 detectionindex.py index <index file> <reports directory>
+#
+# and queried with:
+#
+#   python3 detectionindex.py query <index file> [--files] <term> ...
+#
+# where each term is label[@component][>confidence], and frames - or files with --files -
+# that have detections matching all the terms are listed. For example:
+#
+#   python3 detectionindex.py query detections.sqlite 'cat@coco-detector>0.6' 'X@cat-face-recognizer'
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS files (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL UNIQUE,
+        type TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS components (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE)''',
+    '''CREATE TABLE IF NOT EXISTS labels (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE)''',
+    # 1 row per label of each detected region, or per region without labels with a NULL label.
+    '''CREATE TABLE IF NOT EXISTS detections (
+        file INTEGER NOT NULL,
+        frame INTEGER NOT NULL,
+        timestamp REAL,
+        component INTEGER NOT NULL,
+        region INTEGER NOT NULL,
+        label INTEGER,
+        confidence REAL,
+        x1 INTEGER, y1 INTEGER, x2 INTEGER, y2 INTEGER)''',
+    # file and frame are included so that queries are answered from the indexes alone.
+    'CREATE INDEX IF NOT EXISTS detections_label ON detections (label, confidence, file, frame)',
+    'CREATE INDEX IF NOT EXISTS detections_component ON detections (component, label, confidence, file, frame)',
+    'CREATE INDEX IF NOT EXISTS detections_confidence ON detections (confidence)',
+    'CREATE INDEX IF NOT EXISTS detections_file ON detections (file, frame)'
+]
+
+
+class DetectionIndex(object):
+    '''
+    SQLite detection index. Each pipeline process opens its own DetectionIndex, and they
+    write concurrently in WAL mode, each inserting its detections in batches of batch_rows
+    per transaction.
+    '''
+    def __init__(self, path, batch_rows=5000):
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.batch_rows = batch_rows
+
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+        # Ids of names in the files, components and labels tables, keyed by table and name.
+        self.ids = {'files' : {}, 'components' : {}, 'labels' : {}}
+
+        # Rows not inserted yet, and frame ranges of files whose earlier detections are
+        # to be deleted before inserting them.
+        self.pending_rows = []
+        self.pending_deletes = []
+
+
+    def name_id(self, table, name):
+        name_id = self.ids[table].get(name)
+        if name_id is None:
+            self.db.execute('INSERT OR IGNORE INTO %s (name) VALUES (?)' % table, (name,))
+            # Committed right away, so that other processes aren't locked out of the index
+            # till the next flush.
+            self.db.commit()
+            name_id = self.db.execute('SELECT id FROM %s WHERE name=?' % table, (name,)).fetchone()[0]
+            self.ids[table][name] = name_id
+        return name_id
+
+
+    def file_id(self, file_path, file_type):
+        file_id = self.ids['files'].get(file_path)
+        if file_id is None:
+            self.db.execute('INSERT OR IGNORE INTO files (path, type) VALUES (?,?)', (file_path, file_type))
+            self.db.commit()
+            file_id = self.db.execute('SELECT id FROM files WHERE path=?', (file_path,)).fetchone()[0]
+            self.ids['files'][file_path] = file_id
+        return file_id
+
+
+    def replace_file(self, file_path, file_type, segment=None):
+        '''
+        Deletes the detections of file_path indexed earlier, or only those in the segment's
+        frame range, before its new detections are added. Returns the file's id.
+        '''
+        file_id = self.file_id(file_path, file_type)
+
+        # Deletes are done before inserts in a flush, so the pending detections of a file
+        # being replaced again have to be inserted first.
+        if any([ d[0] == file_id for d in self.pending_deletes ]):
+            self.flush()
+
+        start, end = segment or (0, None)
+        self.pending_deletes.append((file_id, start, end))
+        return file_id
+
+
+    def add_frame(self, file_id, frame_report):
+        '''
+        Adds detections in a frame report, as written by JSONReportWriter, to be inserted.
+        '''
+        frame_num = frame_report.get('frame', 0)
+        timestamp = frame_report.get('timestamp')
+
+        for comp, comp_reports in frame_report.items():
+            if comp in ('frame', 'timestamp', 'inferred', 'carriedforward'):
+                continue
+            self.add_reports(file_id, frame_num, timestamp, comp, comp_reports)
+
+
+    def add_reports(self, file_id, frame_num, timestamp, comp, comp_reports):
+        if not comp_reports:
+            return
+
+        comp_id = self.name_id('components', comp)
+
+        for region_num, r in enumerate(comp_reports):
+            rect = [ int(round(v)) for v in r['rect'] ]
+
+            # Labels are either dicts with optional confidence, or strings with the
+            # region's confidence.
+            labels = []
+            for l in r.get('labels') or []:
+                if isinstance(l, dict):
+                    labels.append((self.name_id('labels', l['label']), l.get('confidence', r.get('confidence'))))
+                else:
+                    labels.append((self.name_id('labels', l), r.get('confidence')))
+
+            if not labels:
+                labels.append((None, r.get('confidence')))
+
+            for label_id, confidence in labels:
+                self.pending_rows.append((file_id, frame_num, timestamp, comp_id, region_num, label_id, confidence,
+                    rect[0], rect[1], rect[2], rect[3]))
+
+        if len(self.pending_rows) >= self.batch_rows:
+            self.flush()
+
+
+    def flush(self):
+        '''
+        Deletes replaced detections and inserts pending ones in one transaction.
+        '''
+        for file_id, start, end in self.pending_deletes:
+            if end is None:
+                self.db.execute('DELETE FROM detections WHERE file=? AND frame>=?', (file_id, start))
+            else:
+                self.db.execute('DELETE FROM detections WHERE file=? AND frame>=? AND frame<?', (file_id, start, end))
+
+        self.db.executemany('INSERT INTO detections VALUES (?,?,?,?,?,?,?,?,?,?,?)', self.pending_rows)
+        self.db.commit()
+
+        self.pending_deletes = []
+        self.pending_rows = []
+
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+
+class DetectionIndexer(BaseComponent):
+    '''
+    Component to add the results of its input sources to a detection index.
+    Detections of a file indexed by an earlier run are replaced.
+    '''
+    def __init__(self, cfg):
+        BaseComponent.__init__(self, cfg)
+
+        params = cfg.get('params') or {}
+        self.path = params.get('path', 'detections.sqlite')
+        self.batch_rows = params.get('batch_rows', 5000)
+
+        # Opened on the first input, since the output directory isn't known before.
+        self.index = None
+
+        # The pipeline executes components and notifies completion from different threads.
+        self.lock = threading.Lock()
+
+        # Ids in the index of files being indexed, keyed by (input file, segment).
+        self.file_ids = {}
+
+
+    def execute(self, input_data, input_directory, output_directory):
+        with self.lock:
+            self.index_frame(input_data, output_directory)
+        return {}
+
+
+    def index_frame(self, input_data, output_directory):
+        if self.index is None:
+            self.index = DetectionIndex(os.path.join(output_directory, self.path), self.batch_rows)
+
+        key = (input_data['file'], input_data.get('segment'))
+        file_id = self.file_ids.get(key)
+        if file_id is None:
+            file_id = self.index.replace_file(input_data['file'], 'photo' if input_data['isphoto'] else 'video',
+                input_data.get('segment'))
+            self.file_ids[key] = file_id
+
+        frame_num = 0 if input_data['isphoto'] else input_data['frame']
+        timestamp = input_data.get('timestamp') if input_data['isvideo'] else None
+
+        for comp in self.cfg['inputs']:
+            self.index.add_reports(file_id, frame_num, timestamp, comp, input_data[comp]['reports'])
+
+
+    def completed(self, input_data, input_directory, output_directory):
+        with self.lock:
+            if self.file_ids.pop((input_data['file'], input_data.get('segment')), None) is not None:
+                # So that the file's detections are searchable once it's completed.
+                self.index.flush()
+        return None
+
+
+    def failed(self, input_file, segment):
+        # Forgotten, so that the file processed again replaces the detections indexed for it.
+        with self.lock:
+            self.file_ids.pop((input_file, segment), None)
+
+
+    def close(self):
+        # Checkpoints the index, so that its -wal and -shm files are removed.
+        with self.lock:
+            if self.index is not None:
+                self.index.close()
+                self.index = None
+
+
+
+def index_reports(index_path, reports_directory):
+    '''
+    Adds the detections in .json, .jsonl and .npz reports under reports_directory to the
+    detection index, replacing those of the same files indexed earlier.
+    '''
+    index = DetectionIndex(index_path)
+
+    for dirpath, dirs, files in os.walk(reports_directory):
+        for f in sorted(files):
+            report_file = os.path.join(dirpath, f)
+            extension = os.path.splitext(f)[1]
+            if extension not in ('.json', '.jsonl', '.npz') or '.segment-' in f:
+                continue
+
+            for header, frame_reports in read_report_frames(report_file):
+                if header.get('file') is None:
+                    print("Not a report: " + report_file)
+                    continue
+
+                print(report_file)
+                file_id = index.replace_file(header['file'], header.get('type'))
+                for frame_report in frame_reports:
+                    index.add_frame(file_id, frame_report)
+
+    index.close()
+
+
+
+def read_report_frames(report_file):
+    '''
+    Yields (header, frame reports) of a report file, where header has 'file' and 'type'.
+    '''
+    if report_file.endswith('.npz'):
+        from columnarreportwriter import ColumnarReport
+        report = ColumnarReport(report_file).to_report()
+        yield report, report['frames']
+
+    elif report_file.endswith('.jsonl'):
+        with open(report_file, 'r') as f:
+            header = json.loads(f.readline())
+            yield header, ( json.loads(line) for line in f if line.strip() )
+
+    else:
+        with open(report_file, 'r') as f:
+            report = json.load(f)
+        if isinstance(report, dict) and 'frames' in report:
+            yield report, report['frames']
+        else:
+            yield {}, []
+
+
+
+def parse_term(term):
+    '''
+    Parses a query term label[@component][>confidence] into (label, component, confidence).
+    '''
+    confidence = None
+    if '>' in term:
+        term, confidence = term.rsplit('>', 1)
+        confidence = float(confidence)
+
+    component = None
+    if '@' in term:
+        term, component = term.rsplit('@', 1)
+
+    return term, component, confidence
+
+
+
+def query(index_path, terms, files_only=False):
+    '''
+    Returns list of (file, frame, timestamp) of frames that have detections matching all
+    terms, or list of (file,) if files_only.
+    '''
+    if not terms:
+        raise ValueError("No query terms")
+
+    db = sqlite3.connect(index_path, timeout=60)
+
+    selects = []
+    params = []
+    for label, component, confidence in [ parse_term(term) for term in terms ]:
+        select = 'SELECT DISTINCT d.file%s FROM detections d JOIN labels l ON l.id = d.label' % ('' if files_only else ', d.frame')
+        conditions = ['l.name = ?']
+        params.append(label)
+        if component is not None:
+            select += ' JOIN components c ON c.id = d.component'
+            conditions.append('c.name = ?')
+            params.append(component)
+        if confidence is not None:
+            conditions.append('d.confidence > ?')
+            params.append(confidence)
+        selects.append(select + ' WHERE ' + ' AND '.join(conditions))
+
+    if files_only:
+        sql = 'SELECT f.path FROM files f JOIN (%s) m ON m.file = f.id ORDER BY f.path' % ' INTERSECT '.join(selects)
+    else:
+        sql = '''SELECT f.path, m.frame, (SELECT timestamp FROM detections t WHERE t.file = m.file AND t.frame = m.frame LIMIT 1)
+            FROM files f JOIN (%s) m ON m.file = f.id ORDER BY f.path, m.frame''' % ' INTERSECT '.join(selects)
+
+    rows = db.execute(sql, params).fetchall()
+    db.close()
+    return rows
+
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='detectionindex.py',
+        description='Builds and queries detection indexes.')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    index_parser = commands.add_parser('index', help='add the detections in reports to an index')
+    index_parser.add_argument('index_file')
+    index_parser.add_argument('reports_directory')
+
+    query_parser = commands.add_parser('query', help='list frames with detections matching all the terms')
+    query_parser.add_argument('index_file')
+    query_parser.add_argument('--files', action='store_true', help='list files instead of frames')
+    query_parser.add_argument('terms', nargs='+', metavar='term', help='label[@component][>confidence]')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'index':
+        index_reports(args.index_file, args.reports_directory)
+        return
+
+    start = time.time()
+    try:
+        rows = query(args.index_file, args.terms, args.files)
+    except ValueError as e:
+        query_parser.error(str(e))
+    elapsed = time.time() - start
+
+    try:
+        for row in rows:
+            print('\t'.join([ '' if v is None else str(v) for v in row ]))
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # Output piped to a command like head that exited. stdout is redirected to
+        # devnull so that flushing it again at exit doesn't fail.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return
+
+    print("%d %s in %.3fs" % (len(rows), 'files' if args.files else 'frames', elapsed), file=sys.stderr)
+
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,278 @@
+import os.path
+import sys
+
+import cv2
+import numpy as np
+
+import workerbudget
+
+# Backends that run a YOLO network for DeepDetector. A backend has:
+#
+#   predict(img)            : detections in an RGB image
+#   predict_batch(images)   : list of detections in each of a list of RGB images,
+#                             running them through the network together
+#   input_size()            : (width, height) of the network's input
+#
+# Detections are in darkflow's return_predict() format:
+#   [{"label":"person", "confidence": 0.56, "topleft": {"x": 184, "y": 101}, "bottomright": {"x": 274, "y": 382}}, ...]
+
+
+class DarkflowBackend(object):
+    '''
+    Runs the network with darkflow's TFNet, in this process.
+    '''
+
+    def __init__(self, params):
+        # Imported here so that TensorFlow is loaded only in processes that actually
+        # run a darkflow network.
+        sys.path.append('/root/darkflow')
+        from net.build import TFNet
+
+        tfnet_cfg = {
+            "model": params['model'],
+            "load": params['weights'],
+            "config" : '/root/darkflow/cfg',
+            "verbalise" : True,
+            "threshold": 0.1
+        }
+
+        self.nn = TFNet(tfnet_cfg)
+
+        if workerbudget.tensorflow_threads:
+            self._limit_session_threads(*workerbudget.tensorflow_threads)
+
+
+    def _limit_session_threads(self, intra_op_threads, inter_op_threads):
+        '''
+        TFNet creates its session with TensorFlow's default thread pools, which are as wide
+        as the machine. Replaces it with a session on the same graph that uses the given
+        number of threads. darkflow loads the weights as constant initializers of the graph's
+        variables, so running the initializers in the new session loads them again.
+        '''
+        import tensorflow as tf
+
+        # A copy of darkflow's config, so that its GPU settings - device_count={'GPU': 0}
+        # without the gpu option, or allow_soft_placement and gpu_options with it - are kept.
+        config = tf.ConfigProto()
+        if getattr(self.nn.sess, '_config', None) is not None:
+            config.CopyFrom(self.nn.sess._config)
+        config.intra_op_parallelism_threads = intra_op_threads
+        config.inter_op_parallelism_threads = inter_op_threads
+
+        with self.nn.graph.as_default():
+            sess = tf.Session(config=config)
+            sess.run(tf.global_variables_initializer())
+
+        self.nn.sess.close()
+        self.nn.sess = sess
+
+
+    def input_size(self):
+        # darkflow's inp_size is (height, width, channels).
+        height, width = self.nn.meta['inp_size'][:2]
+        return width, height
+
+
+    def predict(self, img):
+        return self.nn.return_predict(img)
+
+
+    def predict_batch(self, images):
+        '''
+        Like darkflow's return_predict(), but runs a list of images through the
+        network in a single forward pass. TFNet.return_predict() only feeds a
+        batch of 1 image, paying the per-call overhead of the TensorFlow session
+        for every image and leaving cores idle.
+        '''
+        if len(images) == 1:
+            return [self.predict(images[0])]
+
+        framework = self.nn.framework
+
+        # Images are resized to network's input size, so they can be stacked
+        # even if their sizes are different.
+        batch = np.stack([framework.resize_input(img) for img in images])
+
+        out = self.nn.sess.run(self.nn.out, {self.nn.inp : batch})
+
+        threshold = self.nn.FLAGS.threshold
+
+        all_detections = []
+        for img, img_out in zip(images, out):
+            h, w = img.shape[:2]
+
+            detections = []
+            for box in framework.findboxes(img_out):
+                tmp_box = framework.process_box(box, h, w, threshold)
+                if tmp_box is None:
+                    continue
+
+                detections.append({
+                    'label' : tmp_box[4],
+                    'confidence' : tmp_box[6],
+                    'topleft' : {'x' : tmp_box[0], 'y' : tmp_box[2]},
+                    'bottomright' : {'x' : tmp_box[1], 'y' : tmp_box[3]}
+                })
+
+            all_detections.append(detections)
+
+        return all_detections
+
+
+
+class OpenCVDNNBackend(object):
+    '''
+    Runs the network with OpenCV's dnn module, which reads darknet .cfg and .weights
+    files directly, without TensorFlow or darkflow.
+
+    Params:
+        model, weights : darknet .cfg and .weights files, same as for darkflow.
+        labels         : file with a class label on each line. Defaults to coco.names 
+                         beside the model, or labels.txt in working directory like darkflow.
+        size           : width and height images are resized to for the network. Defaults
+                         to the size in the model's .cfg.
+        threshold      : minimum confidence of detections.
+        nms_threshold  : overlap above which a less confident detection of the same 
+                         label is dropped.
+    '''
+
+    def __init__(self, params):
+        self.net = cv2.dnn.readNetFromDarknet(params['model'], params['weights'])
+        self.output_names = self.net.getUnconnectedOutLayersNames()
+
+        self.labels = read_labels(params)
+
+        size = params.get('size')
+        if size:
+            self.size = (size['width'], size['height'])
+        else:
+            self.size = darknet_input_size(params['model'])
+
+        self.threshold = params.get('threshold', 0.1)
+        self.nms_threshold = params.get('nms_threshold', 0.4)
+
+
+    def input_size(self):
+        return self.size
+
+
+    def predict(self, img):
+        return self.predict_batch([img])[0]
+
+
+    def predict_batch(self, images):
+        # Images are RGB already, which is what darknet networks expect.
+        blob = cv2.dnn.blobFromImages(images, 1.0 / 255, self.size, swapRB=False, crop=False)
+        self.net.setInput(blob)
+        outs = self.net.forward(self.output_names)
+
+        # Each output is a row per candidate box, of all the images one after another:
+        # center x, center y, width, height relative to image size, objectness, 
+        # and then score of each class.
+        outs = [ out.reshape(len(images), -1, out.shape[-1]) for out in outs ]
+
+        return [ self._detections(img, [out[i] for out in outs]) for i, img in enumerate(images) ]
+
+
+    def _detections(self, img, outs):
+        h, w = img.shape[:2]
+
+        candidates = {}
+        for out in outs:
+            class_ids = np.argmax(out[:, 5:], axis=1)
+            confidences = out[np.arange(len(out)), 5 + class_ids]
+
+            for row, class_id, confidence in zip(out[confidences > self.threshold],
+                    class_ids[confidences > self.threshold], confidences[confidences > self.threshold]):
+                cx, cy, bw, bh = row[0] * w, row[1] * h, row[2] * w, row[3] * h
+                box = [int(cx - bw / 2), int(cy - bh / 2), int(bw), int(bh)]
+                candidates.setdefault(int(class_id), []).append((box, float(confidence)))
+
+        detections = []
+        for class_id, class_candidates in sorted(candidates.items()):
+            boxes = [ box for box, confidence in class_candidates ]
+            confidences = [ confidence for box, confidence in class_candidates ]
+
+            for i in np.array(cv2.dnn.NMSBoxes(boxes, confidences, self.threshold, self.nms_threshold)).flatten():
+                x, y, bw, bh = boxes[i]
+                detections.append({
+                    'label' : self.labels[class_id] if class_id < len(self.labels) else str(class_id),
+                    'confidence' : confidences[i],
+                    'topleft' : {'x' : max(x, 0), 'y' : max(y, 0)},
+                    'bottomright' : {'x' : min(x + bw, w - 1), 'y' : min(y + bh, h - 1)}
+                })
+
+        return detections
+
+
+
+def read_labels(params):
+    labels_file = params.get('labels')
+    if not labels_file:
+        labels_file = os.path.join(os.path.dirname(params['model']), 'coco.names')
+        if not os.path.exists(labels_file):
+            labels_file = 'labels.txt'
+
+    with open(labels_file, 'r') as f:
+        return [ line.strip() for line in f if line.strip() ]
+
+
+
+def darknet_input_size(cfg_file):
+    '''
+    Returns (width, height) in the [net] section of a darknet .cfg file.
+    '''
+    values = {}
+    section = None
+    with open(cfg_file, 'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line.startswith('['):
+                section = line
+            elif section in ('[net]', '[network]') and '=' in line:
+                key, value = [ s.strip() for s in line.split('=', 1) ]
+                values[key] = value
+
+    return int(values.get('width', 416)), int(values.get('height', 416))
+
+
+
+BACKENDS = {
+    'darkflow' : DarkflowBackend,
+    'opencv-dnn' : OpenCVDNNBackend
+}
+
+
+def create_backend(params):
+    '''
+    Creates the backend selected by 'backend' in a deepdetector's params.
+    '''
+    backend_name = params.get('backend', 'darkflow')
+
+    backend_type = BACKENDS.get(backend_name)
+    if not backend_type:
+        raise ValueError("Invalid pipeline file. Unknown deepdetector backend " + backend_name)
+
+    return backend_type(params)
+
+
+
+def letterbox(img, width, height):
+    '''
+    Scales img to fit in width x height without changing its aspect ratio, and pads
+    it with gray to width x height.
+    Returns (letterboxed image, scale, x padding, y padding).
+    '''
+    img_height, img_width = img.shape[:2]
+    scale = min(float(width) / img_width, float(height) / img_height)
+
+    scaled_width = max(1, int(round(img_width * scale)))
+    scaled_height = max(1, int(round(img_height * scale)))
+    pad_x = (width - scaled_width) // 2
+    pad_y = (height - scaled_height) // 2
+
+    boxed_img = np.full((height, width, img.shape[2]), 127, dtype=img.dtype)
+    boxed_img[pad_y:pad_y+scaled_height, pad_x:pad_x+scaled_width] = cv2.resize(img,
+        (scaled_width, scaled_height), interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+
+    return boxed_img, scale, pad_x, pad_y
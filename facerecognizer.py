@@ -63,6 +63,25 @@ class FaceRecognizer(BaseComponent):
         self.equalize_hist = params.get('equalizehist', False)
         
         
+    @classmethod
+    def is_fork_safe(cls, cfg):
+        # The trained models are only read during recognition.
+        return True
+        
+        
+    def is_cacheable(self):
+        return True
+        
+        
+    def planes(self):
+        planes = ['gray']
+        # Whole image recognition can use the shared equalized plane. ROIs have to be 
+        # equalized individually, the same way training images were.
+        if self.equalize_hist and 'files' in self.cfg['inputs']:
+            planes.append('gray_equalized')
+        return planes
+        
+        
     def execute(self, input_data, input_directory, output_directory):
         
         # Check what configured inputs are - whether complete image or ROIs output by some
@@ -96,9 +115,13 @@ class FaceRecognizer(BaseComponent):
     
     def detect_in_image(self, input_data):
         
-        gray_img = input_data['gray']
+        if self.equalize_hist:
+            gray_img = input_data['gray_equalized']
+        else:
+            gray_img = input_data['gray']
         
-        results = self._detect_in_area(gray_img.copy())
+        # _detect_in_area() only reads the image, so it's passed without copying.
+        results = self._detect_in_area(gray_img, equalized=self.equalize_hist)
         
         return results
 
@@ -122,7 +145,7 @@ class FaceRecognizer(BaseComponent):
                 roi = gray_img[ rect[1]:rect[3], rect[0]:rect[2] ]
                 print("Facerecognizer: ROI ", roi.shape)
                 
-                results = self._detect_in_area(roi.copy())
+                results = self._detect_in_area(roi)
                 
                 for r in results:
                     rect = r['rect']
@@ -139,9 +162,9 @@ class FaceRecognizer(BaseComponent):
                 
                 
         
-    def _detect_in_area(self, gray_img):
+    def _detect_in_area(self, gray_img, equalized=False):
 
-        if self.equalize_hist:
+        if self.equalize_hist and not equalized:
             gray_img = cv2.equalizeHist(gray_img)
         
         if gray_img.shape != self.train_img_size:
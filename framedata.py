@@ -0,0 +1,133 @@
+import cv2
+
+import re
+import threading
+
+
+# Image planes that can be derived from the RGB image of a frame:
+#
+#   'img'               : the RGB image, always 3 channels
+#   'gray'              : grayscale image
+#   'gray_equalized'    : histogram equalized grayscale image
+#   'img_<W>x<H>'       : RGB image resized to width W and height H
+#   'gray_<W>x<H>'      : grayscale image resized to width W and height H
+#
+# Components declare the planes they read, and each plane is computed once
+# per frame and shared by all components that read it.
+
+SCALED_PLANE_RE = re.compile(r'^(img|gray)_(\d+)x(\d+)$')
+
+
+def scaled_plane_name(base_plane, width, height):
+    return '%s_%dx%d' % (base_plane, width, height)
+
+
+def is_plane_name(name):
+    return name in ('img', 'gray', 'gray_equalized') or SCALED_PLANE_RE.match(name) is not None
+
+
+
+def normalize_image(img):
+    '''
+    Returns the planes that can be had for free or have to be created right away
+    for an image decoded by imageio: the 3 channel RGB 'img' plane always, and the
+    'gray' plane too if the image itself is grayscale.
+    '''
+    planes = {}
+
+    if img.ndim == 3:
+        # It *appears* imageio imread returns RGB or RGBA, not BGR...confirmed using a blue
+        # filled rectangle that imageio is indeed RGB which is opposite of OpenCV's default BGR.
+        # Use RGB consistently everywhere.
+        if img.shape[-1] == 4:
+            print("Input image seems to be 4-channel RGBA. Creating 3-channel RGB version")
+            img = cv2.cvtColor(img, cv2.COLOR_RGBA2RGB)
+
+    elif img.ndim == 2:
+        # If input is a grayscale image, it'll have just 2 dimensions,
+        # but Darkflow code expects 3 dimensions. So always keep 'img' a 3 dimension
+        # image no matter what.
+        print("Input image is grayscale. Creating RGB version")
+        planes['gray'] = img
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+
+    else:
+        raise ValueError("Unknown image format " + str(img.shape))
+
+    planes['img'] = img
+    return planes
+
+
+
+def compute_plane(planes, name):
+    '''
+    Computes plane called name from the planes already in planes dict, adding
+    any intermediate planes it needs to the dict. Returns the plane.
+    '''
+    plane = planes.get(name)
+    if plane is not None:
+        return plane
+
+    if name == 'gray':
+        plane = cv2.cvtColor(planes['img'], cv2.COLOR_RGB2GRAY)
+
+    elif name == 'gray_equalized':
+        plane = cv2.equalizeHist(compute_plane(planes, 'gray'))
+
+    else:
+        m = SCALED_PLANE_RE.match(name)
+        if not m:
+            raise KeyError(name)
+
+        base_plane, width, height = m.group(1), int(m.group(2)), int(m.group(3))
+        plane = cv2.resize(compute_plane(planes, base_plane), (width, height), interpolation=cv2.INTER_AREA)
+
+    planes[name] = plane
+    return plane
+
+
+
+def prepare_planes(img, plane_names):
+    '''
+    Returns dict of the RGB 'img' plane and the named planes for an image decoded by imageio.
+    Used to compute planes components are known to need ahead of time, for example in
+    a prefetcher thread.
+    '''
+    planes = normalize_image(img)
+    for name in plane_names:
+        compute_plane(planes, name)
+
+    return planes
+
+
+
+class FrameData(dict):
+    '''
+    The input data dict sent through pipeline components for an image.
+
+    Image planes that aren't in it yet, like input_data['gray'], are computed on
+    first access from the 'img' plane and cached, so a plane that's not read by
+    any component is never computed, and a plane read by many components is
+    computed only once. It's safe to access planes from concurrently executing
+    components.
+    '''
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.lock = threading.Lock()
+
+
+    def __missing__(self, key):
+        if not is_plane_name(key) or dict.get(self, 'img') is None:
+            raise KeyError(key)
+
+        with self.lock:
+            return compute_plane(self, key)
+
+
+    def release_planes(self):
+        '''
+        Releases all the image arrays.
+        '''
+        for key in list(self.keys()):
+            if is_plane_name(key):
+                self[key] = None
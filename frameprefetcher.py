@@ -0,0 +1,96 @@
+from framedata import prepare_planes
+
+import queue
+import sys
+import threading
+
+
+class FramePrefetcher(object):
+    '''
+    Decodes and color converts video frames in a background thread, keeping
+    upto queue_size frames ready ahead of the frame being processed by the pipeline.
+
+    ffmpeg decoding, copying frames out of its pipe and cv2 color conversions all
+    release the GIL, so they overlap with the pipeline components working on
+    the current frame.
+
+    Iterating over it generates (frame info, planes dict) for each (frame info, image)
+    generated by frames, where planes dict has the RGB 'img' plane and the planes 
+    in plane_names. See framedata.py for planes, and framesampling.py for frame info.
+    '''
+
+    # Marks end of frames in the queue.
+    END = object()
+
+    def __init__(self, frames, queue_size, plane_names):
+        self.frames = frames
+        self.plane_names = plane_names
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.error = None
+
+        self.thread = threading.Thread(target=self._decode, name='frame-prefetcher')
+        self.thread.daemon = True
+
+
+    def __iter__(self):
+        self.thread.start()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is FramePrefetcher.END:
+                    break
+
+                yield item
+
+            if self.error:
+                # Re-raise decoding errors in the pipeline's thread.
+                raise self.error[1].with_traceback(self.error[2])
+
+        finally:
+            self.stop()
+
+
+    def stop(self):
+        '''
+        Stops decoding, for example when the pipeline stops consuming frames midway
+        due to an exception.
+        '''
+        self.stop_event.set()
+
+        # Unblock the decoder if it's waiting for room in the queue.
+        while self.thread.is_alive():
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.thread.join(0.1)
+
+
+    def _decode(self):
+        try:
+            for frame_info, img in self.frames:
+                if self.stop_event.is_set():
+                    return
+
+                planes = prepare_planes(img, self.plane_names)
+
+                if not self._put((frame_info, planes)):
+                    return
+
+        except:
+            self.error = sys.exc_info()
+
+        self._put(FramePrefetcher.END)
+
+
+    def _put(self, item):
+        # Wait for room in the queue, but give up if consumer has stopped.
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
@@ -0,0 +1,145 @@
+from videosegments import video_frames
+from mediadecoders import open_video
+
+try:
+    import av
+except ImportError:
+    av = None
+
+
+class FrameSampler(object):
+    '''
+    Selects which frames of a video are run through the pipeline, as configured by
+    the 'sampling' pipeline option:
+
+        mode: all        every frame (default)
+        mode: stride     every Nth frame, where N is 'every'
+        mode: interval   one frame every T seconds, where T is 'seconds'
+        mode: keyframes  only the key frames (I-frames) of the video. Requires PyAV.
+
+    Frames that are not sampled are not converted to images at all, and when
+    skipping far enough ahead, the reader seeks instead of decoding the skipped
+    frames. With keyframes mode, the decoder skips non-key frames entirely.
+
+    If some component needs to see the skipped frames too - see
+    BaseComponent.accepts_held_frames() - all frames are decoded, and skipped
+    frames are flagged as not sampled instead.
+    '''
+
+    def __init__(self, sampling_cfg):
+        sampling_cfg = sampling_cfg or {}
+
+        self.mode = sampling_cfg.get('mode', 'all')
+        self.every = int(sampling_cfg.get('every', 1))
+        self.seconds = float(sampling_cfg.get('seconds', 0))
+
+        if self.mode not in ('all', 'stride', 'interval', 'keyframes'):
+            raise ValueError("Invalid pipeline file. Unknown sampling mode " + self.mode)
+
+        if self.mode == 'keyframes' and av is None:
+            raise ValueError("Invalid pipeline file. Sampling mode keyframes requires PyAV (pip3 install av)")
+
+
+    def is_sampling(self):
+        return self.mode != 'all'
+
+
+    def stride(self, fps):
+        if self.mode == 'stride':
+            return max(1, self.every)
+        elif self.mode == 'interval':
+            return max(1, int(round(self.seconds * fps)))
+        return 1
+
+
+    def frames(self, input_file, video, segment, all_frames=False):
+        '''
+        Generates (frame info, image) for sampled frames of the opened video,
+        or only for sampled frames in segment's range.
+        frame info is a dict with the source frame number in 'frame', its 'timestamp' in
+        seconds and whether it's 'sampled'.
+        If all_frames is True, unsampled frames are generated too, but flagged as not sampled.
+        '''
+        if self.mode == 'keyframes':
+            for frame in keyframes(input_file, segment, all_frames):
+                yield frame
+            return
+
+        fps = video.get_meta_data().get('fps') or 0.0
+        stride = self.stride(fps)
+
+        if all_frames:
+            for frame_num, img in video_frames(video, segment):
+                yield frame_info(frame_num, fps, frame_num % stride == 0), img
+        else:
+            for frame_num, img in video_frames(video, segment, stride):
+                yield frame_info(frame_num, fps, True), img
+
+
+
+def frame_info(frame_num, fps, sampled):
+    return {
+        'frame' : frame_num,
+        'timestamp' : frame_num / fps if fps else None,
+        'sampled' : sampled
+    }
+
+
+
+def keyframes(input_file, segment, all_frames=False):
+    '''
+    Generates (frame info, image) for key frames of a video using PyAV, whose decoder
+    can skip non-key frames without decoding them.
+    If all_frames is True, all frames are decoded, and only key frames are flagged sampled.
+    '''
+    start_frame, end_frame = segment or (0, None)
+
+    container = av.open(input_file)
+    try:
+        stream = container.streams.video[0]
+        if not all_frames:
+            stream.codec_context.skip_frame = 'NONKEY'
+
+        fps = float(stream.average_rate or 0)
+        time_base = stream.time_base
+        start_pts = stream.start_time or 0
+
+        if start_frame and fps:
+            # Seeks to the key frame at or before start frame.
+            container.seek(start_pts + int(start_frame / fps / time_base), stream=stream)
+
+        for frame in container.decode(stream):
+            if frame.pts is None:
+                continue
+
+            timestamp = float((frame.pts - start_pts) * time_base)
+            frame_num = int(round(timestamp * fps))
+
+            if frame_num < start_frame:
+                continue
+            if end_frame is not None and frame_num >= end_frame:
+                break
+
+            info = {
+                'frame' : frame_num,
+                'timestamp' : timestamp,
+                'sampled' : frame.key_frame or not all_frames
+            }
+            yield info, frame.to_ndarray(format='rgb24')
+
+    finally:
+        container.close()
+
+
+
+def open_sampled_frames(input_file, segment, sampling_cfg, all_frames, video_decoder='imageio-ffmpeg'):
+    '''
+    Opens a video with video_decoder and generates (frame info, image) for its sampled
+    frames. See FrameSampler.frames().
+    '''
+    video = open_video(input_file, video_decoder)
+    try:
+        for frame in FrameSampler(sampling_cfg).frames(input_file, video, segment, all_frames):
+            yield frame
+    finally:
+        video.close()
@@ -0,0 +1,285 @@
+import collections
+import os
+import os.path
+import tarfile
+import zipfile
+
+
+# Besides a directory, the input of the pipelines can be a tar or zip archive, or a file
+# list - a text file with one path per line, relative to the list's directory or absolute.
+# Archives found in an input directory or file list are read too, without extracting them:
+# their members are read into memory and photos are decoded from the bytes read. Videos in
+# archives are written to a temporary file first, since video decoders need a file.
+#
+# A member of an archive is named by the archive's path followed by the member's name in the
+# archive, like photos/shard-00001.tar/img/0001.jpg, so outputs keep the members' names in
+# the archive, under a directory named after the archive. File lists can list members too.
+#
+# Pipeline options:
+#
+#   archives: shard     # default. Each archive is a job, whose members a pipeline process reads
+#                       # in the order they're stored, which is fastest for compressed tars.
+#                       # 'member' makes each member a job, so that the members of a few large
+#                       # archives are spread over all pipelines. Compressed tars can't be read
+#                       # a member at a time, and are still read whole.
+#                       # false ignores archives, like other files that aren't photos or videos.
+#
+#   python3 visualminer.py <input directory, archive or file list> <output directory> <pipeline file>
+
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+ZIP_EXTENSIONS = ('.zip',)
+
+FILE_LIST_EXTENSIONS = set(['.txt', '.lst', '.list'])
+
+# Compressed tars can't be counted without decompressing them, so the number of their
+# members is estimated from their size, as if the members were photos of this size.
+ESTIMATED_MEMBER_BYTES = 256 * 1024
+
+
+def is_archive(file_path):
+    return file_path.lower().endswith(TAR_EXTENSIONS + ZIP_EXTENSIONS)
+
+
+def is_file_list(file_path):
+    return os.path.splitext(file_path)[1].lower() in FILE_LIST_EXTENSIONS
+
+
+def input_directory_of(input_path):
+    '''
+    Returns the directory that output paths are relative to, for an input directory,
+    archive or file list.
+    '''
+    if os.path.isdir(input_path):
+        return input_path
+    return os.path.dirname(input_path)
+
+
+def input_files(input_path):
+    '''
+    Yields paths of files in an input directory, as it's walked, or of files in a file
+    list, or just input_path for an archive or other file.
+    '''
+    if os.path.isdir(input_path):
+        for dirpath,dirs,files in os.walk(input_path):
+            for f in files:
+                yield os.path.join(dirpath, f)
+
+    elif is_file_list(input_path):
+        yield from read_file_list(input_path)
+
+    else:
+        yield input_path
+
+
+def read_file_list(list_path):
+    '''
+    Yields paths listed in a file list. Blank lines and lines starting with # are skipped.
+    '''
+    list_directory = os.path.dirname(list_path)
+    with open(list_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            yield os.path.normpath(os.path.join(list_directory, line))
+
+
+def member_path(archive_path, member_name):
+    '''
+    Returns path that names a member of an archive, or None if the member's name would
+    take it out of the archive's directory.
+    '''
+    member_name = os.path.normpath(member_name.lstrip('/'))
+    if member_name == os.pardir or member_name.startswith(os.pardir + os.sep):
+        return None
+    return os.path.join(archive_path, member_name)
+
+
+def split_archive_path(file_path):
+    '''
+    Returns (archive path, member name) if file_path names a member of an archive, or None.
+    '''
+    path = file_path
+    while True:
+        parent = os.path.dirname(path)
+        if not parent or parent == path:
+            return None
+        if is_archive(parent) and os.path.isfile(parent):
+            return parent, os.path.relpath(file_path, parent).replace(os.sep, '/')
+        path = parent
+
+
+def stat_input(file_path):
+    '''
+    Returns os.stat() of an input file, or of its archive if it's an archive member.
+    '''
+    try:
+        return os.stat(file_path)
+    except OSError:
+        archive = split_archive_path(file_path)
+        if archive is None:
+            raise
+        return os.stat(archive[0])
+
+
+
+def archive_jobs(archive_path, granularity):
+    '''
+    Yields jobs for an archive: a single job for the whole archive, or with 'member'
+    granularity, a job for each member that can be read by itself.
+    '''
+    if granularity == 'member' and archive_path.lower().endswith(ZIP_EXTENSIONS):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                file_path = member_path(archive_path, info.filename)
+                if file_path and not info.is_dir():
+                    yield {
+                        'file' : file_path,
+                        'segment' : None,
+                        'archive' : archive_path,
+                        'member' : info.filename,
+                        'size' : info.file_size
+                    }
+        return
+
+    if granularity == 'member' and archive_path.lower().endswith('.tar'):
+        # Members of an uncompressed tar are read directly at their offset in the tar.
+        with tarfile.open(archive_path, 'r:') as tar:
+            for info in tar:
+                file_path = member_path(archive_path, info.name)
+                if file_path and info.isfile() and not info.issparse():
+                    yield {
+                        'file' : file_path,
+                        'segment' : None,
+                        'archive' : archive_path,
+                        'member' : info.name,
+                        'offset' : info.offset_data,
+                        'size' : info.size
+                    }
+                # tarfile keeps the members read, which can be millions.
+                tar.members = []
+        return
+
+    if granularity == 'member':
+        print("Reading compressed archive %s whole" % archive_path)
+
+    yield {
+        'file' : archive_path,
+        'segment' : None,
+        'shard' : True
+    }
+
+
+def count_members(archive_path):
+    '''
+    Returns the number of files in an archive, counted from the directory of a zip or the
+    headers of an uncompressed tar, or estimated from the size of a compressed tar.
+    '''
+    if archive_path.lower().endswith(ZIP_EXTENSIONS):
+        with zipfile.ZipFile(archive_path) as zf:
+            return len([ info for info in zf.infolist() if not info.is_dir() ])
+
+    if archive_path.lower().endswith('.tar'):
+        count = 0
+        with tarfile.open(archive_path, 'r:') as tar:
+            for info in tar:
+                if info.isfile():
+                    count += 1
+                tar.members = []
+        return count
+
+    return max(1, os.path.getsize(archive_path) // ESTIMATED_MEMBER_BYTES)
+
+
+
+def member_job(file_path):
+    '''
+    Returns job for a member of an archive named by file_path, such as one listed in
+    a file list, or None if it's not an archive member.
+    '''
+    archive = split_archive_path(file_path)
+    if archive is None:
+        return None
+
+    return {
+        'file' : file_path,
+        'segment' : None,
+        'archive' : archive[0],
+        'member' : archive[1]
+    }
+
+
+def iter_archive(archive_path, skip=None):
+    '''
+    Yields (file path, data) of files in an archive in the order they're stored, reading
+    the archive sequentially. Files for whose path skip returns True are not read.
+    '''
+    if archive_path.lower().endswith(ZIP_EXTENSIONS):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                file_path = member_path(archive_path, info.filename)
+                if file_path and not info.is_dir() and not (skip and skip(file_path)):
+                    yield file_path, zf.read(info)
+        return
+
+    # Uncompressed tars are read with seeks over the members skipped. Stream mode reads
+    # compressed tars without seeking back.
+    mode = 'r:' if archive_path.lower().endswith('.tar') else 'r|*'
+    with tarfile.open(archive_path, mode) as tar:
+        for info in tar:
+            file_path = member_path(archive_path, info.name)
+            if file_path and info.isfile() and not (skip and skip(file_path)):
+                yield file_path, tar.extractfile(info).read()
+            tar.members = []
+
+
+
+class ArchiveReader(object):
+    '''
+    Reads the members of archives for member jobs, keeping the last few archives read
+    open, since member jobs of an archive mostly come one after another.
+    '''
+
+    MAX_OPEN_ARCHIVES = 8
+
+    def __init__(self):
+        self.archives = collections.OrderedDict()
+
+
+    def read(self, job):
+        '''
+        Returns the data of the member of job['archive'] that job is for.
+        '''
+        archive_path = job['archive']
+
+        if job.get('offset') is not None:
+            f = self._open((archive_path, 'file'), lambda: open(archive_path, 'rb'))
+            f.seek(job['offset'])
+            return f.read(job['size'])
+
+        if archive_path.lower().endswith(ZIP_EXTENSIONS):
+            zf = self._open((archive_path, 'zip'), lambda: zipfile.ZipFile(archive_path))
+            return zf.read(job['member'])
+
+        # Compressed tars are decompressed upto the member, so they're better read whole.
+        tar = self._open((archive_path, 'tar'), lambda: tarfile.open(archive_path, 'r:*'))
+        f = tar.extractfile(job['member'])
+        if f is None:
+            raise ValueError("%s is not a file in %s" % (job['member'], archive_path))
+        return f.read()
+
+
+    def _open(self, key, open_archive):
+        archive = self.archives.pop(key, None)
+        if archive is None:
+            archive = open_archive()
+            while len(self.archives) >= ArchiveReader.MAX_OPEN_ARCHIVES:
+                self.archives.popitem(last=False)[1].close()
+        self.archives[key] = archive
+        return archive
+
+
+    def close(self):
+        for archive in self.archives.values():
+            archive.close()
+        self.archives.clear()
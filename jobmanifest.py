@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+import os.path
+import sqlite3
+import time
+
+from outputsink import OutputIndex, SHARDS_DIRECTORY, INDEX_FILENAME
+from inputsources import stat_input
+
+
+# A manifest records, in the output directory, which input files have been processed,
+# so that running a pipeline again on the same input directory and output directory
+# processes only new or changed files, files that failed last time, and files whose
+# outputs depend on components whose configuration was changed in the pipeline file.
+#
+# Pipeline options:
+#
+#   manifest: true          # default. false processes every file every time.
+#   manifest_check: mtime   # a file has changed if its size or modification time changed.
+#                           # 'content' instead compares a hash of the file's contents when
+#                           # its modification time changed, which is slower but doesn't
+#                           # reprocess files that were only touched or copied.
+#
+# Members of archives have the size and modification time of their archive, so they're
+# processed again when their archive changes. They're not content hashed.
+
+MANIFEST_FILENAME = 'manifest.sqlite'
+
+
+class JobManifest(object):
+    '''
+    SQLite manifest of jobs - files, or segments of long videos - processed in an output directory.
+
+    For each job, it records the input file's size, modification time and optionally content hash,
+    a hash of the configuration of each component when the job was processed, which components
+    the job's outputs depend on, and the output files written.
+
+    Every process opens its own JobManifest, since SQLite connections can't be shared
+    between processes.
+    '''
+
+    def __init__(self, input_directory, output_directory, components_cfg, options):
+        self.input_directory = input_directory
+        self.output_directory = output_directory
+        self.check_content = options.get('manifest_check', 'mtime') == 'content'
+
+        # Frame sampling changes the outputs of every component on videos.
+        sampling_cfg = json.dumps(options.get('sampling'), sort_keys=True, default=str)
+
+        self.component_hashes = {}
+        self.dependencies = {}
+        for comp_cfg in components_cfg:
+            comp_json = json.dumps(comp_cfg, sort_keys=True, default=str) + sampling_cfg
+            self.component_hashes[comp_cfg['name']] = hashlib.sha1(comp_json.encode('utf-8')).hexdigest()
+
+            deps = [ source for source in comp_cfg.get('inputs', []) if source != 'files' ]
+            if comp_cfg.get('gate'):
+                deps.append(comp_cfg['gate'])
+            self.dependencies[comp_cfg['name']] = deps
+
+        if not os.path.exists(output_directory):
+            os.makedirs(output_directory, exist_ok=True)
+
+        # Index of outputs written into shards, opened when first needed.
+        self.output_index = None
+
+        # Pipeline processes write to the manifest concurrently.
+        self.db = sqlite3.connect(os.path.join(output_directory, MANIFEST_FILENAME), timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            file TEXT NOT NULL,
+            segment TEXT NOT NULL,
+            size INTEGER,
+            mtime REAL,
+            content_hash TEXT,
+            status TEXT NOT NULL,
+            components TEXT,
+            relevant TEXT,
+            outputs TEXT,
+            error TEXT,
+            updated REAL,
+            PRIMARY KEY (file, segment))''')
+        self.db.commit()
+
+
+    def file_state(self, file_path):
+        '''
+        Returns (size, modification time, content hash) of file_path. Content hash is
+        None unless manifest_check is 'content', or if file_path is in an archive.
+        '''
+        st = stat_input(file_path)
+        content_hash = content_sha1(file_path) if self.check_content and os.path.isfile(file_path) else None
+        return st.st_size, st.st_mtime, content_hash
+
+
+    def is_done(self, file_path, segment=None):
+        '''
+        Returns True if the job was processed successfully earlier and doesn't need to be
+        processed again: the file hasn't changed, none of the components its outputs depend
+        on were changed, no components were added, and its output files still exist.
+        '''
+        row = self.db.execute('SELECT size, mtime, content_hash, status, components, relevant, outputs '
+            'FROM jobs WHERE file=? AND segment=?', (self._key(file_path), segment_key(segment))).fetchone()
+        if row is None:
+            return False
+
+        size, mtime, content_hash, status, components, relevant, outputs = row
+        if status != 'done':
+            return False
+
+        try:
+            st = stat_input(file_path)
+        except OSError:
+            return False
+
+        if st.st_size != size:
+            return False
+
+        if st.st_mtime != mtime:
+            if not self.check_content or content_hash is None or content_sha1(file_path) != content_hash:
+                return False
+
+        old_hashes = json.loads(components)
+        relevant = set(json.loads(relevant))
+        for name, comp_hash in self.component_hashes.items():
+            # A component that didn't exist earlier may write outputs for this file.
+            if old_hashes.get(name) != comp_hash and (name in relevant or name not in old_hashes):
+                return False
+
+        for output_file in json.loads(outputs).values():
+            if not self.output_exists(output_file):
+                return False
+
+        return True
+
+
+    def output_exists(self, output_file):
+        '''
+        Returns True if output file, relative to the output directory, was written as
+        a file or into a shard of the output sink.
+        '''
+        if os.path.exists(os.path.join(self.output_directory, output_file)):
+            return True
+
+        if self.output_index is None:
+            if not os.path.exists(os.path.join(self.output_directory, SHARDS_DIRECTORY, INDEX_FILENAME)):
+                return False
+            self.output_index = OutputIndex(self.output_directory)
+
+        return self.output_index.lookup(output_file) is not None
+
+
+    def record_done(self, file_path, segment, file_state, outputs):
+        '''
+        Records a successfully processed job. outputs is the dict of component outputs
+        returned by Pipeline.execute(). Components that returned outputs, and the components
+        they depend on, are the components relevant to the job.
+        '''
+        relevant = set()
+        pending = [ name for name, output in (outputs or {}).items() if output ]
+        while pending:
+            name = pending.pop()
+            if name not in relevant:
+                relevant.add(name)
+                pending.extend(self.dependencies.get(name, []))
+
+        output_files = dict([ (name, output['file']) for name, output in (outputs or {}).items()
+            if output and output.get('file') ])
+        
+        self._record(file_path, segment, file_state, 'done', sorted(relevant), output_files, None)
+
+
+    def record_failed(self, file_path, segment, file_state, error):
+        self._record(file_path, segment, file_state, 'failed', [], {}, error)
+
+
+    def record_stitched(self, file_path, segments, outputs):
+        '''
+        Records a video that was processed in segments, once its segments have been stitched.
+        outputs is a dict of stitched output files keyed by component name. If any segment
+        failed, the video is not recorded, and the segments are processed again next time.
+        '''
+        rows = [ self.db.execute('SELECT size, mtime, content_hash, status, relevant, outputs FROM jobs '
+                'WHERE file=? AND segment=?', (self._key(file_path), segment_key(segment))).fetchone()
+            for segment in segments ]
+
+        if any([ row is None or row[3] != 'done' for row in rows ]):
+            return
+
+        relevant = set()
+        for row in rows:
+            relevant.update(json.loads(row[4]))
+
+        self._record(file_path, None, rows[0][:3], 'done', sorted(relevant), outputs, None)
+
+        self.db.execute('DELETE FROM jobs WHERE file=? AND segment!=?', (self._key(file_path), segment_key(None)))
+        self.db.commit()
+
+
+    def _record(self, file_path, segment, file_state, status, relevant, output_files, error):
+        size, mtime, content_hash = file_state
+        
+        # Relative to the output directory, so that the output directory can be moved.
+        output_files = dict([ (name, os.path.relpath(output_file, self.output_directory)) 
+            for name, output_file in output_files.items() ])
+        
+        self.db.execute('INSERT OR REPLACE INTO jobs VALUES (?,?,?,?,?,?,?,?,?,?,?)', (
+            self._key(file_path), segment_key(segment), size, mtime, content_hash, status,
+            json.dumps(self.component_hashes), json.dumps(relevant), json.dumps(output_files),
+            error, time.time()))
+        self.db.commit()
+
+
+    def _key(self, file_path):
+        # Relative to the input directory, so that the input directory can be moved.
+        return os.path.relpath(file_path, self.input_directory)
+
+
+    def close(self):
+        self.db.close()
+        if self.output_index is not None:
+            self.output_index.close()
+
+
+
+def open_manifest(input_directory, output_directory, components_cfg, options):
+    '''
+    Returns the JobManifest of output directory, or None if disabled by the manifest option.
+    '''
+    if not options.get('manifest', True):
+        return None
+    return JobManifest(input_directory, output_directory, components_cfg, options)
+
+
+
+def segment_key(segment):
+    if not segment:
+        return ''
+    return '%d-%s' % (segment[0], '' if segment[1] is None else segment[1])
+
+
+
+def content_sha1(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
@@ -1,7 +1,9 @@
 from basecomponent import BaseComponent
+from videosegments import segment_suffix, existing_segment_files
 
 import os 
 import os.path
+import sys
 
 import simplejson as json
 
@@ -15,7 +17,9 @@ class JSONReportWriter(BaseComponent):
     The top level structure is a list of frames, regardless of photo or video.
     A photo is treated as a video with a single frame 0.
     In each frame, all the results of configured input sources are included, keyed by the
-    component name.
+    component name. 'inferred' is False for video frames on which some of those results
+    were not inferred but carried forward from an earlier frame by a motion gate, and
+    'carriedforward' lists those components.
     
     example:
     {
@@ -24,6 +28,8 @@ class JSONReportWriter(BaseComponent):
      'frames': [
          {
             'frame' : 0,
+            'timestamp' : 0.0,
+            'inferred' : true,
             'coco-detector' : 
                 [
                     {'labels':[{'label':'cat', 'confidence':0.8}, {'label':'lion', 'confidence':0.3}], 'rect':[x1,y1,x2,y2] },
@@ -34,6 +40,9 @@ class JSONReportWriter(BaseComponent):
          
          {
             'frame' : 1,
+            'timestamp' : 0.04,
+            'inferred' : false,
+            'carriedforward' : ['coco-detector'],
             'coco-detector' : 
                 [
                     {'labels':[{'label':'cat', 'confidence':0.8}, {'label':'lion', 'confidence':0.3}], 'rect':[x1,y1,x2,y2] },
@@ -47,57 +56,293 @@ class JSONReportWriter(BaseComponent):
     }
     
     These results are cached in a dict till the completed notification is received, and then dumped
-    to JSON.
+    to JSON. Reports are kept per input file, because a batch of photos is executed before
+    any of them is completed.
+    
+    If the input is a segment of a long video, a partial report with only that segment's frames
+    is written, and the partial reports are merged in frame order by stitch_segments().
+    
+    With 'format: jsonl' in params, the report is instead streamed to a JSON Lines (.jsonl)
+    file as frames are processed, so that memory used doesn't grow with the length of the
+    video. Its first line is {"file": <filename>, "type": "photo|video"}, and each following
+    line is a frame's report. The file is flushed every 'flush_frames' frames (default 100).
+    convert_jsonl_report() converts it to the report above.
     
     '''
     def __init__(self, cfg):
         BaseComponent.__init__(self, cfg)
         
-        self.full_report = None
+        params = cfg.get('params') or {}
+        self.streaming = params.get('format', 'json') == 'jsonl'
+        self.flush_frames = params.get('flush_frames', 100)
+        
+        # Reports being collected, keyed by (input file, segment).
+        self.full_reports = {}
+        
+        # With jsonl format, (output file path, open file, number of frames written)
+        # keyed by (input file, segment).
+        self.streams = {}
         
     def execute(self, input_data, input_directory, output_directory):
-        if not self.full_report:
-            self.full_report = {
-                'file' : input_data['file'],
-                'type' : 'photo' if input_data['isphoto'] else 'video',
-                'frames' : []
-            }
+        frame_report = self.frame_report(input_data)
+        
+        key = (input_data['file'], input_data.get('segment'))
         
+        if self.streaming:
+            self.write_frame_report(key, input_data, frame_report, input_directory, output_directory)
+            return {}
+            
+        full_report = self.full_reports.get(key)
+        if not full_report:
+            full_report = report_header(input_data)
+            full_report['frames'] = []
+            self.full_reports[key] = full_report
+        
+        full_report['frames'].append(frame_report)
+        
+        return {}
+        
+        
+    def frame_report(self, input_data):
         frame_report = {
             'frame' : 0 if input_data['isphoto'] else input_data['frame'],
         }
         
+        if input_data['isvideo']:
+            # Position of the frame in seconds, since frames may be sampled.
+            frame_report['timestamp'] = input_data.get('timestamp')
+        
+        # Components whose reports were carried forward from an earlier frame by a
+        # motion gate instead of being inferred on this frame.
+        carried_forward = []
+        
         for comp in self.cfg['inputs']:
             comp_outputs = input_data.get(comp)
             comp_reports = comp_outputs['reports']
             
             frame_report[comp] = comp_reports
             
-        self.full_report['frames'].append(frame_report)
+            if comp_outputs.get('carriedforward'):
+                carried_forward.append(comp)
+                
+        if input_data['isvideo']:
+            frame_report['inferred'] = not carried_forward
+            if carried_forward:
+                frame_report['carriedforward'] = carried_forward
+            
+        return frame_report
         
-        return {}
+        
+    def write_frame_report(self, key, input_data, frame_report, input_directory, output_directory):
+        stream = self.streams.get(key)
+        if stream is None:
+            output_filepath = self.output_filepath(input_data, input_directory, output_directory) + '.jsonl'
+            print(output_filepath)
+            
+            f = open(output_filepath, 'w', buffering=1 << 20)
+            f.write(json.dumps(report_header(input_data)) + '\n')
+            stream = [output_filepath, f, 0]
+            self.streams[key] = stream
+            
+        stream[1].write(json.dumps(frame_report) + '\n')
+        stream[2] += 1
+        if stream[2] % self.flush_frames == 0:
+            stream[1].flush()
 
         
     def completed(self, input_data, input_directory, output_directory):
         
-        # The output directory structure should match input directory structure.
-        relpath_of_input_file = os.path.relpath(input_data['file'], input_directory)
-        relparent_of_input_file = os.path.dirname(relpath_of_input_file)
-        inp_filename,inp_extension = os.path.splitext(os.path.basename(relpath_of_input_file))
-        
-        output_filedir = os.path.join(output_directory, relparent_of_input_file)
-        if not os.path.exists(output_filedir):
-            os.makedirs(output_filedir)
+        if self.streaming:
+            stream = self.streams.pop((input_data['file'], input_data.get('segment')), None)
+            if stream is None:
+                return None
+            stream[1].close()
+            return {'file':stream[0]}
             
-        output_filepath =  os.path.join(output_filedir, inp_filename + '.json')
+        output_filepath = self.output_filepath(input_data, input_directory, output_directory) + '.json'
             
         print(output_filepath)
         
         
-        with open(output_filepath, 'w') as f:
-            json.dump(self.full_report, f, indent=4, separators=(',', ': '))
+        # Removed so that the same input file processed again gets a new report.
+        full_report = self.full_reports.pop((input_data['file'], input_data.get('segment')), None)
+        
+        if self.writes_to_sink(input_data):
+            self.write_output(output_filepath, json.dumps(full_report, indent=4, separators=(',', ': ')).encode('utf-8'))
+        else:
+            with open(output_filepath, 'w') as f:
+                json.dump(full_report, f, indent=4, separators=(',', ': '))
+        
+        return {'file':output_filepath}
+        
+        
+    def failed(self, input_file, segment):
+        # Discarded, so that the file processed again doesn't append to its unfinished report.
+        self.full_reports.pop((input_file, segment), None)
+        
+        stream = self.streams.pop((input_file, segment), None)
+        if stream is not None:
+            # Deleted, so that it isn't taken for a complete report.
+            print("Discarding unfinished " + stream[0])
+            stream[1].close()
+            os.remove(stream[0])
+        
+        
+    def writes_to_sink(self, input_data):
+        '''
+        Returns True if input data's report is written to the pipeline's output sink.
+        Partial reports of segments are always written as files, for stitch_segments().
+        '''
+        return self.output_sink is not None and not self.streaming and not input_data.get('segment')
+        
+        
+    def output_filepath(self, input_data, input_directory, output_directory):
+        '''
+        Returns path of input data's report, without extension.
+        '''
+        output_filepath = self.output_filepath_base(input_data['file'], input_directory, output_directory,
+            not self.writes_to_sink(input_data))
+        
+        if input_data.get('segment'):
+            output_filepath += segment_suffix(input_data['segment'])
+            
+        return output_filepath
+
 
+    @classmethod
+    def stitch_segments(cls, cfg, input_file, segments, input_directory, output_directory, output_sink=None):
+        
+        output_filepath = cls.output_filepath_base(input_file, input_directory, output_directory)
+        
+        if (cfg.get('params') or {}).get('format', 'json') == 'jsonl':
+            # Written as a file even with an output sink, like unsegmented .jsonl reports.
+            return stitch_jsonl_segments(input_file, output_filepath, segments)
         
+        segment_filepaths = existing_segment_files(input_file, [
+            output_filepath + segment_suffix(frame_range) + '.json' for frame_range in segments ])
+        if segment_filepaths is None:
+            return None
+            
+        full_report = None
+        for segment_filepath in segment_filepaths:
+            with open(segment_filepath, 'r') as f:
+                segment_report = json.load(f)
+                
+            if segment_report is None:
+                # Segment turned out to be past end of video because frame count is an estimate.
+                continue
+                
+            if full_report is None:
+                full_report = segment_report
+            else:
+                full_report['frames'].extend(segment_report['frames'])
+            
+        if full_report is None:
+            return
+            
+        output_filepath += '.json'
+        print(output_filepath)
+        
+        if output_sink is not None:
+            output_sink.write(output_filepath, json.dumps(full_report, indent=4, separators=(',', ': ')).encode('utf-8'))
+            output_sink.flush()
+        else:
+            with open(output_filepath, 'w') as f:
+                json.dump(full_report, f, indent=4, separators=(',', ': '))
+            
+        # Only once the stitched report is written, so that segments are not lost.
+        for segment_filepath in segment_filepaths:
+            os.remove(segment_filepath)
+            
         return {'file':output_filepath}
 
+
+
+def report_header(input_data):
+    return {
+        'file' : input_data['file'],
+        'type' : 'photo' if input_data['isphoto'] else 'video'
+    }
+
+
+
+def stitch_jsonl_segments(input_file, output_filepath, segments):
+    '''
+    Concatenates the .jsonl reports of segments, in frame order, into the .jsonl report of
+    input file, keeping only the first segment's header line.
+    '''
+    segment_filepaths = existing_segment_files(input_file, [
+        output_filepath + segment_suffix(frame_range) + '.jsonl' for frame_range in segments ])
+    if segment_filepaths is None:
+        return None
+        
+    output_file = None
+    for segment_filepath in segment_filepaths:
+        with open(segment_filepath, 'r') as segment_file:
+            header = segment_file.readline()
+            if output_file is None:
+                print(output_filepath + '.jsonl')
+                output_file = open(output_filepath + '.jsonl', 'w', buffering=1 << 20)
+                output_file.write(header)
+                
+            for line in segment_file:
+                output_file.write(line)
+                
+    if output_file is None:
+        return None
+        
+    output_file.close()
+    
+    for segment_filepath in segment_filepaths:
+        os.remove(segment_filepath)
+        
+    return {'file':output_filepath + '.jsonl'}
+
+
+
+def read_jsonl_report(jsonl_filepath):
+    '''
+    Returns the report in a .jsonl file as a dict in the layout of a .json report.
+    '''
+    with open(jsonl_filepath, 'r') as f:
+        report = json.loads(f.readline())
+        report['frames'] = [ json.loads(line) for line in f if line.strip() ]
+    return report
+
+
+
+def convert_jsonl_report(jsonl_filepath, json_filepath):
+    '''
+    Converts a .jsonl report to a .json report, identical to what JSONReportWriter
+    writes without 'format: jsonl'. Frames are converted one at a time, so this 
+    works for reports of any length.
+    '''
+    with open(jsonl_filepath, 'r') as jsonl_file, open(json_filepath, 'w') as json_file:
+        header = json.loads(jsonl_file.readline())
+        
+        json_file.write('{\n')
+        for key, value in header.items():
+            json_file.write('    %s: %s,\n' % (json.dumps(key), json.dumps(value)))
+        json_file.write('    "frames": [')
         
+        first = True
+        for line in jsonl_file:
+            if not line.strip():
+                continue
+                
+            frame_json = json.dumps(json.loads(line), indent=4, separators=(',', ': '))
+            json_file.write('\n' if first else ',\n')
+            json_file.write('\n'.join([ '        ' + l for l in frame_json.split('\n') ]))
+            first = False
+            
+        json_file.write('\n    ]\n}' if not first else ']\n}')
+        
+
+
+if __name__ == '__main__':
+    # Converts .jsonl reports to .json reports:
+    #   python3 jsonreportwriter.py <report.jsonl> ...
+    for jsonl_filepath in sys.argv[1:]:
+        json_filepath = os.path.splitext(jsonl_filepath)[0] + '.json'
+        print("%s -> %s" % (jsonl_filepath, json_filepath))
+        convert_jsonl_report(jsonl_filepath, json_filepath)
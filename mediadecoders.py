@@ -0,0 +1,372 @@
+import os
+import os.path
+import struct
+import sys
+import tempfile
+import time
+
+import cv2
+import imageio
+import numpy as np
+
+try:
+    import av
+except ImportError:
+    av = None
+
+
+# Input files are recognized as photos or videos by their first bytes, falling back
+# to their extensions, before they're decoded. Then they're decoded by the decoders
+# selected with the 'decoders' pipeline option. Files that aren't recognized either way
+# are ignored without being decoded:
+#
+#   decoders:
+#     photo: imageio          # imageio (default) or opencv
+#     video: imageio-ffmpeg   # imageio-ffmpeg (default), opencv, or pyav (pip3 install av)
+#
+# A video decoder returns a reader with the same methods as an imageio reader that
+# the pipeline uses: iteration over frames, get_data(frame number), get_meta_data()
+# with 'fps', 'size' and 'duration', get_length() and close(). Frames are RGB.
+#
+# Files read into memory, like members of archives, are decoded from their bytes.
+
+
+# Extensions of files that are never videos.
+PHOTO_EXTENSIONS = set(['.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp',
+    '.ppm', '.pgm', '.pbm', '.pnm', '.jp2', '.j2k', '.ico'])
+
+VIDEO_EXTENSIONS = set(['.mp4', '.m4v', '.mov', '.avi', '.mkv', '.webm', '.flv', '.wmv', '.mpg', '.mpeg',
+    '.ts', '.mts', '.m2ts', '.3gp', '.ogv', '.h264', '.264', '.h265', '.hevc'])
+
+# Brands in the ftyp box of ISO media files that are still images, not videos.
+IMAGE_FTYP_BRANDS = set([b'heic', b'heix', b'mif1', b'msf1', b'avif'])
+
+# Sizes of the versions of the DIB header that follows the 14 byte header of BMP files.
+BMP_DIB_HEADER_SIZES = set([12, 16, 40, 52, 56, 64, 108, 124])
+
+
+def is_bmp_header(header):
+    '''
+    Returns whether header is the start of a BMP file. 'BM' alone starts many other files.
+    '''
+    if len(header) < 18 or not header.startswith(b'BM'):
+        return False
+
+    file_size, reserved, pixels_offset, dib_header_size = struct.unpack('<IIII', header[2:18])
+    return dib_header_size in BMP_DIB_HEADER_SIZES and pixels_offset >= 14 + dib_header_size and \
+        (file_size == 0 or file_size > pixels_offset)
+
+
+def is_netpbm_header(header):
+    '''
+    Returns whether header is the start of a PBM, PGM, PPM or PAM file.
+    '''
+    return len(header) > 2 and header[0:1] == b'P' and header[1:2] in b'1234567' and header[2:3] in b' \t\r\n'
+
+
+def sniff_media_type(file_path, data=None):
+    '''
+    Returns 'photo' or 'video' depending on the first bytes of file_path, or of data
+    if it's the file's bytes, or its extension if they're not recognized, or None if 
+    neither tells what it is.
+    '''
+    if data is not None:
+        header = data[:512]
+    else:
+        try:
+            with open(file_path, 'rb') as f:
+                header = f.read(512)
+        except (IOError, OSError):
+            return None
+
+    if header.startswith(b'\xff\xd8\xff') or header.startswith(b'\x89PNG\r\n\x1a\n') or \
+        header.startswith(b'GIF87a') or header.startswith(b'GIF89a') or is_bmp_header(header) or \
+        header.startswith(b'II*\x00') or header.startswith(b'MM\x00*') or \
+        (header.startswith(b'RIFF') and header[8:12] == b'WEBP') or is_netpbm_header(header) or \
+        header.startswith(b'\x00\x00\x00\x0cjP  \r\n\x87\n') or header.startswith(b'\xff\x4f\xff\x51'):
+        return 'photo'
+
+    if header[4:8] == b'ftyp':
+        return 'photo' if header[8:12] in IMAGE_FTYP_BRANDS else 'video'
+
+    if (header.startswith(b'RIFF') and header[8:12] == b'AVI ') or \
+        header.startswith(b'\x1a\x45\xdf\xa3') or header.startswith(b'FLV') or \
+        header.startswith(b'\x00\x00\x01\xba') or header.startswith(b'\x00\x00\x01\xb3') or \
+        header.startswith(b'\x30\x26\xb2\x75\x8e\x66\xcf\x11') or header.startswith(b'OggS') or \
+        (len(header) > 188 and header[0:1] == b'\x47' and header[188:189] == b'\x47'):
+        return 'video'
+
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in PHOTO_EXTENSIONS:
+        return 'photo'
+    if extension in VIDEO_EXTENSIONS:
+        return 'video'
+
+    return None
+
+
+
+def read_photo_imageio(file_path, data=None):
+    return imageio.imread(file_path if data is None else data)
+
+
+def read_photo_opencv(file_path, data=None):
+    if data is None:
+        img = cv2.imread(file_path, cv2.IMREAD_UNCHANGED)
+    else:
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError("OpenCV could not read " + file_path)
+
+    # Same channel order as imageio.
+    if img.ndim == 3 and img.shape[-1] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA)
+    if img.ndim == 3:
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return img
+
+
+
+class OpenCVVideoReader(object):
+    '''
+    Reads a video with cv2.VideoCapture.
+    '''
+
+    # Frames upto this far ahead are reached by grabbing frames without converting
+    # them, instead of seeking.
+    MAX_SKIP_FRAMES = 100
+
+    def __init__(self, file_path):
+        self.capture = cv2.VideoCapture(file_path)
+        if not self.capture.isOpened():
+            raise ValueError("OpenCV could not open " + file_path)
+
+        # Number of the frame read next.
+        self.position = 0
+
+
+    def get_meta_data(self):
+        fps = self.capture.get(cv2.CAP_PROP_FPS) or 0.0
+        nframes = self.capture.get(cv2.CAP_PROP_FRAME_COUNT)
+        return {
+            'fps' : fps,
+            'size' : (int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))),
+            'duration' : nframes / fps if nframes > 0 and fps else None
+        }
+
+
+    def get_length(self):
+        nframes = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        return nframes if nframes > 0 else float('inf')
+
+
+    def get_data(self, index):
+        if index < self.position or index - self.position > OpenCVVideoReader.MAX_SKIP_FRAMES:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+            self.position = index
+
+        while self.position < index:
+            if not self.capture.grab():
+                raise IndexError("Frame %d is beyond end of video" % index)
+            self.position += 1
+
+        img = self._read()
+        if img is None:
+            raise IndexError("Frame %d is beyond end of video" % index)
+        return img
+
+
+    def __iter__(self):
+        while True:
+            img = self._read()
+            if img is None:
+                return
+            yield img
+
+
+    def _read(self):
+        ok, img = self.capture.read()
+        if not ok:
+            return None
+        self.position += 1
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+    def close(self):
+        self.capture.release()
+
+
+
+class PyAVVideoReader(object):
+    '''
+    Reads a video with PyAV.
+    '''
+
+    def __init__(self, file_path):
+        if av is None:
+            raise ValueError("Invalid pipeline file. Video decoder pyav requires PyAV (pip3 install av)")
+
+        self.container = av.open(file_path)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = 'AUTO'
+
+        self.fps = float(self.stream.average_rate or 0)
+        self.start_pts = self.stream.start_time or 0
+
+        self.frames = None
+        # Number of the frame decoded next.
+        self.position = 0
+
+
+    def get_meta_data(self):
+        duration = None
+        if self.container.duration:
+            duration = self.container.duration / float(av.time_base)
+        return {
+            'fps' : self.fps,
+            'size' : (self.stream.codec_context.width, self.stream.codec_context.height),
+            'duration' : duration
+        }
+
+
+    def get_length(self):
+        return self.stream.frames or float('inf')
+
+
+    def get_data(self, index):
+        if self.frames is None or index < self.position or (self.fps and index - self.position > self.fps * 10):
+            self._seek(index)
+
+        # Frames before index are decoded but not converted.
+        for frame_num, frame in self.frames:
+            self.position = frame_num + 1
+            if frame_num >= index:
+                return frame.to_ndarray(format='rgb24')
+
+        raise IndexError("Frame %d is beyond end of video" % index)
+
+
+    def __iter__(self):
+        self._seek(0)
+        for frame_num, frame in self.frames:
+            self.position = frame_num + 1
+            yield frame.to_ndarray(format='rgb24')
+
+
+    def _seek(self, index):
+        if index and self.fps:
+            # Seeks to the key frame at or before index.
+            self.container.seek(self.start_pts + int(index / self.fps / self.stream.time_base), stream=self.stream)
+        else:
+            self.container.seek(self.start_pts, stream=self.stream)
+
+        self.frames = self._numbered_frames()
+        self.position = index
+
+
+    def _numbered_frames(self):
+        frame_num = None
+        for frame in self.container.decode(self.stream):
+            if frame.pts is not None and self.fps:
+                frame_num = int(round(float((frame.pts - self.start_pts) * self.stream.time_base) * self.fps))
+            elif frame_num is None:
+                frame_num = 0
+            else:
+                frame_num += 1
+            yield frame_num, frame
+
+
+    def close(self):
+        self.container.close()
+
+
+
+PHOTO_DECODERS = {
+    'imageio' : read_photo_imageio,
+    'opencv' : read_photo_opencv
+}
+
+VIDEO_DECODERS = {
+    'imageio-ffmpeg' : lambda file_path: imageio.get_reader(file_path, 'ffmpeg'),
+    'opencv' : OpenCVVideoReader,
+    'pyav' : PyAVVideoReader
+}
+
+
+def decoder_names(options):
+    '''
+    Returns (photo decoder name, video decoder name) selected by pipeline options.
+    Raises ValueError if either is unknown.
+    '''
+    decoders_cfg = options.get('decoders') or {}
+    photo_decoder = decoders_cfg.get('photo', 'imageio')
+    video_decoder = decoders_cfg.get('video', 'imageio-ffmpeg')
+
+    if photo_decoder not in PHOTO_DECODERS:
+        raise ValueError("Invalid pipeline file. Unknown photo decoder " + photo_decoder)
+    if video_decoder not in VIDEO_DECODERS:
+        raise ValueError("Invalid pipeline file. Unknown video decoder " + video_decoder)
+    if video_decoder == 'pyav' and av is None:
+        raise ValueError("Invalid pipeline file. Video decoder pyav requires PyAV (pip3 install av)")
+
+    return photo_decoder, video_decoder
+
+
+def read_photo(file_path, decoder='imageio', data=None):
+    '''
+    Decodes photo file_path, or data if it's the file's bytes.
+    '''
+    return PHOTO_DECODERS[decoder](file_path, data)
+
+
+def open_video(file_path, decoder='imageio-ffmpeg'):
+    return VIDEO_DECODERS[decoder](file_path)
+
+
+def write_temporary_file(file_path, data):
+    '''
+    Writes data, the bytes of file_path, to a temporary file with the same extension,
+    for decoders that need a file. Returns path of temporary file, which the caller 
+    should remove.
+    '''
+    fd, temp_path = tempfile.mkstemp(suffix=os.path.splitext(file_path)[1], prefix='deepvisualminer-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    return temp_path
+
+
+
+def benchmark(file_path):
+    '''
+    Decodes file_path with every available decoder for its type, and prints
+    how long each takes.
+    '''
+    media_type = sniff_media_type(file_path)
+    print("%s is a %s" % (file_path, media_type))
+
+    if media_type == 'photo':
+        for name in sorted(PHOTO_DECODERS):
+            start = time.time()
+            img = read_photo(file_path, name)
+            print("%-16s %s in %.3fs" % (name, img.shape, time.time() - start))
+
+    elif media_type == 'video':
+        for name in sorted(VIDEO_DECODERS):
+            if name == 'pyav' and av is None:
+                continue
+            start = time.time()
+            video = open_video(file_path, name)
+            try:
+                nframes = sum([ 1 for img in video ])
+            finally:
+                video.close()
+            elapsed = time.time() - start
+            print("%-16s %d frames in %.2fs, %.1f frames/s" % (name, nframes, elapsed, nframes / elapsed if elapsed else 0))
+
+
+
+if __name__ == '__main__':
+    # Compare decoders on files in the formats of a collection:
+    #   python3 mediadecoders.py <file> ...
+    for file_path in sys.argv[1:]:
+        benchmark(file_path)
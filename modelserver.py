@@ -0,0 +1,374 @@
+import multiprocessing
+import multiprocessing.connection
+import queue
+import time
+import traceback
+
+import sharedframes
+import workerbudget
+from detectorbackends import create_backend
+
+
+# A model server is a process that owns a deepdetector's network and runs it for
+# deepdetectors in all the pipeline processes, instead of every pipeline process loading
+# its own copy of the network. Images are passed to it through shared memory, as
+# FrameHandles of a SharedFramePool, and only the detections are sent back.
+#
+# A deepdetector uses model servers when its params have:
+#
+#   modelserver:
+#     instances: 1          # server processes sharing the requests, each with its own network
+#     batch_size: 16        # most images run through the network together
+#     batch_timeout: 0.01   # seconds to wait for requests from other pipelines to fill a batch
+
+# How often a pipeline process waiting for a response checks that the servers are running.
+SERVER_CHECK_INTERVAL = 5
+
+
+class ModelServerConnection(object):
+    '''
+    What a pipeline process needs to talk to the model servers of a deepdetector.
+    Requests are put in request_queue, which all the servers of the deepdetector read,
+    and responses for this pipeline process come back in response_queue.
+    server_sentinels are the sentinels of the server processes, which become ready when
+    they exit. Process.is_alive() only works in the process that started them.
+    '''
+    def __init__(self, worker_id, request_queue, response_queue, server_sentinels=()):
+        self.worker_id = worker_id
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+        self.server_sentinels = list(server_sentinels)
+
+
+    def check_servers(self, name):
+        '''
+        Raises RuntimeError if a server has exited, since the requests it had taken are
+        never answered.
+        '''
+        if multiprocessing.connection.wait(self.server_sentinels, 0):
+            raise RuntimeError("Model server for %s exited" % name)
+
+
+
+class ModelServer(multiprocessing.Process):
+    '''
+    Serves detection requests of a deepdetector from all pipeline processes.
+
+    A request is (worker id, request id, list of FrameHandles of images), or
+    (worker id, request id, None) to ask for the network's input size.
+    The response, put in the worker's response queue, is (request id, list of detections
+    for each image), or (request id, error message string) if there was an error.
+    (worker id, None, None) tells that the worker closed its pool, and gets no response.
+
+    The shared memory of a worker's pool stays attached between its requests. It's
+    detached when the worker closes the pool, or replaces it with a larger one.
+
+    Requests from different workers that arrive together are run through the network
+    in one batch.
+    '''
+
+    def __init__(self, cfg, request_queue, response_queues, budget=None):
+        multiprocessing.Process.__init__(self)
+        self.daemon = True
+
+        self.cfg = cfg
+        self.request_queue = request_queue
+        self.response_queues = response_queues
+        self.budget = budget
+
+        server_cfg = server_params(cfg)
+        self.batch_size = server_cfg.get('batch_size', 16)
+        self.batch_timeout = server_cfg.get('batch_timeout', 0.01)
+
+        # Name of the pool attached for each worker, keyed by worker id.
+        self.worker_pools = {}
+
+
+    def run(self):
+        print("Model server for %s loading model" % self.cfg['name'])
+
+        if self.budget:
+            workerbudget.apply_budget(self.budget)
+
+        backend = None
+        load_error = None
+        try:
+            backend = create_backend(self.cfg['params'])
+        except:
+            load_error = "Model server for %s could not load model:\n%s" % (self.cfg['name'], traceback.format_exc())
+            print(load_error)
+
+        stopped = False
+        while not stopped:
+            requests, stopped = self._next_requests()
+            requests = self._detach_pools(requests)
+            if not requests:
+                continue
+
+            if load_error:
+                for worker_id, request_id, handles in requests:
+                    self.response_queues[worker_id].put((request_id, load_error))
+                continue
+
+            try:
+                self._serve(backend, requests)
+            except:
+                error = "Error in model server for %s:\n%s" % (self.cfg['name'], traceback.format_exc())
+                for worker_id, request_id, handles in requests:
+                    self.response_queues[worker_id].put((request_id, error))
+
+        print("Model server for %s exiting" % self.cfg['name'])
+
+
+    def _next_requests(self):
+        '''
+        Waits for a request, and then takes more requests for upto batch_timeout seconds
+        till there are batch_size images.
+        Returns (list of requests, whether server should stop).
+        '''
+        request = self.request_queue.get()
+        if request is None:
+            return [], True
+
+        requests = [request]
+        num_images = len(request[2] or [])
+        deadline = time.time() + self.batch_timeout
+
+        while num_images < self.batch_size:
+            try:
+                request = self.request_queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+
+            if request is None:
+                return requests, True
+
+            requests.append(request)
+            num_images += len(request[2] or [])
+
+        return requests, False
+
+
+    def _detach_pools(self, requests):
+        '''
+        Detaches the pools that workers closed or replaced. Returns the requests that
+        need responses.
+        '''
+        served = []
+        for worker_id, request_id, handles in requests:
+            pool_name = handles[0].pool_name if handles else None
+
+            if request_id is None or (pool_name and self.worker_pools.get(worker_id, pool_name) != pool_name):
+                old_pool_name = self.worker_pools.pop(worker_id, None)
+                if old_pool_name:
+                    sharedframes.detach(old_pool_name)
+
+            if pool_name:
+                self.worker_pools[worker_id] = pool_name
+
+            if request_id is not None:
+                served.append((worker_id, request_id, handles))
+
+        return served
+
+
+    def _serve(self, backend, requests):
+        images = []
+        for worker_id, request_id, handles in requests:
+            for handle in handles or []:
+                images.append(sharedframes.attach_views(handle)[0])
+
+        print("Model server for %s running %d images of %d requests" % (self.cfg['name'], len(images), len(requests)))
+
+        all_detections = []
+        for i in range(0, len(images), self.batch_size):
+            all_detections.extend(backend.predict_batch(images[i:i+self.batch_size]))
+
+        # Drop the views before responding, after which the workers reuse their slots.
+        images = None
+
+        for worker_id, request_id, handles in requests:
+            if handles is None:
+                self.response_queues[worker_id].put((request_id, backend.input_size()))
+            else:
+                self.response_queues[worker_id].put((request_id, all_detections[:len(handles)]))
+                all_detections = all_detections[len(handles):]
+
+
+
+class ModelServerClient(object):
+    '''
+    A deepdetector backend that sends images to model servers through a ModelServerConnection
+    instead of running a network itself.
+
+    Images are copied into this client's own SharedFramePool, which grows as needed.
+    '''
+
+    def __init__(self, name, connection):
+        self.name = name
+        self.connection = connection
+        self.pool = None
+        self.next_request_id = 0
+        self.network_input_size = None
+
+
+    def input_size(self):
+        if self.network_input_size is None:
+            self.network_input_size = tuple(self._request(None))
+        return self.network_input_size
+
+
+    def predict(self, img):
+        return self.predict_batch([img])[0]
+
+
+    def predict_batch(self, images):
+        self._ensure_pool(images)
+
+        handles = [ self.pool.put(img) for img in images ]
+        try:
+            return self._request(handles)
+        finally:
+            for handle in handles:
+                self.pool.release(handle)
+
+
+    def _request(self, handles):
+        request_id = self.next_request_id
+        self.next_request_id += 1
+
+        self.connection.request_queue.put((self.connection.worker_id, request_id, handles))
+
+        while True:
+            try:
+                response_id, result = self.connection.response_queue.get(timeout=SERVER_CHECK_INTERVAL)
+            except queue.Empty:
+                self.connection.check_servers(self.name)
+                continue
+            if response_id == request_id:
+                break
+            # A response to an earlier request that was abandoned due to an error.
+
+        if isinstance(result, str):
+            raise RuntimeError(result)
+
+        return result
+
+
+    def _ensure_pool(self, images):
+        slot_bytes = max([ img.nbytes for img in images ]) + 8
+        if self.pool and self.pool.num_slots >= len(images) and self.pool.slot_bytes >= slot_bytes:
+            return
+
+        num_slots = len(images)
+        if self.pool:
+            num_slots = max(num_slots, self.pool.num_slots)
+            slot_bytes = max(slot_bytes, self.pool.slot_bytes)
+            self.pool.close()
+
+        self.pool = sharedframes.SharedFramePool(num_slots, slot_bytes)
+
+
+    def close(self):
+        if self.pool:
+            # Only the server that takes this detaches the pool now. Other instances of
+            # the server detach it when this worker's requests come from a new pool.
+            self.connection.request_queue.put((self.connection.worker_id, None, None))
+            self.pool.close()
+            self.pool = None
+
+
+
+def server_params(cfg):
+    '''
+    Returns the model server params of a deepdetector's config, or None if it doesn't
+    use a model server.
+    '''
+    server_cfg = cfg.get('params', {}).get('modelserver')
+    if not server_cfg:
+        return None
+    return server_cfg if isinstance(server_cfg, dict) else {}
+
+
+
+def start_model_servers(components_cfg, num_workers, cpu_count=None):
+    '''
+    Starts the model servers of every deepdetector in components_cfg that uses them.
+    If cpu_count is given, the instances of a deepdetector's server split that many cores
+    between them, the same way pipeline processes do.
+    Returns (list of server processes, list of connections dict of each worker), where
+    a connections dict maps deepdetector name to its ModelServerConnection.
+    '''
+    servers = []
+    worker_connections = [ {} for i in range(num_workers) ]
+
+    if not sharedframes.is_available():
+        print("Shared memory is not available in this version of python. Not starting model servers.")
+        return servers, worker_connections
+
+    for cfg in components_cfg:
+        server_cfg = server_params(cfg)
+        if cfg['type'] != 'deepdetector' or server_cfg is None:
+            continue
+
+        request_queue = multiprocessing.Queue()
+        response_queues = [ multiprocessing.Queue() for i in range(num_workers) ]
+
+        instances = server_cfg.get('instances', 1)
+        budget = workerbudget.plan_budget({}, cpu_count, instances) if cpu_count else None
+
+        sentinels = []
+        for i in range(instances):
+            server = ModelServer(cfg, request_queue, response_queues, budget)
+            server.start()
+            servers.append(server)
+            sentinels.append(server.sentinel)
+
+        for worker_id in range(num_workers):
+            worker_connections[worker_id][cfg['name']] = ModelServerConnection(
+                worker_id, request_queue, response_queues[worker_id], sentinels)
+
+    return servers, worker_connections
+
+
+
+def stop_model_servers(servers):
+    # Each server takes one None from its deepdetector's request queue and exits.
+    for server in servers:
+        server.request_queue.put(None)
+
+    for server in servers:
+        server.join()
+
+
+
+# Connections of this pipeline process to model servers, and clients created on them,
+# keyed by deepdetector name.
+_connections = {}
+_clients = {}
+
+def connect(connections):
+    '''
+    Called in a pipeline process before its pipeline is created, with the connections
+    returned for it by start_model_servers().
+    '''
+    _connections.update(connections)
+
+
+def client(name):
+    '''
+    Returns a ModelServerClient for deepdetector called name, or None if this
+    process is not connected to a model server for it.
+    '''
+    if name not in _connections:
+        return None
+
+    if name not in _clients:
+        _clients[name] = ModelServerClient(name, _connections[name])
+    return _clients[name]
+
+
+def close_clients():
+    for c in _clients.values():
+        c.close()
+    _clients.clear()
@@ -0,0 +1,118 @@
+import cv2
+import numpy as np
+
+from basecomponent import BaseComponent
+from framedata import scaled_plane_name
+
+
+class MotionGate(BaseComponent):
+    '''
+    A MotionGate decides for each video frame whether it has changed enough
+    since the last frame that was inferred on, to be worth running expensive
+    detectors on again. It compares downscaled grayscale images, which is cheap.
+
+    Components that name a gate in their 'gate' setting are executed only on frames
+    the gate lets through. On other frames their reports of the last inferred frame
+    are carried forward, marked with 'carriedforward' in their outputs.
+
+    Params:
+        method          : 'diff' compares pixels, 'histogram' compares histograms of
+                          intensities, which is less sensitive to small movements and noise.
+        size            : width and height the frames are downscaled to for comparison.
+        threshold       : for diff, the fraction of pixels that should have changed.
+                          For histogram, the Bhattacharyya distance between histograms.
+        pixel_threshold : for diff, how much a pixel's intensity should change for it
+                          to count as changed.
+        refresh_frames  : frames are inferred at least once every refresh_frames frames,
+                          even if nothing seems to have changed.
+
+    Outputs 'infer' - True if gated components should run - and the change 'score'.
+    Photos, and first frame of every video or video segment, are always inferred.
+    '''
+
+    def __init__(self, cfg):
+        BaseComponent.__init__(self, cfg)
+
+        params = cfg.get('params') or {}
+
+        self.method = params.get('method', 'diff')
+        if self.method not in ('diff', 'histogram'):
+            raise ValueError("Invalid pipeline file. Unknown motion gate method " + self.method)
+
+        size = params.get('size') or {}
+        self.plane = scaled_plane_name('gray', size.get('width', 160), size.get('height', 120))
+
+        self.threshold = params.get('threshold', 0.02 if self.method == 'diff' else 0.1)
+        self.pixel_threshold = params.get('pixel_threshold', 25)
+        self.refresh_frames = params.get('refresh_frames', 100)
+
+        self.reset()
+
+
+    def reset(self):
+        # Thumbnail or histogram of the last inferred frame. Frames are compared with
+        # it rather than with the previous frame, so that slow changes add up.
+        self.reference = None
+        self.reference_frame = None
+        self.reference_video = None
+
+
+    def planes(self):
+        return [self.plane]
+
+
+    def execute(self, input_data, input_directory, output_directory):
+        if not input_data['isvideo']:
+            return {'reports' : [], 'infer' : True, 'score' : None}
+
+        frame_num = input_data['frame']
+        signature = self._signature(input_data[self.plane])
+
+        video = (input_data['file'], input_data.get('segment'))
+        if video != self.reference_video:
+            # Don't compare with a frame of the previous video, even if that
+            # video was not completed due to an error.
+            self.reset()
+            self.reference_video = video
+
+        if self.reference is None:
+            infer, score = True, None
+
+        else:
+            score = self._change(signature)
+            infer = score > self.threshold or frame_num - self.reference_frame >= self.refresh_frames
+
+        if infer:
+            self.reference = signature
+            self.reference_frame = frame_num
+
+        print("motiongate: frame {} change {} infer {}".format(frame_num, score, infer))
+
+        return {'reports' : [], 'infer' : infer, 'score' : score}
+
+
+    def _signature(self, gray_img):
+        if self.method == 'histogram':
+            hist = cv2.calcHist([gray_img], [0], None, [64], [0, 256])
+            return cv2.normalize(hist, hist)
+
+        # Keep a copy because the plane may be a view into a shared frame pool
+        # slot that's reused for another frame.
+        return gray_img.copy()
+
+
+    def _change(self, signature):
+        if self.method == 'histogram':
+            return float(cv2.compareHist(self.reference, signature, cv2.HISTCMP_BHATTACHARYYA))
+
+        changed = cv2.absdiff(self.reference, signature) > self.pixel_threshold
+        return float(np.count_nonzero(changed)) / changed.size
+
+
+    def completed(self, input_data, input_directory, output_directory):
+        self.reset()
+
+
+    def failed(self, input_file, segment):
+        # So that a retry of the same video doesn't compare with a frame of the failed attempt.
+        self.reset()
@@ -0,0 +1,309 @@
+import io
+import os
+import os.path
+import queue
+import socket
+import sqlite3
+import sys
+import tarfile
+import threading
+import time
+
+
+# An output sink writes the outputs of writer components - annotated frames and photos,
+# and JSON and columnar reports - into large tar shards in the output directory instead
+# of into millions of small files, which is much faster on network filesystems where
+# creating files and directories dominates. Outputs are appended to shards by a writer
+# thread in each pipeline process, and an index records where each output is, so that
+# a single output can be read without unpacking its shard.
+#
+# Pipeline options:
+#
+#   output_sink:
+#     shard_size_mb: 1024     # a new shard is started once a shard is larger than this
+#     queue_size: 256         # outputs waiting to be written, before writers block
+#
+# Outputs are keyed by the path, relative to the output directory, that they'd have
+# been written to otherwise. Shards and their index are in the 'shards' directory of
+# the output directory:
+#
+#   python3 outputsink.py <output directory> list [key prefix]
+#   python3 outputsink.py <output directory> get <key> [destination file]
+#
+# Annotated videos, JSON Lines reports and the partial reports of video segments are
+# still written as files.
+
+SHARDS_DIRECTORY = 'shards'
+INDEX_FILENAME = 'index.sqlite'
+
+
+class OutputIndex(object):
+    '''
+    SQLite index of the outputs in shards of an output directory: each output's shard,
+    and the offset and size of its data in the shard. Written concurrently by the output
+    sinks of all pipeline processes.
+    '''
+    def __init__(self, output_directory):
+        self.output_directory = output_directory
+
+        shards_directory = os.path.join(output_directory, SHARDS_DIRECTORY)
+        if not os.path.exists(shards_directory):
+            os.makedirs(shards_directory, exist_ok=True)
+
+        self.db = sqlite3.connect(os.path.join(shards_directory, INDEX_FILENAME), timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS outputs (
+            key TEXT PRIMARY KEY,
+            shard TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            written REAL NOT NULL)''')
+        self.db.commit()
+
+
+    def add(self, entries):
+        '''
+        Records (key, shard, offset, size) of outputs written. An output written again
+        replaces the earlier one.
+        '''
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO outputs VALUES (?,?,?,?,?)',
+            [ (key, shard, offset, size, now) for key, shard, offset, size in entries ])
+        self.db.commit()
+
+
+    def lookup(self, key):
+        '''
+        Returns (shard path, offset, size) of output with key, or None if it's not in a shard.
+        '''
+        row = self.db.execute('SELECT shard, offset, size FROM outputs WHERE key=?', (key,)).fetchone()
+        if row is None:
+            return None
+        return os.path.join(self.output_directory, SHARDS_DIRECTORY, row[0]), row[1], row[2]
+
+
+    def keys(self, prefix=''):
+        return [ row[0] for row in self.db.execute('SELECT key FROM outputs WHERE key >= ? AND key < ? ORDER BY key',
+            (prefix, prefix + '\U0010ffff')) ]
+
+
+    def read(self, key):
+        '''
+        Returns the data of output with key, or None if it's not in a shard.
+        '''
+        location = self.lookup(key)
+        if location is None:
+            return None
+
+        shard, offset, size = location
+        with open(shard, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+
+    def close(self):
+        self.db.close()
+
+
+
+class ShardedOutputSink(object):
+    '''
+    Appends outputs to tar shards from a writer thread. Shards are named after the
+    host and process, so that every pipeline process writes its own shards.
+    '''
+
+    # Outputs are flushed to the shard and recorded in the index at least every this
+    # many outputs, and whenever the queue is empty.
+    INDEX_BATCH = 256
+
+    def __init__(self, output_directory, shard_size_mb=1024, queue_size=256):
+        self.output_directory = output_directory
+        self.shard_size = shard_size_mb * 1024 * 1024
+
+        self.index = OutputIndex(output_directory)
+
+        self.shard_prefix = '%s-%d-%d' % (socket.gethostname(), os.getpid(), int(time.time()))
+        self.shard_number = 0
+        self.shard_name = None
+        self.tar = None
+
+        self.queue = queue.Queue(queue_size)
+
+        # Exception raised in the writer thread, raised again in the next write().
+        self.error = None
+
+        self.thread = threading.Thread(target=self._write_outputs)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def write(self, output_filepath, data):
+        '''
+        Queues data to be written as the output that would otherwise be written to
+        output_filepath. Blocks if the writer thread is queue_size outputs behind.
+        '''
+        if self.error is not None:
+            raise self.error
+
+        key = os.path.relpath(output_filepath, self.output_directory)
+        self.queue.put((key, data))
+
+
+    def flush(self):
+        '''
+        Waits till queued outputs are written and recorded in the index.
+        '''
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+
+    def close(self):
+        '''
+        Writes queued outputs and closes the shard being written.
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        self.index.close()
+
+        if self.error is not None:
+            raise self.error
+
+
+    def _write_outputs(self):
+        entries = []
+        # Outputs appended to the shard but not recorded yet, which are marked done
+        # in the queue once they're recorded.
+        unrecorded = 0
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+
+                key, data = item
+                entries.append(self._append(key, data))
+                unrecorded += 1
+
+                if len(entries) >= ShardedOutputSink.INDEX_BATCH or self.queue.empty():
+                    self._flush(entries)
+                    entries = []
+                    for i in range(unrecorded):
+                        self.queue.task_done()
+                    unrecorded = 0
+
+        except Exception as e:
+            print("Output sink failed: %r" % e)
+            self.error = e
+
+            # Queued outputs are dropped, so that flush() doesn't wait for them forever.
+            entries = []
+            for i in range(unrecorded):
+                self.queue.task_done()
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                self.queue.task_done()
+
+        finally:
+            try:
+                self._flush(entries)
+            finally:
+                if self.tar is not None:
+                    self.tar.close()
+
+
+    def _append(self, key, data):
+        if self.tar is None or self.tar.offset >= self.shard_size:
+            self._next_shard()
+
+        info = tarfile.TarInfo(key)
+        info.size = len(data)
+        info.mtime = time.time()
+        self.tar.addfile(info, io.BytesIO(data))
+
+        # Data is followed by padding upto the next 512 byte block.
+        offset = self.tar.offset - ((len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        return key, self.shard_name, offset, len(data)
+
+
+    def _next_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+
+        self.shard_name = '%s-%05d.tar' % (self.shard_prefix, self.shard_number)
+        self.shard_number += 1
+
+        shard_path = os.path.join(self.output_directory, SHARDS_DIRECTORY, self.shard_name)
+        print("Writing outputs to " + shard_path)
+        self.tar = tarfile.open(shard_path, 'w', format=tarfile.PAX_FORMAT)
+
+
+    def _flush(self, entries):
+        if not entries:
+            return
+        # Outputs are recorded only once they're in the shard, so that readers never
+        # find an output in the index that's not in the shard yet.
+        self.tar.fileobj.flush()
+        self.index.add(entries)
+
+
+
+def open_output_sink(output_directory, options):
+    '''
+    Returns the ShardedOutputSink configured by the output_sink option, or None if
+    outputs are written as files.
+    '''
+    sink_cfg = options.get('output_sink')
+    if not sink_cfg:
+        return None
+
+    if not isinstance(sink_cfg, dict):
+        sink_cfg = {}
+
+    return ShardedOutputSink(output_directory, sink_cfg.get('shard_size_mb', 1024), sink_cfg.get('queue_size', 256))
+
+
+
+def read_output(output_directory, output_filepath):
+    '''
+    Returns the data of the output written to output_filepath, either as a file or
+    into a shard, or None if there's no such output.
+    '''
+    if os.path.exists(output_filepath):
+        with open(output_filepath, 'rb') as f:
+            return f.read()
+
+    if not os.path.exists(os.path.join(output_directory, SHARDS_DIRECTORY, INDEX_FILENAME)):
+        return None
+
+    index = OutputIndex(output_directory)
+    try:
+        return index.read(os.path.relpath(output_filepath, output_directory))
+    finally:
+        index.close()
+
+
+
+if __name__ == '__main__':
+    index = OutputIndex(sys.argv[1])
+
+    if sys.argv[2] == 'list':
+        for key in index.keys(sys.argv[3] if len(sys.argv) > 3 else ''):
+            print(key)
+
+    elif sys.argv[2] == 'get':
+        data = index.read(sys.argv[3])
+        if data is None:
+            print("No output " + sys.argv[3], file=sys.stderr)
+            sys.exit(1)
+
+        if len(sys.argv) > 4:
+            with open(sys.argv[4], 'wb') as f:
+                f.write(data)
+        else:
+            sys.stdout.buffer.write(data)
+
+    index.close()
@@ -1,22 +1,49 @@
-from deepdetector import DeepDetector
-from simpledetector import SimpleDetector
-from facerecognizer import FaceRecognizer
-from annotatedphotowriter import AnnotatedPhotoWriter
-from annotatedframewriter import AnnotatedFrameWriter
-from annotatedvideowriter import AnnotatedVideoWriter
-from jsonreportwriter import JSONReportWriter
+from componentregistry import ComponentRegistry
+from videosegments import probe_frame_count, plan_segments
+from framesampling import FrameSampler, open_sampled_frames
+from mediadecoders import PHOTO_EXTENSIONS, sniff_media_type, decoder_names, read_photo, open_video, write_temporary_file
+from frameprefetcher import FramePrefetcher
+from framedata import FrameData, normalize_image
+from componentgraph import ComponentGraph
+from stagerunner import StageRunner
+import sharedframes
+import modelserver
+import workerbudget
+from jobmanifest import open_manifest
+from resultcache import open_result_cache
+from outputsink import open_output_sink
+from inputsources import input_directory_of, input_files, is_archive, archive_jobs, count_members, member_job, iter_archive, ArchiveReader
 
 
-import imageio
-import cv2
-
+import concurrent.futures
+import functools
+import gc
 import multiprocessing
 import os
 import os.path
+import queue
 import yaml
 import sys
+import time
 import traceback
 
+
+def load_pipeline_file(pipeline_file):
+    '''
+    Loads a pipeline YAML file. Returns a (components config, options) tuple
+    where options is the optional top level 'options' mapping of execution
+    settings that apply to the whole pipeline.
+    '''
+    with open(pipeline_file, 'r') as f:
+        cfg = yaml.safe_load(f)
+
+    return cfg['pipeline'], cfg.get('options') or {}
+
+
+def is_photo_job(job):
+    return not job['segment'] and os.path.splitext(job['file'])[1].lower() in PHOTO_EXTENSIONS
+
+
 class MultiPipelineExecutor(object):
     '''
     A multiprocess executor that sets up a pipeline for each CPU
@@ -25,29 +52,80 @@ class MultiPipelineExecutor(object):
     Each pipeline has its own detectors (including darkflow detectors), recognizer and outputter components,
     including  deep object detector neural networks. This may seem inefficient,
     but it appears darkflow stores some state per input file and is therefore not thread safe.
+    
+    Deep detectors with the modelserver param instead share model server processes,
+    started here, that each load the network once and batch the requests of all 
+    pipelines together. See modelserver.py.
+    
+    Components that are read-only and safe to use after a fork, like cascade
+    detectors and recognizers, are created once here before the pipeline processes
+    are forked, so that all pipelines share their models' memory pages copy-on-write
+    instead of each loading the models again. Other components are created in each
+    pipeline process.
+
+    Long videos are split into frame-range segments that are processed by different
+    pipelines, so that a single long video doesn't keep just one core busy.
+    Per-segment outputs are stitched back in frame order once all segments are processed.
+    If a segment failed, the outputs of the video's segments are kept unstitched, so that
+    with a manifest only the failed segments are processed again by the next run.
+    
+    The input is a directory, an archive or a file list. Archives are distributed
+    whole or a member at a time. See inputsources.py.
     '''
-    def execute(self, pipeline_file, input_directory, output_directory):
-        
-        # Create a shared file queue across multiple processes.
-        file_queue = multiprocessing.JoinableQueue()
+    def execute(self, pipeline_file, input_path, output_directory):
+
+        components_cfg, options = load_pipeline_file(pipeline_file)
         
+        # Output paths are relative to it.
+        input_directory = input_directory_of(input_path)
+
         # Start pipelines.
-        num_pipeline_processors = multiprocessing.cpu_count()
+        budget = self.plan_budget(pipeline_file, input_path, options)
+        print('Worker budget: %r' % budget)
+        num_pipeline_processors = budget.workers
+        
+        # Create a shared file queue across multiple processes. It's bounded, so that 
+        # the input directory is enumerated only as fast as the pipelines process it.
+        file_queue = multiprocessing.JoinableQueue(options.get('file_queue_size', 64))
+        
+        # Pipeline processes report the results of segment jobs here.
+        result_queue = multiprocessing.Queue()
+        
+        model_servers, model_server_connections = modelserver.start_model_servers(
+            components_cfg, num_pipeline_processors, multiprocessing.cpu_count())
+        
+        preloaded_components = self.preload_components(components_cfg, options)
+        
         print('Creating %d pipelines' % num_pipeline_processors)
         pipeline_processors = [ 
-            PipelineProcessor(pipeline_file, input_directory, output_directory, file_queue) 
+            PipelineProcessor(pipeline_file, input_directory, output_directory, file_queue,
+                model_server_connections[i], preloaded_components, budget, result_queue) 
             for i in range(num_pipeline_processors) ]
-            
-        # Enqueue files in input directory.
-        for dirpath,dirs,files in os.walk(input_directory):
-            for f in files:
-                file_path = os.path.join(dirpath, f)
-                print("put in queue:", file_path)
-                file_queue.put(file_path)
 
         for w in pipeline_processors:
             w.start()
                 
+        # Videos split into segments, and their segments.
+        segmented_videos = {}
+
+        # Files processed by earlier runs into the same output directory are skipped.
+        manifest = open_manifest(input_directory, output_directory, components_cfg, options)
+        
+        # Enqueue files in input directory while the pipelines process them. 
+        jobs = self.enumerate_jobs(input_path, num_pipeline_processors, options, segmented_videos, manifest)
+        
+        if options.get('scheduling', 'fifo') == 'largest_first':
+            jobs = self.largest_first(jobs, options.get('scheduling_window', 200))
+        else:
+            jobs = ( job for job, cost in jobs )
+            
+        num_segment_jobs = 0
+        for job in jobs:
+            print("put in queue:", job['file'], job['segment'] or '')
+            file_queue.put(job)
+            if job.get('id') is not None:
+                num_segment_jobs += 1
+
         # Add an end command in each queue
         for i in range(num_pipeline_processors):
             file_queue.put(None)
@@ -55,195 +133,1050 @@ class MultiPipelineExecutor(object):
         # Wait for all of the tasks to finish
         file_queue.join()
         
+        modelserver.stop_model_servers(model_servers)
+
+        failed_videos = self.failed_segmented_videos(result_queue, num_segment_jobs)
+
+        # Stitched outputs go into shards too, if the pipelines write their outputs there.
+        output_sink = open_output_sink(output_directory, options) if segmented_videos else None
+        
+        for file_path, segments in segmented_videos.items():
+            if file_path in failed_videos:
+                print("Not stitching segments of %s, since some of them failed" % file_path)
+                continue
+                
+            outputs = self.stitch_segments(components_cfg, file_path, segments, input_directory, output_directory, output_sink)
+            if manifest:
+                manifest.record_stitched(file_path, segments, outputs)
+
+        if output_sink:
+            output_sink.close()
+            
+        if manifest:
+            manifest.close()
+            
         print("Completed")
+
+
+    def plan_budget(self, pipeline_file, input_path, options):
+        '''
+        Returns the WorkerBudget - number of pipeline processes and the threads and memory
+        of each - given by options. With 'workers: auto', the best budget for this machine
+        is found by running the pipeline on a sample of the input files. Archives are 
+        not sampled.
+        '''
+        cpu_count = multiprocessing.cpu_count()
+        
+        if options.get('workers') != 'auto':
+            return workerbudget.plan_budget(options, cpu_count)
+            
+        num_samples = (options.get('calibration') or {}).get('sample_files', 2)
+        sample_files = []
+        for file_path in input_files(input_path):
+            if not is_archive(file_path) and os.path.isfile(file_path):
+                sample_files.append(file_path)
+            if len(sample_files) >= num_samples:
+                break
+                
+        if not sample_files:
+            return workerbudget.plan_budget(options, cpu_count)
+            
+        print("Calibrating worker budget on " + ', '.join(sample_files))
+        return workerbudget.calibrate(pipeline_file, input_directory_of(input_path), sample_files, options, cpu_count)
+        
+        
+    def preload_components(self, components_cfg, options):
+        '''
+        Creates the fork safe components of the pipeline, if pipeline processes are
+        going to be forked. Returns dict of components keyed by name.
+        '''
+        if not options.get('preload_components', True):
+            return {}
+            
+        if multiprocessing.get_start_method() != 'fork':
+            print("Pipeline processes are not forked. Not preloading components.")
+            return {}
             
+        preloaded_components = {}
+        for comp_cfg in components_cfg:
+            comp_type = Pipeline.COMPONENTS.get(comp_cfg['type'])
+            if comp_type and comp_type.is_fork_safe(comp_cfg):
+                print("Preloading " + comp_cfg['name'])
+                preloaded_components[comp_cfg['name']] = comp_type(comp_cfg)
+                
+        if preloaded_components and hasattr(gc, 'freeze'):
+            # Keep the garbage collector in pipeline processes from touching, and so 
+            # copying, the pages of objects created so far.
+            gc.freeze()
+            
+        return preloaded_components
+        
+        
+    def enumerate_jobs(self, input_path, num_pipeline_processors, options, segmented_videos, manifest=None):
+        '''
+        Walks input directory, or reads input file list or archive, and yields (job, cost)
+        of its files as they're found, where cost is the estimated number of images to 
+        process for the job - number of frames of a video or video segment, number of members
+        of an archive read whole, and 1 for a photo or an archive member. Archives are split
+        into jobs by archive_jobs().
+        Videos that are split into segments are added to segmented_videos.
+        Files and segments that the manifest says are done are skipped. Members of
+        archives that are read whole are skipped by the pipeline process instead.
+        '''
+        # Video lengths are needed only to plan segments or to schedule largest first.
+        largest_first = options.get('scheduling', 'fifo') == 'largest_first'
+        probe_videos = options.get('segment_videos', True) or largest_first
+            
+        archives = options.get('archives', 'shard')
+            
+        for file_path in input_files(input_path):
+            if archives and is_archive(file_path) and os.path.isfile(file_path):
+                for job in archive_jobs(file_path, archives):
+                    if job.get('shard'):
+                        # Counting members takes reading the headers of a tar, so it's 
+                        # done only when the count is used.
+                        yield job, count_members(file_path) if largest_first else 1
+                        continue
+                    if manifest and manifest.is_done(job['file']):
+                        print("Already processed:", job['file'])
+                        continue
+                    yield job, 1
+                continue
+                
+            if manifest and manifest.is_done(file_path):
+                print("Already processed:", file_path)
+                continue
+                
+            if not os.path.exists(file_path):
+                # Members of archives can be listed in file lists.
+                job = member_job(file_path)
+                if job:
+                    yield job, 1
+                else:
+                    print("No such file:", file_path)
+                continue
+                
+            nframes = None
+            if probe_videos and sniff_media_type(file_path) == 'video':
+                nframes = probe_frame_count(file_path)
+                
+            segments = self.plan_segments(nframes, num_pipeline_processors, options)
+            if len(segments) > 1:
+                segmented_videos[file_path] = segments
+            else:
+                segments = [None]
+
+            for segment in segments:
+                if segment and manifest and manifest.is_done(file_path, segment):
+                    print("Already processed:", file_path, segment)
+                    continue
+                    
+                job = {
+                    'file' : file_path,
+                    'segment' : segment
+                }
+                
+                if segment:
+                    # So that its result is reported.
+                    job['id'] = (file_path, segment)
+                
+                if segment:
+                    cost = (segment[1] or nframes) - segment[0]
+                else:
+                    cost = nframes or 1
+                    
+                yield job, cost
+
+
+    def largest_first(self, jobs, window):
+        '''
+        Yields jobs, reordered so that jobs with higher cost come first. Jobs are reordered
+        within windows of 'window' jobs at a time, so that enumeration of a large directory
+        still streams. Among jobs with same cost, larger files come first.
+        '''
+        def sort_key(job_and_cost):
+            job, cost = job_and_cost
+            try:
+                size = job.get('size') or os.path.getsize(job['file'])
+            except OSError:
+                size = 0
+            return (cost, size)
+            
+        pending = []
+        for job_and_cost in jobs:
+            pending.append(job_and_cost)
+            if len(pending) >= window:
+                pending.sort(key=sort_key, reverse=True)
+                for job, cost in pending:
+                    yield job
+                pending = []
+                
+        pending.sort(key=sort_key, reverse=True)
+        for job, cost in pending:
+            yield job
+
+
+    def plan_segments(self, nframes, num_pipeline_processors, options):
+        '''
+        Returns list of (start_frame, end_frame) segments of a file with nframes frames.
+        It's a single segment if file is not a video or too short to split.
+        '''
+        if not options.get('segment_videos', True):
+            return [(0, None)]
+
+        return plan_segments(nframes, num_pipeline_processors, options.get('min_segment_frames', 1000))
+
+
+    def failed_segmented_videos(self, result_queue, num_segment_jobs):
+        '''
+        Reads the results of num_segment_jobs segment jobs reported by the pipeline processes.
+        Returns set of the videos that have segments that failed.
+        '''
+        failed_videos = set()
+        while num_segment_jobs:
+            (file_path, segment), status, output_files, error = result_queue.get()
+            if status == 'running':
+                continue
+                
+            num_segment_jobs -= 1
+            if status != 'done':
+                failed_videos.add(file_path)
+                
+        return failed_videos
+        
+        
+    def stitch_segments(self, components_cfg, file_path, segments, input_directory, output_directory, output_sink=None):
+        '''
+        Returns dict of stitched output files keyed by component name.
+        '''
+        print("Stitching %d segments of %s" % (len(segments), file_path))
+        outputs = {}
+        for comp_cfg in components_cfg:
+            comp_type = Pipeline.COMPONENTS.get(comp_cfg['type'])
+            if not comp_type:
+                continue
+
+            try:
+                output = comp_type.stitch_segments(comp_cfg, file_path, segments, input_directory, output_directory, output_sink)
+                if output and output.get('file'):
+                    outputs[comp_cfg['name']] = output['file']
+            except:
+                print("*****************\nException while stitching segments of " + file_path)
+                traceback.print_exc()
+                
+        return outputs
+
     
 class PipelineProcessor(multiprocessing.Process):
     
-    def __init__(self, pipeline_file, input_directory, output_directory, file_queue):
+    def __init__(self, pipeline_file, input_directory, output_directory, file_queue, model_server_connections=None,
+            preloaded_components=None, budget=None, result_queue=None):
         multiprocessing.Process.__init__(self)
 
         self.file_queue = file_queue
         self.pipeline_file = pipeline_file
         self.input_directory = input_directory
         self.output_directory = output_directory
+        self.model_server_connections = model_server_connections or {}
+        self.preloaded_components = preloaded_components or {}
+        self.budget = budget
+        
+        # If given, (job id, status, output files, error) of jobs with an 'id' are put in 
+        # it when they start running and when they finish. See PipelineDaemon.
+        self.result_queue = result_queue
         
     def run(self):
-        self.pipeline = Pipeline(self.pipeline_file, self.input_directory, self.output_directory)
+        # Thread and memory limits apply to models loaded from now on.
+        if self.budget:
+            workerbudget.apply_budget(self.budget)
+        
+        # Deep detectors that use model servers connect to them when created.
+        modelserver.connect(self.model_server_connections)
+        
+        self.pipeline = Pipeline(self.pipeline_file, self.input_directory, self.output_directory,
+            self.preloaded_components)
+        
+        self.manifest = open_manifest(self.input_directory, self.output_directory, 
+            self.pipeline.cfg, self.pipeline.options)
+        
+        self.archive_reader = ArchiveReader()
         
         proc_name = self.name
+        
+        # Jobs taken from the queue while collecting a batch of photos, that 
+        # could not be added to the batch.
+        pending_jobs = []
+        
         while True:
-            next_file = self.file_queue.get()
-            if next_file is None:
+            next_job = pending_jobs.pop(0) if pending_jobs else self.file_queue.get()
+            if next_job is None:
                 # None means shutdown this process.
                 print('%s: Exiting' % proc_name)
+                self.pipeline.close()
+                modelserver.close_clients()
+                if self.manifest:
+                    self.manifest.close()
+                self.archive_reader.close()
                 self.file_queue.task_done()
                 break
                 
-            print('%s: Executing %s' % (proc_name, next_file))
             # Termination of process due to uncaught exception will hold up 
             # the main process because it'll wait on queue forever.
+            if next_job.get('shard'):
+                try:
+                    self.execute_archive(next_job)
+                finally:
+                    self.file_queue.task_done()
+                continue
+                
+            if self.pipeline.batch_size > 1 and is_photo_job(next_job):
+                photo_jobs = self.collect_photo_jobs(next_job, pending_jobs)
+                if len(photo_jobs) > 1:
+                    try:
+                        self.execute_photo_jobs(photo_jobs)
+                    finally:
+                        for job in photo_jobs:
+                            self.file_queue.task_done()
+                    continue
+                
             try:
-                self.pipeline.execute(next_file)
-                print('%s: Executed %s' % (proc_name, next_file))
-            except:
-                print("*****************\nException while executing " + next_file)
-                traceback.print_exc()
+                self.execute_job(next_job)
             finally:
                 self.file_queue.task_done()
 
         return        
+        
+        
+    def execute_job(self, job):
+        '''
+        Executes the pipeline on a file or video segment, and records the result in the
+        manifest and reports it.
+        '''
+        next_file = job['file']
+        segment = job['segment']
+        print('%s: Executing %s %s' % (self.name, next_file, segment or ''))
+        self.report(job, 'running')
+        file_state = None
+        try:
+            file_state = self.manifest.file_state(next_file) if self.manifest else None
+            outputs = self.pipeline.execute(next_file, segment, self.read_job_data(job))
+            print('%s: Executed %s %s' % (self.name, next_file, segment or ''))
+            if self.manifest:
+                self.manifest.record_done(next_file, segment, file_state, outputs)
+            self.report(job, 'done' if outputs is not None else 'ignored', outputs)
+        except:
+            print("*****************\nException while executing " + next_file)
+            traceback.print_exc()
+            if self.manifest and file_state:
+                self.manifest.record_failed(next_file, segment, file_state, traceback.format_exc())
+            self.report(job, 'failed', error=traceback.format_exc())
+            
+            
+    def read_job_data(self, job):
+        '''
+        Returns bytes of job's file if it's a member of an archive, or None if the
+        pipeline should read the file.
+        '''
+        if 'data' in job:
+            return job['data']
+        if job.get('archive'):
+            return self.archive_reader.read(job)
+        return None
+        
+        
+    def execute_archive(self, archive_job):
+        '''
+        Executes the pipeline on the members of an archive, read in the order they're stored,
+        in batches of photos if the pipeline processes batches. Members that the manifest
+        says are done are skipped.
+        '''
+        archive = archive_job['file']
+        print('%s: Executing members of %s' % (self.name, archive))
+        self.report(archive_job, 'running')
+        
+        def is_done(file_path):
+            # Checked before a member is read, so that members done are not read.
+            if self.manifest and self.manifest.is_done(file_path):
+                print("Already processed:", file_path)
+                return True
+            return False
+            
+        photo_jobs = []
+        error = None
+        try:
+            for file_path, data in iter_archive(archive, is_done):
+                job = {
+                    'file' : file_path,
+                    'segment' : None,
+                    'data' : data
+                }
+                data = None
+                
+                if self.pipeline.batch_size > 1 and is_photo_job(job):
+                    photo_jobs.append(job)
+                    if len(photo_jobs) == self.pipeline.batch_size:
+                        self.execute_photo_jobs(photo_jobs)
+                        photo_jobs = []
+                else:
+                    self.execute_job(job)
+                    
+        except:
+            print("*****************\nException while reading archive " + archive)
+            traceback.print_exc()
+            error = traceback.format_exc()
+            
+        if photo_jobs:
+            self.execute_photo_jobs(photo_jobs)
+            
+        self.report(archive_job, 'failed' if error else 'done', error=error)
+        
+        
+    def collect_photo_jobs(self, first_job, pending_jobs):
+        '''
+        Collects upto pipeline's batch size photo jobs from the queue, waiting 
+        no more than batch_timeout seconds for them. Jobs that aren't photos are
+        added to pending_jobs.
+        '''
+        photo_jobs = [first_job]
+        deadline = time.time() + self.pipeline.batch_timeout
+        
+        while len(photo_jobs) < self.pipeline.batch_size:
+            try:
+                job = self.file_queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+                
+            if job is None or not is_photo_job(job):
+                pending_jobs.append(job)
+                break
+                
+            photo_jobs.append(job)
+            
+        return photo_jobs
+        
+        
+    def execute_photo_jobs(self, photo_jobs):
+        input_files = [ job['file'] for job in photo_jobs ]
+        print('%s: Executing batch of %d photos %s' % (self.name, len(input_files), input_files))
+        for job in photo_jobs:
+            self.report(job, 'running')
+        file_states = None
+        try:
+            file_states = [ self.manifest.file_state(f) for f in input_files ] if self.manifest else None
+            data = dict([ (job['file'], self.read_job_data(job)) for job in photo_jobs ])
+            all_outputs = self.pipeline.execute_photos(input_files, data)
+            print('%s: Executed batch of %d photos' % (self.name, len(input_files)))
+            if self.manifest:
+                for input_file, file_state in zip(input_files, file_states):
+                    self.manifest.record_done(input_file, None, file_state, all_outputs.get(input_file))
+            for job in photo_jobs:
+                outputs = all_outputs.get(job['file'])
+                self.report(job, 'done' if outputs is not None else 'ignored', outputs)
+        except:
+            print("*****************\nException while executing batch of photos " + ', '.join(input_files))
+            traceback.print_exc()
+            if self.manifest and file_states:
+                for input_file, file_state in zip(input_files, file_states):
+                    self.manifest.record_failed(input_file, None, file_state, traceback.format_exc())
+            for job in photo_jobs:
+                self.report(job, 'failed', error=traceback.format_exc())
+                
+                
+    def report(self, job, status, outputs=None, error=None):
+        if self.result_queue is None or job.get('id') is None:
+            return
+            
+        output_files = dict([ (name, output['file']) for name, output in (outputs or {}).items()
+            if isinstance(output, dict) and output.get('file') ])
+        
+        # So that outputs of a finished job can be read from shards right away.
+        if status != 'running' and self.pipeline.output_sink:
+            self.pipeline.output_sink.flush()
+            
+        self.result_queue.put((job['id'], status, output_files, error))
     
 
 class Pipeline(object):
     '''
     A Pipeline consists of a series of detectors, recognizers and outputters
     through which a photo or video is passed in a sequence.
+    
+    The inputs of components define a dependency graph between them. On each image,
+    a component is executed once all the components in its inputs have completed, 
+    and components that don't depend on each other are executed concurrently
+    in a pool of component_threads threads (OpenCV and TensorFlow release the GIL).
+    
+    With streaming execution, video frames are instead pipelined through stages
+    of components, each stage in its own thread. See StageRunner.
+    
+    With the sampling option, only sampled frames of videos are run through the 
+    components. See FrameSampler.
+    
+    Components with a 'gate' are executed only on frames that the named MotionGate
+    lets through, and their reports of the last inferred frame are carried forward
+    to other frames.
     '''
     
-    COMPONENTS = {
-        'deepdetector' : DeepDetector,
-        'simpledetector' : SimpleDetector,
-        'photowriter' : AnnotatedPhotoWriter,
-        'framewriter' : AnnotatedFrameWriter,
-        'videowriter' : AnnotatedVideoWriter,
-        'recognizer' : FaceRecognizer,
-        'jsonreportwriter' : JSONReportWriter
-    }
+    # Component modules are imported only when a pipeline uses them. See ComponentRegistry.
+    COMPONENTS = ComponentRegistry({
+        'deepdetector' : 'deepdetector:DeepDetector',
+        'simpledetector' : 'simpledetector:SimpleDetector',
+        'photowriter' : 'annotatedphotowriter:AnnotatedPhotoWriter',
+        'framewriter' : 'annotatedframewriter:AnnotatedFrameWriter',
+        'videowriter' : 'annotatedvideowriter:AnnotatedVideoWriter',
+        'recognizer' : 'facerecognizer:FaceRecognizer',
+        'jsonreportwriter' : 'jsonreportwriter:JSONReportWriter',
+        'columnarreportwriter' : 'columnarreportwriter:ColumnarReportWriter',
+        'detectionindexer' : 'detectionindex:DetectionIndexer',
+        'motiongate' : 'motiongate:MotionGate'
+    })
     
-    def __init__(self, pipeline_file, input_directory, output_directory):
+    def __init__(self, pipeline_file, input_directory, output_directory, preloaded_components=None):
         
-        with open(pipeline_file, 'r') as f:
-            self.cfg = yaml.load(f)
-            
-        self.cfg = self.cfg['pipeline']
+        self.cfg, self.options = load_pipeline_file(pipeline_file)
         self.output_directory = output_directory
         self.input_directory = input_directory
         
-        self.create_components()
+        self.create_components(preloaded_components or {})
+        
+        # Raises an error if dependencies are cyclic.
+        self.graph = ComponentGraph(self.components)
+        
+        # Image planes other than RGB image read by components, which are prepared 
+        # along with decoding of video frames. See framedata.py.
+        self.plane_names = []
+        for comp in self.components:
+            for name in comp.planes():
+                if name != 'img' and name not in self.plane_names:
+                    self.plane_names.append(name)
         
+        self.component_executor = None
+        component_threads = self.options.get('component_threads', 4)
+        if component_threads > 1 and not self.graph.is_chain():
+            self.component_executor = concurrent.futures.ThreadPoolExecutor(component_threads)
+            
+        # If some component, like a batched deep detector, wants batches of images, 
+        # video frames and photos are run through the components in batches. When
+        # waiting for photos or frames to fill a batch, a partial batch is executed
+        # after batch_timeout seconds.
+        self.batch_size = max([comp.batch_size() for comp in self.components] + [1])
+        self.batch_timeout = self.options.get('batch_timeout', 0.1)
+            
+        # In streaming execution, video frames are pipelined through stages of 
+        # components running in their own threads instead of one frame at a time.
+        self.stage_runner = None
+        if self.options.get('execution') == 'streaming':
+            self.stage_runner = StageRunner(self.plan_stages(), self._execute_component_batch,
+                self._release_images, self.options.get('stage_queue_size', 4), self.batch_timeout)
+            
+        # Raises an error if sampling configuration is invalid.
+        self.sampler = FrameSampler(self.options.get('sampling'))
         
-    def create_components(self):
+        # Raises an error if decoders configuration is invalid.
+        self.photo_decoder, self.video_decoder = decoder_names(self.options)
         
+        # If some components want to see frames that are not sampled, all frames
+        # are decoded, and other components' outputs of the last sampled frame are 
+        # held for the frames that are not sampled.
+        self.decode_all_frames = self.sampler.is_sampling() and any(
+            [comp.accepts_held_frames() for comp in self.components])
+            
+        # Outputs of components on the last frame they were executed on, for 
+        # frames on which they're not executed.
+        self.last_outputs = {}
+        
+        # Number of photos and video frames sent through the components, for 
+        # measuring throughput.
+        self.images_read = 0
+        
+        # Reports of detectors and recognizers on images seen before are taken from
+        # the result cache instead of running their models again.
+        self.result_cache = open_result_cache(self.options)
+        
+        # Writers write outputs into shards instead of files if there's an output sink.
+        self.output_sink = open_output_sink(self.output_directory, self.options)
+        for comp in self.components:
+            comp.output_sink = self.output_sink
+        
+        
+    def plan_stages(self):
+        '''
+        Groups components into stages for streaming execution. Components with the same
+        'stage' name in their configuration run in the same stage, and every other
+        component runs in a stage of its own.
+        Returns list of (stage name, list of components) in pipeline order.
+        '''
+        stage_groups = []
+        stage_index_of = {}
+        
+        for comp in self.graph.order:
+            stage_name = comp.cfg.get('stage', comp.name)
+            
+            stage_names = [name for name, components in stage_groups]
+            if stage_name in stage_names:
+                stage_index = stage_names.index(stage_name)
+            else:
+                stage_index = len(stage_groups)
+                stage_groups.append((stage_name, []))
+                
+            for dep in self.graph.dependencies[comp.name]:
+                if stage_index_of[dep] > stage_index:
+                    raise ValueError("Invalid pipeline file. {} in stage {} depends on {} which is in a later stage".format(
+                        comp.name, stage_name, dep))
+                        
+            stage_groups[stage_index][1].append(comp)
+            stage_index_of[comp.name] = stage_index
+            
+        return stage_groups
+        
+        
+    def create_components(self, preloaded_components):
+        '''
+        Creates the components of the pipeline, except those in preloaded_components
+        dict, which were already created in the parent process and are reused as is.
+        '''
         self.components = []
         
         for comp_cfg in self.cfg:
+            if comp_cfg['name'] in preloaded_components:
+                self.components.append(preloaded_components[comp_cfg['name']])
+                continue
+                
             comp_type = Pipeline.COMPONENTS.get(comp_cfg['type'])
             if comp_type:
                 comp = comp_type(comp_cfg)
                 self.components.append(comp)
+            else:
+                print("Warning: ignoring {} of unknown type {}".format(comp_cfg['name'], comp_cfg['type']))
             
             
-    def execute(self, input_file):
+    def execute(self, input_file, segment=None, data=None):
+        '''
+        Executes the pipeline on a photo or video file. If segment is a 
+        (start_frame, end_frame) tuple, only that frame range of the video 
+        is processed. end_frame is exclusive, and None means till end of video.
+        If data is given, it's the bytes of the file, such as a member of an 
+        archive, which are decoded instead of reading the file.
+        
+        Returns dict of outputs of components when the file was completed, keyed by
+        component name - see completed() - or None if the file is not a photo or video.
+        '''
         
         isphoto = False
         isvideo = False
         img = None
         
-        # if input file is a photo, read it. Also create a separate
-        # grayscale image because some of the detectors work on grayscale
+        # File the video is decoded from.
+        video_file = input_file
+        
+        # Whether input file is a photo or video is told from its first bytes, so 
+        # that it's decoded only by the decoder for its type. Only videos are split
+        # into segments. Files of types not recognized are ignored.
+        media_type = 'video' if segment else sniff_media_type(input_file, data)
+        
+        # if input file is a photo, read it. Derived images like grayscale image
+        # are created when first needed, because some of the detectors work on grayscale
         # but annotate on original color image. 
-        # Send the color image, grayscale image, filepath, and isphoto flag
+        # Send the color image, filepath, and isphoto flag
         # through the components of the pipeline.
-        try:
-            img = imageio.imread(input_file)
+        if media_type == 'photo':
+            try:
+                img = read_photo(input_file, self.photo_decoder, data)
+                print("Image read")
+                isphoto = True
+            except:
+                print("Error while attempting to read photo:", sys.exc_info())
                 
-            print("Image read")
-            
-            isphoto = True            
-            
-        except:
-            print("Not a photo. Error while attempting to load:", sys.exc_info())
-            # If input file is a video, open it and setup an iterator over its
-            # frames. Then for each frame, send image, grayscale image, video filename,
-            # frame number and isvideo flag through the components of the pipeline.
-            video = None
+        # If input file is a video, open it and setup an iterator over its
+        # frames. Then for each frame, send image, video filename,
+        # frame number and isvideo flag through the components of the pipeline.
+        elif media_type == 'video':
             try:
-                video = imageio.get_reader(input_file, 'ffmpeg')
+                if data is not None:
+                    video_file = write_temporary_file(input_file, data)
+                    data = None
+                video = open_video(video_file, self.video_decoder)
                 print("Video opened")
                 isvideo = True
             except:
-                print("Not a video. Error while attempting to open:", sys.exc_info())
-                if video:
-                    video.close()
+                print("Error while attempting to open video:", sys.exc_info())
         
         if not isphoto and not isvideo:
             print("Ignoring file: ", input_file)
+            if video_file != input_file:
+                os.remove(video_file)
             return
             
         if isphoto:
-            input_data = {
+            input_data = self._photo_input(input_file, img)
+            img = None
+            
+            try:
+                self._execute_pipeline_on_batch([input_data])
+                
+                return self.completed(input_data)
+            except:
+                self.failed([input_file])
+                raise
+            
+        elif isvideo:
+            
+            self.last_outputs = {}
+            frame_inputs = self._video_frame_inputs(input_file, video, segment, video_file)
+            
+            try:
+                try:
+                    if self.stage_runner:
+                        input_data = self.stage_runner.run(frame_inputs)
+                        self.stage_runner.print_stats()
+                    else:
+                        input_data = None
+                        for batch in self._batches(frame_inputs):
+                            self._execute_pipeline_on_batch(batch)
+                            input_data = batch[-1]
+                finally:
+                    # Stops the frame prefetcher, if frames were not all consumed due to an 
+                    # exception, before the video it's decoding is closed.
+                    frame_inputs.close()
+                    video.close()
+                    if video_file != input_file:
+                        os.remove(video_file)
+                
+                if input_data is None:
+                    # Segments are planned on estimated frame counts, so a segment may
+                    # start beyond end of video.
+                    print("No frames in %s %s" % (input_file, segment or ''))
+                    return {}
+                    
+                # Notify components such as video writers that need to know when
+                # the input stream has completed so they can do their own cleanup.
+                return self.completed(input_data)
+            except:
+                self.failed([input_file], segment)
+                raise
+            
+            
+    def execute_photos(self, input_files, data=None):
+        '''
+        Executes the pipeline on a batch of photo files, so that components that 
+        process batches can process the photos together. data is an optional dict
+        of the bytes of files read into memory, keyed by file.
+        Files that turn out not to be photos are executed one by one.
+        Returns dict of what execute() returns for each file, keyed by file.
+        '''
+        data = data or {}
+        all_outputs = {}
+        photo_inputs = []
+        for input_file in input_files:
+            if sniff_media_type(input_file, data.get(input_file)) != 'photo':
+                all_outputs[input_file] = self.execute(input_file, None, data.get(input_file))
+                continue
+                
+            try:
+                img = read_photo(input_file, self.photo_decoder, data.get(input_file))
+            except:
+                print("Error while attempting to read photo:", sys.exc_info())
+                print("Ignoring file: ", input_file)
+                all_outputs[input_file] = None
+                continue
+                
+            photo_inputs.append(self._photo_input(input_file, img))
+            img = None
+            
+        if not photo_inputs:
+            return all_outputs
+            
+        print("%d images read" % len(photo_inputs))
+        
+        try:
+            self._execute_pipeline_on_batch(photo_inputs)
+            
+            for input_data in photo_inputs:
+                all_outputs[input_data['file']] = self.completed(input_data)
+        except:
+            self.failed([ input_data['file'] for input_data in photo_inputs ])
+            raise
+            
+        return all_outputs
+            
+            
+    def _photo_input(self, input_file, img):
+        input_data = FrameData(normalize_image(img))
+        input_data.update({
+            'file' : input_file,
+            'isphoto' : True,
+            'isvideo' : False
+        })
+        self.images_read += 1
+        return input_data
+        
+        
+    def _batches(self, inputs):
+        '''
+        Generates lists of upto batch_size consecutive input data from inputs.
+        '''
+        batch = []
+        for input_data in inputs:
+            batch.append(input_data)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+                
+        if batch:
+            yield batch
+        
+                
+    def _video_frame_inputs(self, input_file, video, segment, video_file=None):
+        '''
+        Generates the input data sent through the components for each frame of video.
+        video_file is the file the video is decoded from, if it's not input_file.
+        '''
+        for frame_info, planes, release in self._prepared_video_frames(video_file or input_file, video, segment):
+            input_data = FrameData(planes)
+            input_data.update({
                 'file' : input_file,
-                'img' : img,
-                'isphoto' : True,
-                'isvideo' : False
-            }
+                'isphoto' : False,
+                'isvideo' : True,
+                # Source frame number and timestamp even when frames are sampled.
+                'frame' : frame_info['frame'],
+                'timestamp' : frame_info['timestamp'],
+                'sampled' : frame_info['sampled'],
+                'segment' : segment,
+                # Called when frame's images are no longer used, if they're
+                # views into a shared frame pool.
+                'release_images' : release
+            })
             
-            self._execute_pipeline_on_image(input_data)
+            # Only input data should refer to the images, so that releasing them 
+            # there releases them completely.
+            planes = None
             
-            self.completed(input_data)
+            self.images_read += 1
+            yield input_data
             
-        elif isvideo:
             
-            for frame_num, img in enumerate(video):
-
-                input_data = {
-                    'file' : input_file,
-                    'img' : img,
-                    'isphoto' : False,
-                    'isvideo' : True,
-                    'frame' : frame_num
-                }
+    def _prepared_video_frames(self, input_file, video, segment):
+        '''
+        Generates (frame info, planes dict, release function) for sampled frames of video.
+        See framesampling.py for frame info.
+        The planes are the RGB 'img' plane and the planes declared by components, 
+        computed ahead of time along with decoding.
+        Unless disabled with prefetch_frames option set to 0, frames are decoded and 
+        converted in a background thread, upto prefetch_frames ahead of the
+        frame being processed. 
+        
+        With prefetch_mode option set to process, they're instead decoded in a 
+        separate process and passed through shared memory. The images are then
+        views into shared memory, and release function should be called
+        once they're no longer used.
+        '''
+        prefetch_frames = self.options.get('prefetch_frames', 8)
+        
+        if prefetch_frames and self.options.get('prefetch_mode') == 'process':
+            if sharedframes.is_available():
+                frames_factory = functools.partial(open_sampled_frames, input_file, segment,
+                    self.options.get('sampling'), self.decode_all_frames, self.video_decoder)
+                
+                # Frames held in a batch, and by the stages of streaming execution,
+                # also occupy slots.
+                frames_in_flight = self.batch_size - 1
+                if self.stage_runner:
+                    frames_in_flight = (self.stage_runner.queue_size + self.batch_size) * len(self.stage_runner.stage_groups)
+                    
+                prefetcher = sharedframes.SharedFramePrefetcher(frames_factory,
+                    video.get_meta_data()['size'], self.plane_names, prefetch_frames, frames_in_flight)
+                
+                yield from prefetcher
+                return
                 
-                self._execute_pipeline_on_image(input_data)
+            print("Shared memory is not available in this version of python. Prefetching frames in a thread.")
+        
+        frames = self.sampler.frames(input_file, video, segment, self.decode_all_frames)
+        
+        if prefetch_frames:
+            frames = FramePrefetcher(frames, prefetch_frames, self.plane_names)
+        else:
+            # Only the planes needed right away are created. The others are created
+            # when first accessed, in the component's thread.
+            frames = ( (frame_info, normalize_image(img)) for frame_info, img in frames )
             
-            # Notify components such as video writers that need to know when
-            # the input stream has completed so they can do their own cleanup.
-            self.completed(input_data)
+        for frame_info, planes in frames:
+            yield frame_info, planes, None
+        
         
+    def _execute_pipeline_on_batch(self, batch):
+        '''
+        Executes the components on a batch of input data of consecutive video frames, 
+        or of photos. Each component is executed on the whole batch before its 
+        dependents, so that components that process batches get all of them together.
+        '''
+        for input_data in batch:
+            print("Input image:", input_data['img'].shape)
+        
+        def execute_component(comp):
+            return self._execute_component_batch(comp, batch)
+            
+        try:
+            for comp, batch_outputs in self.graph.execute(execute_component, self.component_executor):
+                # At each stage of the pipeline, collect the component's outputs
+                # and add them to the input data so that they're available for 
+                # downstream components.
+                for input_data, comp_outputs in zip(batch, batch_outputs):
+                    input_data[comp.name] = comp_outputs
                 
-    def _execute_pipeline_on_image(self, input_data):
+        finally:
+            for input_data in batch:
+                self._release_images(input_data)
+        
         
-        if input_data['img'].ndim == 3:
-            # It *appears* imageio imread returns RGB or RGBA, not BGR...confirmed using a blue
-            # filled rectangle that imageio is indeed RGB which is opposite of OpenCV's default BGR.
-            # Use RGB consistently everywhere.
-            if input_data['img'].shape[-1] == 4:
-                input_data['gray'] = cv2.cvtColor(input_data['img'], cv2.COLOR_RGBA2GRAY)
-                print("Input image seems to be 4-channel RGBA. Creating 3-channel RGB version")
-                input_data['img'] = cv2.cvtColor(input_data['img'], cv2.COLOR_RGBA2RGB)
+    def _release_images(self, input_data):
+        input_data.release_planes()
+        
+        release = input_data.pop('release_images', None)
+        if release:
+            release()
+            
+            
+    def _execute_component_batch(self, comp, batch):
+        '''
+        Executes comp on a batch of input data, in a single execute_batch() call for
+        all the inputs it should be executed on. Returns list of its outputs for each
+        input data in batch.
+        '''
+        batch_outputs = [None] * len(batch)
+        
+        # Indexes of inputs comp is executed on.
+        executed = []
+        
+        # (index, index of input whose outputs are reused, whether carried forward by a gate) 
+        # for inputs comp is not executed on. Index of None means the outputs of the
+        # last input of an earlier batch.
+        reused = []
+        
+        gate = comp.cfg.get('gate')
+        
+        for i, input_data in enumerate(batch):
+            last_executed = executed[-1] if executed else None
+            
+            if not input_data.get('sampled', True) and not comp.accepts_held_frames():
+                # Frame was decoded only for components that accept held frames. 
+                # Others are not executed, and their outputs of the last sampled frame
+                # are held instead.
+                reused.append((i, last_executed, False))
+                
+            elif gate and not (input_data.get(gate) or {}).get('infer', True) and \
+                (executed or comp.name in self.last_outputs):
+                print("Carrying forward %s on %s frame %d" % (comp.name, input_data['file'], input_data.get('frame', 0)))
+                reused.append((i, last_executed, True))
+                
             else:
-                input_data['gray'] = cv2.cvtColor(input_data['img'], cv2.COLOR_RGB2GRAY)
+                executed.append(i)
+                
+        if executed and self.result_cache and comp.is_cacheable() and comp.cfg.get('cache', True):
+            self._execute_cached_component_batch(comp, batch, executed, batch_outputs)
             
-        elif input_data['img'].ndim == 2:
-            # If input is a grayscale image, it'll have just 2 dimensions, 
-            # but Darkflow code expects 3 dimensions. So always keep 'img' a 3 dimension
-            # image no matter what.
-            print("Input image is grayscale. Creating RGB version")
-            input_data['gray'] = input_data['img'].copy()
-            input_data['img'] = cv2.cvtColor(input_data['img'], cv2.COLOR_GRAY2RGB)
+        elif executed:
+            print("Executing %s on %s frames %s" % (comp.name, batch[executed[0]]['file'], 
+                [batch[i].get('frame', 0) for i in executed]))
+            outputs = comp.execute_batch([batch[i] for i in executed], self.input_directory, self.output_directory)
+            for i, comp_outputs in zip(executed, outputs):
+                batch_outputs[i] = comp_outputs
+                
+        for i, source, carried_forward in reused:
+            if source is None:
+                comp_outputs = self.last_outputs.get(comp.name, {'reports' : []})
+            else:
+                comp_outputs = batch_outputs[source]
+                
+            if carried_forward:
+                comp_outputs = dict(comp_outputs)
+                comp_outputs['carriedforward'] = True
+                
+            batch_outputs[i] = comp_outputs
+        
+        if executed and (self.decode_all_frames or gate):
+            # A component is executed on one batch at a time and in frame order, 
+            # even in streaming execution, so these are always of the last frame.
+            self.last_outputs[comp.name] = batch_outputs[executed[-1]]
             
-        else:
-            raise "Unknown image format " + input_data['img'].shape
+        return batch_outputs
         
-        print("Input image:", input_data['img'].shape)
-        print("Grayscale image:", input_data['gray'].shape)
         
-        for comp in self.components:
-            print("Executing %s on %s frame %d" % (comp.name, input_data['file'], input_data.get('frame', 0)))
-            comp_outputs = comp.execute(input_data, self.input_directory, self.output_directory)
+    def _execute_cached_component_batch(self, comp, batch, executed, batch_outputs):
+        '''
+        Sets outputs of comp on inputs at executed indexes of batch in batch_outputs,
+        from the result cache where possible, executing comp only on the rest.
+        '''
+        keys = self.result_cache.keys(comp, [batch[i] for i in executed])
+        
+        missed = []
+        for i, key, cached_outputs in zip(executed, keys, self.result_cache.get(keys)):
+            if cached_outputs is None:
+                missed.append((i, key))
+            else:
+                batch_outputs[i] = cached_outputs
+                
+        if len(missed) < len(executed):
+            print("Cached %s on %s frames %s" % (comp.name, batch[executed[0]]['file'], 
+                [batch[i].get('frame', 0) for i in executed if batch_outputs[i] is not None]))
+                
+        if not missed:
+            return
             
-            # At each stage of the pipeline, collect the component's outputs
-            # and add them to the input data so that they're available for 
-            # downstream components.
-            input_data[comp.name] = comp_outputs
+        print("Executing %s on %s frames %s" % (comp.name, batch[missed[0][0]]['file'], 
+            [batch[i].get('frame', 0) for i, key in missed]))
+        outputs = comp.execute_batch([batch[i] for i, key in missed], self.input_directory, self.output_directory)
+        for (i, key), comp_outputs in zip(missed, outputs):
+            batch_outputs[i] = comp_outputs
             
+        self.result_cache.put([key for i, key in missed], outputs)
+        
         
-        # Release the image arrays.
-        input_data['img'] = None
-        input_data['gray'] = None
+    def close(self):
+        '''
+        Releases resources held across input files.
+        '''
+        for comp in self.components:
+            try:
+                comp.close()
+            except:
+                print("*****************\nException while closing %s" % comp.name)
+                traceback.print_exc()
+                
+        if self.result_cache:
+            self.result_cache.close()
+            self.result_cache = None
+            
+        if self.output_sink:
+            self.output_sink.close()
+            self.output_sink = None
             
             
     def completed(self, input_data):
+        '''
+        Notifies components that input file has completed. Returns dict of each 
+        component's non-empty outputs, keyed by component name - what it returned from
+        completed() if anything, else its outputs on the last image.
+        '''
+        outputs = {}
+        for comp in self.components:
+            output = comp.completed(input_data, self.input_directory, self.output_directory)
+            if not output:
+                output = input_data.get(comp.name)
+            if output:
+                outputs[comp.name] = output
+        return outputs
+        
+        
+    def failed(self, input_files, segment=None):
+        '''
+        Notifies components that processing of input files, or of a segment of a video,
+        failed before they were completed, so that they discard what they kept for them.
+        '''
         for comp in self.components:
-            comp.completed(input_data, self.input_directory, self.output_directory)
+            for input_file in input_files:
+                try:
+                    comp.failed(input_file, segment)
+                except:
+                    print("*****************\nException while discarding %s of %s" % (comp.name, input_file))
+                    traceback.print_exc()
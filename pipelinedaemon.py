@@ -0,0 +1,372 @@
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+import os.path
+import re
+import signal
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    # Python < 3.7
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+from pipeline import load_pipeline_file, MultiPipelineExecutor, PipelineProcessor
+from jobmanifest import open_manifest
+from jsonreportwriter import read_jsonl_report
+from outputsink import read_output
+from inputsources import is_archive
+import modelserver
+
+
+# Daemon mode keeps pipeline processes running with their models loaded, and accepts
+# files to process over HTTP on localhost, or picks them up as they land in the input
+# directory, so that each file takes only as long as its inference.
+#
+#   python3 visualminer.py serve <input directory> <output directory> <pipeline file>
+#
+# Files must be inside the input directory, and outputs are written to the same relative
+# paths in the output directory as when mining the directory. Videos are not split into
+# segments.
+#
+# HTTP API:
+#
+#   POST /jobs               {"file": "<path>"}  ->  202 {"id": "<job id>", ...}
+#   GET  /jobs/<job id>      -> {"id", "file", "status", "outputs", "error"}
+#                               status is queued, running, done, failed, or ignored for
+#                               files that are not photos or videos.
+#   GET  /jobs/<job id>/report[?component=<name>]
+#                            -> JSON report written by a jsonreportwriter for the file,
+#                               in the layout of a .json report even if it wrote .jsonl
+#
+# Pipeline options:
+#
+#   daemon:
+#     host: 127.0.0.1
+#     port: 8765
+#     watch: false          # also process new files that appear in the input directory
+#     watch_interval: 2     # seconds between scans of the input directory
+#     max_jobs: 10000       # finished jobs remembered for status requests
+
+
+class PipelineDaemon(object):
+    '''
+    Runs pipeline processes like MultiPipelineExecutor, but keeps them running and
+    takes jobs from submit() instead of from walking the input directory once.
+    '''
+
+    def __init__(self, pipeline_file, input_directory, output_directory):
+        self.pipeline_file = pipeline_file
+        self.input_directory = os.path.abspath(input_directory)
+        self.output_directory = output_directory
+
+        self.components_cfg, self.options = load_pipeline_file(pipeline_file)
+        self.daemon_cfg = self.options.get('daemon') or {}
+
+        self.file_queue = multiprocessing.JoinableQueue()
+        self.result_queue = multiprocessing.Queue()
+
+        # Jobs keyed by id, in order of submission.
+        self.jobs = collections.OrderedDict()
+        self.jobs_lock = threading.Lock()
+        self.job_ids = itertools.count(1)
+
+        self.max_jobs = self.daemon_cfg.get('max_jobs', 10000)
+
+        self.pipeline_processors = []
+        self.model_servers = []
+
+
+    def start(self):
+        '''
+        Loads the pipelines and starts processing submitted jobs.
+        '''
+        executor = MultiPipelineExecutor()
+
+        # Pipeline processes and model servers ignore Ctrl-C, and are stopped by stop()
+        # after it, once they finish their current jobs.
+        default_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            self._start_processes(executor)
+        finally:
+            signal.signal(signal.SIGINT, default_sigint_handler)
+
+        results_thread = threading.Thread(target=self._collect_results)
+        results_thread.daemon = True
+        results_thread.start()
+
+
+    def _start_processes(self, executor):
+        budget = executor.plan_budget(self.pipeline_file, self.input_directory, self.options)
+        print('Worker budget: %r' % budget)
+
+        self.model_servers, model_server_connections = modelserver.start_model_servers(
+            self.components_cfg, budget.workers, multiprocessing.cpu_count())
+
+        preloaded_components = executor.preload_components(self.components_cfg, self.options)
+
+        print('Creating %d pipelines' % budget.workers)
+        self.pipeline_processors = [
+            PipelineProcessor(self.pipeline_file, self.input_directory, self.output_directory, self.file_queue,
+                model_server_connections[i], preloaded_components, budget, self.result_queue)
+            for i in range(budget.workers) ]
+
+        for w in self.pipeline_processors:
+            w.start()
+
+
+    def stop(self):
+        for w in self.pipeline_processors:
+            self.file_queue.put(None)
+
+        for w in self.pipeline_processors:
+            w.join()
+
+        modelserver.stop_model_servers(self.model_servers)
+
+
+    def submit(self, file_path):
+        '''
+        Queues file_path for processing and returns its job.
+        Raises ValueError if file_path is not a file inside the input directory.
+        '''
+        file_path = os.path.abspath(file_path)
+
+        if os.path.commonpath([file_path, self.input_directory]) != self.input_directory:
+            raise ValueError("File is not in input directory " + self.input_directory)
+
+        if not os.path.isfile(file_path):
+            raise ValueError("No such file " + file_path)
+
+        job = {
+            'id' : str(next(self.job_ids)),
+            'file' : file_path,
+            'status' : 'queued',
+            'outputs' : {},
+            'error' : None,
+            'submitted' : time.time()
+        }
+
+        with self.jobs_lock:
+            self.jobs[job['id']] = job
+            self._forget_finished_jobs()
+
+        print("put in queue:", file_path)
+        self.file_queue.put({
+            'id' : job['id'],
+            'file' : file_path,
+            'segment' : None,
+            # Archives are read whole by a pipeline, whatever the archives option.
+            'shard' : bool(self.options.get('archives', 'shard')) and is_archive(file_path)
+        })
+
+        return dict(job)
+
+
+    def status(self, job_id):
+        '''
+        Returns copy of job with job_id, or None if there's no such job.
+        '''
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+
+    def report(self, job_id, component=None):
+        '''
+        Returns the JSON report of a finished job, written by the jsonreportwriter called
+        component, or by the first jsonreportwriter if component is None.
+        Returns None if there's no such report.
+        '''
+        job = self.status(job_id)
+        if not job or job['status'] != 'done':
+            return None
+
+        for comp_cfg in self.components_cfg:
+            if comp_cfg['type'] != 'jsonreportwriter' or (component and comp_cfg['name'] != component):
+                continue
+
+            report_file = job['outputs'].get(comp_cfg['name'])
+            if not report_file:
+                continue
+
+            if report_file.endswith('.jsonl'):
+                if os.path.exists(report_file):
+                    return read_jsonl_report(report_file)
+                continue
+
+            # The report may be in a shard of the output sink.
+            data = read_output(self.output_directory, report_file)
+            if data is not None:
+                return json.loads(data.decode('utf-8'))
+
+        return None
+
+
+    def _collect_results(self):
+        while True:
+            job_id, status, output_files, error = self.result_queue.get()
+
+            with self.jobs_lock:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    continue
+
+                job['status'] = status
+                job['outputs'] = output_files
+                job['error'] = error
+                if status != 'running':
+                    job['finished'] = time.time()
+                    print("Job %s %s in %.2fs: %s" % (job_id, status, job['finished'] - job['submitted'], job['file']))
+
+
+    def _forget_finished_jobs(self):
+        if len(self.jobs) <= self.max_jobs:
+            return
+
+        for job_id in [ job_id for job_id, job in self.jobs.items() if 'finished' in job ]:
+            del self.jobs[job_id]
+            if len(self.jobs) <= self.max_jobs:
+                break
+
+
+    def watch(self):
+        '''
+        Submits files that appear in the input directory, polling it every watch_interval
+        seconds. A file is submitted once its size and modification time are the same in
+        two scans, so that files still being copied are not picked up. Files that the
+        manifest says were processed already are skipped. Never returns.
+        '''
+        interval = self.daemon_cfg.get('watch_interval', 2)
+        manifest = open_manifest(self.input_directory, self.output_directory, self.components_cfg, self.options)
+
+        # (size, modification time) of files seen in the last scan that were not submitted yet.
+        pending = {}
+        # (size, modification time) of files submitted or skipped.
+        seen = {}
+
+        while True:
+            for dirpath,dirs,files in os.walk(self.input_directory):
+                for f in files:
+                    file_path = os.path.join(dirpath, f)
+                    try:
+                        st = os.stat(file_path)
+                    except OSError:
+                        continue
+
+                    state = (st.st_size, st.st_mtime)
+                    if seen.get(file_path) == state:
+                        continue
+
+                    if pending.get(file_path) != state:
+                        pending[file_path] = state
+                        continue
+
+                    del pending[file_path]
+                    seen[file_path] = state
+
+                    if manifest and manifest.is_done(file_path):
+                        continue
+
+                    try:
+                        self.submit(file_path)
+                    except ValueError as e:
+                        print("Not submitting {}: {}".format(file_path, e))
+
+            time.sleep(interval)
+
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Handles the HTTP API of the PipelineDaemon set as server.pipeline_daemon.
+    '''
+
+    JOB_PATH = re.compile(r'^/jobs/([^/?]+)(/report)?(?:\?component=([^&]+))?$')
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self._respond(404, {'error' : 'Not found'})
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            job = self.server.pipeline_daemon.submit(request['file'])
+        except (ValueError, KeyError, TypeError) as e:
+            return self._respond(400, {'error' : str(e)})
+
+        self._respond(202, job)
+
+
+    def do_GET(self):
+        match = DaemonRequestHandler.JOB_PATH.match(self.path)
+        if not match:
+            return self._respond(404, {'error' : 'Not found'})
+
+        job_id, is_report, component = match.groups()
+        daemon = self.server.pipeline_daemon
+
+        job = daemon.status(job_id)
+        if job is None:
+            return self._respond(404, {'error' : 'No such job ' + job_id})
+
+        if not is_report:
+            return self._respond(200, job)
+
+        report = daemon.report(job_id, component)
+        if report is None:
+            return self._respond(404, {'error' : 'No report for job %s with status %s' % (job_id, job['status'])})
+
+        self._respond(200, report)
+
+
+    def _respond(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+
+def serve(input_directory, output_directory, pipeline_file):
+    '''
+    Runs a PipelineDaemon and its HTTP API, and watches the input directory if
+    configured, till interrupted.
+    '''
+    daemon = PipelineDaemon(pipeline_file, input_directory, output_directory)
+    daemon.start()
+
+    host = daemon.daemon_cfg.get('host', '127.0.0.1')
+    port = daemon.daemon_cfg.get('port', 8765)
+
+    server = ThreadingHTTPServer((host, port), DaemonRequestHandler)
+    server.daemon_threads = True
+    server.pipeline_daemon = daemon
+
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    print("Listening on http://%s:%d" % (host, port))
+
+    try:
+        if daemon.daemon_cfg.get('watch', False):
+            print("Watching " + daemon.input_directory)
+            daemon.watch()
+        else:
+            while True:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        server.shutdown()
+        daemon.stop()
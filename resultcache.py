@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+
+# A result cache stores the reports of detectors and recognizers on local disk, keyed
+# by the content of the image and the component's configuration, so that the same
+# image - a copy of a photo in another folder, or the same video processed again by a
+# pipeline with different downstream components - is not run through the models again.
+#
+# Pipeline options:
+#
+#   result_cache:
+#     path: ~/.cache/deepvisualminer/results.sqlite
+#     max_size_mb: 1024     # least recently used results are evicted beyond this size
+#
+# A component's results are cached if its class supports it - see BaseComponent.is_cacheable() -
+# unless its config has 'cache: false'.
+
+# Params that change how a component runs, but not its results.
+EXECUTION_PARAMS = ('batch_size', 'modelserver')
+
+
+class ResultCache(object):
+    '''
+    SQLite store of component outputs, with least recently used eviction once it's
+    larger than max_size_mb. Can be shared by processes and used from multiple threads.
+
+    A result's key is a hash of the image's pixels, the component's type, params and
+    inputs, the sizes and modification times of model files in the params, and the
+    reports of the upstream components it reads. So a component's cached results are
+    reused across differently named components with the same configuration, and are not
+    reused if a model file or any upstream result changes.
+    '''
+
+    # Last use times of hits are written in batches of this many.
+    TOUCH_BATCH = 64
+
+    def __init__(self, path, max_size_mb):
+        path = os.path.expanduser(path)
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.max_size = max_size_mb * 1024 * 1024
+
+        # Components are executed concurrently by the pipeline's component threads.
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS results (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        self.db.commit()
+
+        # Estimated size of the cache. Other processes sharing the cache add to it
+        # too, so it's recounted on every eviction.
+        self.size = self._total_size()
+
+        self.pending_touches = []
+
+        # Keys of components' configurations, keyed by component name.
+        self.component_keys = {}
+
+        self.hits = 0
+        self.misses = 0
+
+
+    def keys(self, comp, inputs):
+        '''
+        Returns the cache keys of comp's results on each of inputs.
+        '''
+        comp_key = self.component_keys.get(comp.name)
+        if comp_key is None:
+            comp_key = component_key(comp.cfg)
+            self.component_keys[comp.name] = comp_key
+
+        keys = []
+        for input_data in inputs:
+            sha1 = hashlib.sha1(comp_key.encode('utf-8'))
+            sha1.update(content_hash(input_data).encode('utf-8'))
+            for source in comp.cfg['inputs']:
+                if source != 'files':
+                    upstream_reports = (input_data.get(source) or {}).get('reports')
+                    sha1.update(json.dumps(upstream_reports, sort_keys=True, default=str).encode('utf-8'))
+            keys.append(sha1.hexdigest())
+
+        return keys
+
+
+    def get(self, keys):
+        '''
+        Returns list of cached outputs for each of keys, None for keys that aren't cached.
+        '''
+        with self.lock:
+            results = []
+            for key in keys:
+                row = self.db.execute('SELECT value FROM results WHERE key=?', (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    results.append(None)
+                else:
+                    self.hits += 1
+                    self.pending_touches.append((time.time(), key))
+                    results.append(json.loads(row[0]))
+
+            if len(self.pending_touches) >= ResultCache.TOUCH_BATCH:
+                self._flush_touches()
+                self.db.commit()
+
+            return results
+
+
+    def put(self, keys, outputs):
+        '''
+        Stores the reports in each of outputs under the corresponding key.
+        '''
+        with self.lock:
+            now = time.time()
+            for key, comp_outputs in zip(keys, outputs):
+                value = json.dumps({'reports' : comp_outputs.get('reports', [])}, default=str)
+                self.db.execute('INSERT OR REPLACE INTO results VALUES (?,?,?,?)', (key, value, len(value), now))
+                self.size += len(value)
+
+            self._flush_touches()
+
+            if self.size > self.max_size:
+                self._evict()
+
+            self.db.commit()
+
+
+    def _flush_touches(self):
+        if self.pending_touches:
+            self.db.executemany('UPDATE results SET last_used=? WHERE key=?', self.pending_touches)
+            self.pending_touches = []
+
+
+    def _evict(self):
+        # Evict down to 90% of max size, so that eviction doesn't run on every put.
+        self.size = self._total_size()
+        target = self.max_size * 0.9
+
+        while self.size > target:
+            rows = self.db.execute('SELECT key, size FROM results ORDER BY last_used LIMIT 1000').fetchall()
+            if not rows:
+                break
+
+            evicted = []
+            for key, size in rows:
+                if self.size <= target:
+                    break
+                evicted.append((key,))
+                self.size -= size
+
+            self.db.executemany('DELETE FROM results WHERE key=?', evicted)
+
+        print("Result cache: evicted down to %d MB" % (self.size // (1024 * 1024)))
+
+
+    def _total_size(self):
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+
+
+    def close(self):
+        with self.lock:
+            self._flush_touches()
+            self.db.commit()
+            self.db.close()
+        print("Result cache: %d hits, %d misses" % (self.hits, self.misses))
+
+
+
+def open_result_cache(options):
+    '''
+    Returns the ResultCache configured by the result_cache option, or None if there isn't one.
+    '''
+    cache_cfg = options.get('result_cache')
+    if not cache_cfg:
+        return None
+
+    if not isinstance(cache_cfg, dict):
+        cache_cfg = {}
+
+    return ResultCache(cache_cfg.get('path', '~/.cache/deepvisualminer/results.sqlite'),
+        cache_cfg.get('max_size_mb', 1024))
+
+
+
+def content_hash(input_data):
+    '''
+    Returns hash of the pixels of input data's image, computing it only once per image.
+    '''
+    img_hash = input_data.get('contenthash')
+    if img_hash is None:
+        img = input_data['img']
+        sha1 = hashlib.sha1(str((img.shape, img.dtype.str)).encode('utf-8'))
+        sha1.update(img.data if img.flags['C_CONTIGUOUS'] else img.tobytes())
+        img_hash = sha1.hexdigest()
+        input_data['contenthash'] = img_hash
+    return img_hash
+
+
+
+def component_key(cfg):
+    '''
+    Returns hash of what determines a component's results: its type, params and inputs,
+    and the model files its params refer to.
+    '''
+    params = dict([ (k, v) for k, v in (cfg.get('params') or {}).items() if k not in EXECUTION_PARAMS ])
+
+    key_cfg = {
+        'type' : cfg['type'],
+        'params' : params,
+        'inputs' : cfg.get('inputs'),
+        'files' : files_state(params)
+    }
+    return hashlib.sha1(json.dumps(key_cfg, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+
+def files_state(params):
+    '''
+    Returns sorted list of (path, size, modification time) of files, and files in directories,
+    named by string values in params.
+    '''
+    state = []
+    for value in params.values():
+        if not isinstance(value, str):
+            continue
+
+        if os.path.isfile(value):
+            st = os.stat(value)
+            state.append((value, st.st_size, st.st_mtime))
+
+        elif os.path.isdir(value):
+            for dirpath, dirs, files in os.walk(value):
+                for f in files:
+                    st = os.stat(os.path.join(dirpath, f))
+                    state.append((os.path.join(dirpath, f), st.st_size, st.st_mtime))
+
+    return sorted(state)
@@ -0,0 +1,338 @@
+import numpy as np
+
+import collections
+import functools
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+from framedata import prepare_planes, SCALED_PLANE_RE
+
+
+# A FrameHandle is what's passed between processes instead of the pixels of a frame.
+# It locates the planes of a frame - for example the RGB and grayscale images - in a
+# slot of a SharedFramePool.
+# planes is a tuple of (byte offset in slot, shape, dtype string) for each plane.
+FrameHandle = collections.namedtuple('FrameHandle', ['pool_name', 'slot', 'planes'])
+
+
+def is_available():
+    return shared_memory is not None
+
+
+
+# Shared memory blocks attached in this process, keyed by name, so that
+# views of frames from another process's pool don't attach again for every frame.
+_attached = {}
+
+def attach_views(handle):
+    '''
+    Returns numpy arrays that are views of the frame planes located by handle,
+    in any process. No pixels are copied.
+    The arrays are valid only till the owner of the handle releases it.
+    '''
+    shm = _attached.get(handle.pool_name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=handle.pool_name)
+        _attached[handle.pool_name] = shm
+
+    return _views(shm, handle)
+
+
+
+def detach(pool_name):
+    '''
+    Detaches the shared memory of another process's pool attached by attach_views(),
+    once no views of its frames are used any more.
+    '''
+    shm = _attached.pop(pool_name, None)
+    if shm is None:
+        return
+
+    try:
+        shm.close()
+    except BufferError:
+        # Some views are still referenced. The memory is unmapped once they're
+        # garbage collected.
+        print("Warning: shared frame pool %s detached while frames are still in use" % pool_name)
+
+
+
+def _views(shm, handle):
+    views = []
+    for offset, shape, dtype in handle.planes:
+        views.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset))
+    return views
+
+
+
+class SharedFramePool(object):
+    '''
+    A pool of fixed size slots in one shared memory block, for passing frames
+    between processes without pickling their pixels.
+
+    A producer copies a frame's planes into a free slot with put(), and passes
+    the small FrameHandle it returns to other processes. They get numpy views
+    of the planes with attach_views(). Each slot has a reference count. put()
+    sets it to 1, holders can retain() a handle to keep the slot alive longer,
+    and every holder calls release() once done. A slot whose count drops to 0 is
+    reused for another frame. put() blocks when all slots are in use, which
+    provides back-pressure to the producer.
+
+    Create the pool in the parent process before starting the processes
+    that use it.
+    '''
+
+    def __init__(self, num_slots, slot_bytes):
+        self.num_slots = num_slots
+        self.slot_bytes = slot_bytes
+
+        self.shm = shared_memory.SharedMemory(create=True, size=num_slots * slot_bytes)
+        self.name = self.shm.name
+        self.owner = True
+
+        self.refcounts = multiprocessing.Array('i', num_slots)
+        self.free_slots = multiprocessing.Semaphore(num_slots)
+
+
+    def __getstate__(self):
+        # Only the name of the shared memory block is pickled when the pool is passed
+        # to a spawned process. The process attaches to the existing block.
+        state = self.__dict__.copy()
+        del state['shm']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=self.name)
+        self.owner = False
+
+
+    def put(self, *planes):
+        '''
+        Copies the given arrays into a free slot and returns its FrameHandle.
+        '''
+        layout = []
+        offset = 0
+        for p in planes:
+            layout.append((offset, p.shape, p.dtype.str))
+            # Keep planes 8 byte aligned.
+            offset += (p.nbytes + 7) // 8 * 8
+
+        if offset > self.slot_bytes:
+            raise ValueError("Frame of %d bytes doesn't fit in shared frame pool slot of %d bytes" % (
+                offset, self.slot_bytes))
+
+        self.free_slots.acquire()
+        with self.refcounts.get_lock():
+            slot = self.refcounts[:].index(0)
+            self.refcounts[slot] = 1
+
+        slot_offset = slot * self.slot_bytes
+        handle = FrameHandle(self.name, slot,
+            tuple([ (slot_offset + o, shape, dtype) for o, shape, dtype in layout ]))
+
+        for view, p in zip(_views(self.shm, handle), planes):
+            view[...] = p
+
+        return handle
+
+
+    def views(self, handle):
+        return _views(self.shm, handle)
+
+
+    def retain(self, handle):
+        with self.refcounts.get_lock():
+            self.refcounts[handle.slot] += 1
+
+
+    def release(self, handle):
+        with self.refcounts.get_lock():
+            self.refcounts[handle.slot] -= 1
+            freed = self.refcounts[handle.slot] == 0
+
+        if freed:
+            self.free_slots.release()
+
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:
+            # Some views of frames are still referenced. The memory is
+            # freed once they're garbage collected.
+            print("Warning: shared frame pool closed while frames are still in use")
+        if self.owner:
+            self.shm.unlink()
+
+
+
+class FrameDecoderProcess(multiprocessing.Process):
+    '''
+    Decodes and color converts video frames in a separate process and puts
+    the planes in plane_names along with the RGB 'img' plane in a SharedFramePool.
+    (frame info, plane names, FrameHandle) of each frame is sent over a queue,
+    and None at the end, or when stop_event is set.
+    If there's an error, an error message string is sent instead of None.
+
+    frames_factory is a picklable callable that opens the video in the decoder
+    process and returns a generator of (frame info, image). See framesampling.py.
+    '''
+    def __init__(self, frames_factory, plane_names, pool, handle_queue, stop_event):
+        multiprocessing.Process.__init__(self)
+        self.daemon = True
+
+        self.frames_factory = frames_factory
+        self.plane_names = plane_names
+        self.pool = pool
+        self.handle_queue = handle_queue
+        self.stop_event = stop_event
+
+
+    def run(self):
+        try:
+            for frame_info, img in self.frames_factory():
+                if self.stop_event.is_set():
+                    break
+                planes = prepare_planes(img, self.plane_names)
+                names = list(planes.keys())
+                handle = self.pool.put(*[planes[n] for n in names])
+                self.handle_queue.put((frame_info, names, handle))
+
+            self.handle_queue.put(None)
+
+        except:
+            self.handle_queue.put(traceback.format_exc())
+
+        finally:
+            self.pool.shm.close()
+
+
+
+class SharedFramePrefetcher(object):
+    '''
+    Like FramePrefetcher, but decodes in a FrameDecoderProcess instead of a
+    thread, so decoding doesn't compete for the GIL with the components.
+
+    Iterating over it generates (frame info, planes dict, release) where the
+    planes are views into the shared frame pool, and release is a function
+    that must be called once the frame's planes are no longer used.
+    '''
+
+    # Seconds stop() waits for the decoder to stop before terminating it.
+    STOP_TIMEOUT = 5
+
+    def __init__(self, frames_factory, frame_size, plane_names, queue_size, frames_in_flight=0):
+        width, height = frame_size
+
+        # Each slot holds the RGB plane, a grayscale plane that comes for free
+        # with grayscale videos, and the named planes.
+        slot_bytes = width * height * 4 + 16
+        for name in plane_names:
+            m = SCALED_PLANE_RE.match(name)
+            if m:
+                slot_bytes += int(m.group(2)) * int(m.group(3)) * (3 if m.group(1) == 'img' else 1) + 8
+            elif name != 'gray':
+                slot_bytes += width * height + 8
+
+        # Decoder can fill queue_size slots ahead while the pipeline holds the
+        # current frame and any frames in flight.
+        self.pool = SharedFramePool(queue_size + 1 + frames_in_flight, slot_bytes)
+        self.handle_queue = multiprocessing.Queue(queue_size + 1 + frames_in_flight)
+        self.stop_event = multiprocessing.Event()
+        self.decoder = FrameDecoderProcess(frames_factory, plane_names, self.pool, self.handle_queue,
+            self.stop_event)
+
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.closed = False
+
+        # Slots of frames yielded to the pipeline, that it may still be using.
+        self.yielded_slots = set()
+
+
+    def __iter__(self):
+        self.decoder.start()
+        planes = None
+        try:
+            while True:
+                item = self.handle_queue.get()
+                if item is None:
+                    break
+
+                if isinstance(item, str):
+                    raise RuntimeError("Error while decoding frames:\n" + item)
+
+                frame_info, names, handle = item
+                planes = dict(zip(names, self.pool.views(handle)))
+                with self.lock:
+                    self.yielded_slots.add(handle.slot)
+
+                yield frame_info, planes, functools.partial(self._release, handle)
+
+        finally:
+            # Drop the views so that shared memory can be closed.
+            planes = None
+            self.stop()
+
+
+    def stop(self):
+        # The decoder is asked to stop rather than terminated, since terminating it while
+        # it holds the lock of the pool's refcounts would leave the lock held for good.
+        self.stop_event.set()
+        deadline = time.time() + SharedFramePrefetcher.STOP_TIMEOUT
+        while self.decoder.is_alive() and time.time() < deadline:
+            # Frees the slots of queued frames, in case the decoder is waiting for one.
+            try:
+                item = self.handle_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if isinstance(item, tuple):
+                self.pool.release(item[2])
+
+        if self.decoder.is_alive():
+            print("Warning: frame decoder did not stop. Terminating it")
+            self.decoder.terminate()
+        self.decoder.join()
+
+        with self.lock:
+            # Frames the decoder queued, or was putting in the pool when it was terminated,
+            # that were never yielded, are never released by the pipeline.
+            refcounts = self.pool.refcounts.get_obj()[:]
+            for slot in range(self.pool.num_slots):
+                if slot not in self.yielded_slots:
+                    refcounts[slot] = 0
+
+            # Only this process uses the refcounts now. They're copied without taking their
+            # lock, which a terminated decoder may have held, into ones with a new lock.
+            self.pool.refcounts = multiprocessing.Array('i', refcounts)
+
+            self.stopped = True
+            self._close_if_unused()
+
+
+    def _release(self, handle):
+        # Frames may still be in use by the pipeline after decoding has stopped,
+        # so the pool is closed only when the last of them is released. Closing
+        # earlier would unmap memory under numpy views of those frames.
+        with self.lock:
+            self.pool.release(handle)
+            if not self.pool.refcounts[handle.slot]:
+                self.yielded_slots.discard(handle.slot)
+            self._close_if_unused()
+
+
+    def _close_if_unused(self):
+        if self.stopped and not self.closed and not any(self.pool.refcounts[:]):
+            self.pool.close()
+            self.closed = True
@@ -17,6 +17,24 @@ class SimpleDetector(BaseComponent):
         self.min_neighbors = params.get('min_neighbors', 3)
         self.output_label = params['outputlabel']
         
+        # Detect on histogram equalized grayscale image, which improves contrast of
+        # too dark or too bright images.
+        self.gray_plane = 'gray_equalized' if params.get('equalizehist', False) else 'gray'
+        
+        
+    @classmethod
+    def is_fork_safe(cls, cfg):
+        # The cascade is only read during detection.
+        return True
+        
+        
+    def is_cacheable(self):
+        return True
+        
+        
+    def planes(self):
+        return [self.gray_plane]
+        
         
     def execute(self, input_data, input_directory, output_directory):
         
@@ -51,7 +69,7 @@ class SimpleDetector(BaseComponent):
         
     def detect_in_image(self, input_data):
 
-        gray_img = input_data['gray']
+        gray_img = input_data[self.gray_plane]
         
 
         min_size = (min(50, gray_img.shape[0] // 10), min(50, gray_img.shape[1] // 10))
@@ -74,7 +92,7 @@ class SimpleDetector(BaseComponent):
             
         
     def detect_in_rois(self, input_data, comp_reports):
-        gray_img = input_data['gray']
+        gray_img = input_data[self.gray_plane]
 
         min_size = (min(50, gray_img.shape[0] // 10), min(50, gray_img.shape[1] // 10))
         
@@ -0,0 +1,207 @@
+import queue
+import sys
+import threading
+import time
+
+
+class Stage(threading.Thread):
+    '''
+    A stage is a group of pipeline components that runs in its own thread. It takes
+    frames' input data from its input queue, executes its components on them one
+    by one, and passes them on to the next stage's queue.
+
+    Frames pass through every stage in the order they were decoded, so stateful
+    components like JSONReportWriter and AnnotatedVideoWriter see frames in order.
+
+    If a component of the stage wants batches of frames, the stage takes upto that
+    many frames from its queue at a time, executing a partial batch if no more
+    frames arrive within batch_timeout seconds.
+    '''
+
+    # Marks end of frames in a queue.
+    END = object()
+
+    def __init__(self, name, components, execute_component_batch, release_images, input_queue, output_queue,
+            batch_timeout):
+        threading.Thread.__init__(self, name='stage-' + name)
+        self.daemon = True
+
+        self.stage_name = name
+        self.components = components
+        self.execute_component_batch = execute_component_batch
+        self.release_images = release_images
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+
+        self.batch_size = max([comp.batch_size() for comp in components])
+        self.batch_timeout = batch_timeout
+
+        self.error = None
+        self.last_input_data = None
+
+        # Statistics to find out which stage is the bottleneck. A stage whose
+        # input queue is usually full is slower than the stages before it.
+        self.frames = 0
+        self.queue_occupancy_total = 0
+        self.queue_occupancy_max = 0
+        self.busy_seconds = 0.0
+
+
+    def run(self):
+        while True:
+            batch, end = self._next_batch()
+
+            if batch:
+                self._execute(batch)
+
+            if end:
+                break
+
+        if self.output_queue is not None:
+            self.output_queue.put(Stage.END)
+
+
+    def _next_batch(self):
+        '''
+        Takes upto batch_size frames' input data from input queue, waiting for more
+        frames to fill the batch no more than batch_timeout seconds after the first.
+        Returns (list of input data, whether end of frames was reached).
+        '''
+        batch = []
+        deadline = None
+
+        while len(batch) < self.batch_size:
+            occupancy = self.input_queue.qsize()
+            try:
+                if deadline is None:
+                    input_data = self.input_queue.get()
+                    deadline = time.time() + self.batch_timeout
+                else:
+                    input_data = self.input_queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+
+            if input_data is Stage.END:
+                return batch, True
+
+            self.frames += 1
+            self.queue_occupancy_total += occupancy
+            self.queue_occupancy_max = max(self.queue_occupancy_max, occupancy)
+
+            batch.append(input_data)
+
+        return batch, False
+
+
+    def _execute(self, batch):
+        if self.error:
+            # Keep draining input queue after an error so that earlier stages
+            # don't block forever on a full queue.
+            for input_data in batch:
+                self.release_images(input_data)
+            return
+
+        start = time.time()
+        try:
+            for comp in self.components:
+                for input_data, comp_outputs in zip(batch, self.execute_component_batch(comp, batch)):
+                    input_data[comp.name] = comp_outputs
+        except:
+            self.error = sys.exc_info()
+            for input_data in batch:
+                self.release_images(input_data)
+            return
+        finally:
+            self.busy_seconds += time.time() - start
+
+        for input_data in batch:
+            if self.output_queue is not None:
+                self.output_queue.put(input_data)
+            else:
+                # Last stage. Release the image arrays, but keep input data for
+                # completed notification.
+                self.release_images(input_data)
+                self.last_input_data = input_data
+
+
+    def stats(self):
+        return {
+            'stage' : self.stage_name,
+            'components' : [comp.name for comp in self.components],
+            'frames' : self.frames,
+            'queue_size' : self.input_queue.maxsize,
+            'mean_queue_occupancy' : float(self.queue_occupancy_total) / self.frames if self.frames else 0.0,
+            'max_queue_occupancy' : self.queue_occupancy_max,
+            'busy_seconds' : self.busy_seconds
+        }
+
+
+
+class StageRunner(object):
+    '''
+    Runs the frames of a video through a series of stages connected by bounded
+    queues, so that different stages work on different frames at the same time.
+    For example, frame N+1 is in the deep detector while frame N is in the cascade
+    detector and frame N-1 is being encoded by the video writer.
+
+    stage_groups is a list of (stage name, list of components) in pipeline
+    order, where no component depends on a component of a later stage.
+    '''
+
+    def __init__(self, stage_groups, execute_component_batch, release_images, queue_size, batch_timeout):
+        self.stage_groups = stage_groups
+        self.execute_component_batch = execute_component_batch
+        self.release_images = release_images
+        self.queue_size = queue_size
+        self.batch_timeout = batch_timeout
+        self.stages = []
+
+
+    def run(self, frame_inputs):
+        '''
+        Runs every input data generated by frame_inputs through all the stages.
+        Returns the input data of last frame, or None if there were no frames.
+        '''
+        queues = [ queue.Queue(maxsize=self.queue_size) for g in self.stage_groups ]
+
+        self.stages = []
+        for i, (name, components) in enumerate(self.stage_groups):
+            output_queue = queues[i+1] if i + 1 < len(queues) else None
+            self.stages.append(Stage(name, components, self.execute_component_batch, self.release_images,
+                queues[i], output_queue, self.batch_timeout))
+
+        for stage in self.stages:
+            stage.start()
+
+        try:
+            for input_data in frame_inputs:
+                # Blocks when first stage is busy and its queue is full.
+                queues[0].put(input_data)
+
+                if any([stage.error for stage in self.stages]):
+                    break
+
+        finally:
+            queues[0].put(Stage.END)
+            for stage in self.stages:
+                stage.join()
+
+        for stage in self.stages:
+            if stage.error:
+                raise stage.error[1].with_traceback(stage.error[2])
+
+        return self.stages[-1].last_input_data
+
+
+    def stats(self):
+        '''
+        Returns queue occupancy and busy time of each stage during the last run.
+        '''
+        return [ stage.stats() for stage in self.stages ]
+
+
+    def print_stats(self):
+        for s in self.stats():
+            print("Stage %s %s: %d frames, queue occupancy mean %.1f max %d of %d, busy %.1fs" % (
+                s['stage'], s['components'], s['frames'], s['mean_queue_occupancy'],
+                s['max_queue_occupancy'], s['queue_size'], s['busy_seconds']))
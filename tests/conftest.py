@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules are at the top of the repository, and are imported by name like
+# visualminer.py imports them.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
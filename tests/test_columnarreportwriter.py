@@ -0,0 +1,104 @@
+import json
+import os
+
+import numpy as np
+
+from columnarreportwriter import ColumnarReportWriter, ColumnarReport, convert_json_report
+from jsonreportwriter import JSONReportWriter
+from videosegments import segment_suffix
+
+
+def video_frames(input_file, frame_numbers, segment=None):
+    '''
+    Yields input data of video frames with detections of components 'det' and 'rec'.
+    '''
+    for frame_num in frame_numbers:
+        det_reports = [ {'rect' : [frame_num, 10, 20, 30], 'labels' : [{'label' : 'cat', 'confidence' : 0.5}]} ]
+        if frame_num % 2:
+            det_reports.append({'rect' : [1, 2, 3, 4], 'labels' : [{'label' : 'dog', 'confidence' : 0.75},
+                {'label' : 'cat', 'confidence' : 0.25}]})
+        rec_reports = [ {'rect' : [5, 6, 7, 8], 'labels' : []} ] if frame_num == 2 else []
+        yield {
+            'file' : input_file,
+            'segment' : segment,
+            'isphoto' : False,
+            'isvideo' : True,
+            'frame' : frame_num,
+            'timestamp' : frame_num / 25.0,
+            'det' : {'reports' : det_reports, 'carriedforward' : frame_num == 3},
+            'rec' : {'reports' : rec_reports}
+        }
+
+
+def write_report(writer_type, params, input_file, frame_numbers, input_directory, output_directory, segment=None):
+    writer = writer_type({'name' : 'report', 'inputs' : ['det', 'rec'], 'params' : params})
+    input_data = None
+    for input_data in video_frames(input_file, frame_numbers, segment):
+        writer.execute(input_data, input_directory, output_directory)
+    return writer.completed(input_data, input_directory, output_directory)['file']
+
+
+def json_report(tmp_path, frame_numbers):
+    json_filepath = write_report(JSONReportWriter, {}, str(tmp_path / 'v.mp4'), frame_numbers,
+        str(tmp_path), str(tmp_path / 'json'))
+    with open(json_filepath, 'r') as f:
+        return json.load(f)
+
+
+def test_columnar_report_has_the_frames_of_json_report(tmp_path):
+    for compress in (False, True):
+        npz_filepath = write_report(ColumnarReportWriter, {'compress' : compress}, str(tmp_path / 'v.mp4'),
+            range(5), str(tmp_path), str(tmp_path / ('npz%d' % compress)))
+        assert npz_filepath.endswith('.npz')
+
+        for mmap in (True, False):
+            report = ColumnarReport(npz_filepath, mmap)
+            assert report.to_report() == json_report(tmp_path, range(5))
+
+
+def test_select_filters_detections(tmp_path):
+    npz_filepath = write_report(ColumnarReportWriter, {}, str(tmp_path / 'v.mp4'), range(5),
+        str(tmp_path), str(tmp_path / 'npz'))
+    report = ColumnarReport(npz_filepath)
+
+    mask = report.select(label='cat', component='det', min_confidence=0.3)
+    assert list(report.frame[mask]) == [0, 1, 2, 3, 4]
+
+    mask = report.select(label=['dog', 'cat'], first_frame=2, last_frame=3)
+    assert list(report.frame[mask]) == [2, 3, 3, 3]
+
+    assert not report.select(label='horse').any()
+
+
+def test_segment_reports_are_stitched_in_frame_order(tmp_path):
+    input_directory = str(tmp_path)
+    output_directory = str(tmp_path / 'npz')
+    input_file = os.path.join(input_directory, 'v.mp4')
+
+    segments = [(0, 2), (2, 4), (4, None)]
+    for segment, frame_numbers in reversed(list(zip(segments, [range(0, 2), range(2, 4), range(4, 5)]))):
+        write_report(ColumnarReportWriter, {}, input_file, frame_numbers, input_directory, output_directory, segment)
+    assert os.path.exists(os.path.join(output_directory, 'v' + segment_suffix(segments[1]) + '.npz'))
+
+    cfg = {'name' : 'report', 'type' : 'columnarreportwriter', 'inputs' : ['det', 'rec']}
+    output = ColumnarReportWriter.stitch_segments(cfg, input_file, segments, input_directory, output_directory)
+
+    report = ColumnarReport(output['file'])
+    assert report.to_report() == json_report(tmp_path, range(5))
+    assert os.listdir(output_directory) == ['v.npz']
+
+
+def test_converted_json_report_has_the_same_arrays(tmp_path):
+    npz_filepath = write_report(ColumnarReportWriter, {}, str(tmp_path / 'v.mp4'), range(5),
+        str(tmp_path), str(tmp_path / 'npz'))
+    json_filepath = write_report(JSONReportWriter, {'format' : 'jsonl'}, str(tmp_path / 'v.mp4'), range(5),
+        str(tmp_path), str(tmp_path / 'json'))
+
+    converted_filepath = str(tmp_path / 'converted.npz')
+    convert_json_report(json_filepath, converted_filepath)
+
+    report = ColumnarReport(npz_filepath)
+    converted = ColumnarReport(converted_filepath)
+    assert converted.meta() == report.meta()
+    for name, arr in report.arrays().items():
+        np.testing.assert_array_equal(getattr(converted, name), arr)
@@ -0,0 +1,95 @@
+import json
+import os
+
+from detectionindex import DetectionIndex, DetectionIndexer, index_reports, query
+
+
+def frame_report(frame_num, label, confidence=0.5):
+    return {
+        'frame' : frame_num,
+        'timestamp' : frame_num / 25.0,
+        'det' : [ {'rect' : [0, 0, 10, 10], 'labels' : [{'label' : label, 'confidence' : confidence}]} ]
+    }
+
+
+def index_video(index, file_path, frames, segment=None):
+    file_id = index.replace_file(file_path, 'video', segment)
+    for frame_num, label in frames:
+        index.add_frame(file_id, frame_report(frame_num, label))
+
+
+def test_reindexed_file_replaces_its_detections(tmp_path):
+    index_path = str(tmp_path / 'detections.sqlite')
+
+    index = DetectionIndex(index_path)
+    index_video(index, 'v.mp4', [ (f, 'cat') for f in range(4) ])
+    index_video(index, 'w.mp4', [(0, 'cat')])
+    index.close()
+
+    index = DetectionIndex(index_path)
+    index_video(index, 'v.mp4', [(1, 'dog'), (2, 'dog')])
+    index.close()
+
+    assert query(index_path, ['cat']) == [('w.mp4', 0, 0.0)]
+    assert query(index_path, ['dog'], files_only=True) == [('v.mp4',)]
+
+
+def test_file_replaced_again_before_flush(tmp_path):
+    index_path = str(tmp_path / 'detections.sqlite')
+
+    index = DetectionIndex(index_path)
+    index_video(index, 'v.mp4', [(0, 'cat'), (1, 'cat')])
+    index_video(index, 'v.mp4', [(1, 'dog')])
+    index.close()
+
+    assert query(index_path, ['cat']) == []
+    assert [ row[:2] for row in query(index_path, ['dog']) ] == [('v.mp4', 1)]
+
+
+def test_reindexed_segment_replaces_only_its_frames(tmp_path):
+    index_path = str(tmp_path / 'detections.sqlite')
+
+    index = DetectionIndex(index_path)
+    index_video(index, 'v.mp4', [ (f, 'cat') for f in range(0, 10) ], (0, 10))
+    index_video(index, 'v.mp4', [ (f, 'cat') for f in range(10, 20) ], (10, None))
+    index.close()
+
+    index = DetectionIndex(index_path)
+    index_video(index, 'v.mp4', [(12, 'dog')], (10, None))
+    index.close()
+
+    assert [ row[1] for row in query(index_path, ['cat']) ] == list(range(10))
+    assert [ row[1] for row in query(index_path, ['dog']) ] == [12]
+
+
+def test_reports_indexed_again_are_not_duplicated(tmp_path):
+    index_path = str(tmp_path / 'detections.sqlite')
+    reports_directory = str(tmp_path / 'reports')
+    os.makedirs(reports_directory)
+
+    report = {'file' : 'v.mp4', 'type' : 'video', 'frames' : [ frame_report(f, 'cat') for f in range(3) ]}
+    with open(os.path.join(reports_directory, 'v.json'), 'w') as f:
+        json.dump(report, f)
+
+    index_reports(index_path, reports_directory)
+    index_reports(index_path, reports_directory)
+
+    assert [ row[1] for row in query(index_path, ['cat']) ] == [0, 1, 2]
+
+
+def test_indexer_replaces_detections_of_file_processed_again(tmp_path):
+    output_directory = str(tmp_path)
+    indexer = DetectionIndexer({'name' : 'indexer', 'inputs' : ['det'], 'params' : {'path' : 'detections.sqlite'}})
+
+    for label in ('cat', 'dog'):
+        input_data = None
+        for frame_num in range(3):
+            input_data = {'file' : 'v.mp4', 'isphoto' : False, 'isvideo' : True, 'frame' : frame_num,
+                'timestamp' : frame_num / 25.0, 'det' : {'reports' : frame_report(frame_num, label)['det']}}
+            indexer.execute(input_data, output_directory, output_directory)
+        indexer.completed(input_data, output_directory, output_directory)
+    indexer.close()
+
+    index_path = os.path.join(output_directory, 'detections.sqlite')
+    assert query(index_path, ['cat']) == []
+    assert [ row[1] for row in query(index_path, ['dog@det>0.4']) ] == [0, 1, 2]
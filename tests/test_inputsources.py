@@ -0,0 +1,103 @@
+import io
+import os
+import tarfile
+import zipfile
+
+from inputsources import (input_directory_of, input_files, read_file_list, member_path, split_archive_path,
+    stat_input, archive_jobs, count_members, member_job, iter_archive, ArchiveReader)
+
+
+MEMBERS = [ ('img/%d.jpg' % i, b'photo %d' % i) for i in range(3) ]
+
+
+def write_tar(path, mode='w'):
+    with tarfile.open(path, mode) as tar:
+        for name, data in MEMBERS:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+def write_zip(path):
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('img/', b'')
+        for name, data in MEMBERS:
+            zf.writestr(name, data)
+    return path
+
+
+def test_directory_files(tmp_path):
+    os.makedirs(str(tmp_path / 'a' / 'b'))
+    for name in ('x.jpg', 'a/y.mp4', 'a/b/z.png'):
+        open(str(tmp_path / name), 'w').close()
+
+    assert sorted(input_files(str(tmp_path))) == sorted([ str(tmp_path / name) for name in ('x.jpg', 'a/y.mp4', 'a/b/z.png') ])
+    assert input_directory_of(str(tmp_path)) == str(tmp_path)
+
+
+def test_file_list_paths_are_relative_to_its_directory(tmp_path):
+    list_path = str(tmp_path / 'files.txt')
+    with open(list_path, 'w') as f:
+        f.write('# photos\n\na.jpg\n  sub/b.jpg  \n/data/c.mp4\n../d.jpg\n')
+
+    expected = [ str(tmp_path / 'a.jpg'), str(tmp_path / 'sub' / 'b.jpg'), '/data/c.mp4',
+        os.path.join(os.path.dirname(str(tmp_path)), 'd.jpg') ]
+    assert list(read_file_list(list_path)) == expected
+    assert list(input_files(list_path)) == expected
+    assert input_directory_of(list_path) == str(tmp_path)
+
+
+def test_member_paths_stay_in_archive_directory():
+    assert member_path('in/a.tar', 'img/1.jpg') == os.path.join('in/a.tar', 'img/1.jpg')
+    assert member_path('in/a.tar', '/img/1.jpg') == os.path.join('in/a.tar', 'img/1.jpg')
+    assert member_path('in/a.tar', '../1.jpg') is None
+    assert member_path('in/a.tar', 'img/../../1.jpg') is None
+
+
+def test_archive_member_path_is_split(tmp_path):
+    archive_path = write_tar(str(tmp_path / 'a.tar'))
+    file_path = os.path.join(archive_path, 'img', '1.jpg')
+
+    assert split_archive_path(file_path) == (archive_path, 'img/1.jpg')
+    assert split_archive_path(str(tmp_path / 'img' / '1.jpg')) is None
+    assert stat_input(file_path).st_size == os.path.getsize(archive_path)
+
+    assert member_job(file_path) == {'file' : file_path, 'segment' : None, 'archive' : archive_path, 'member' : 'img/1.jpg'}
+
+
+def test_archive_member_jobs_read_their_members(tmp_path):
+    reader = ArchiveReader()
+    for archive_path in (write_tar(str(tmp_path / 'a.tar')), write_zip(str(tmp_path / 'a.zip'))):
+        jobs = list(archive_jobs(archive_path, 'member'))
+        assert [ job['file'] for job in jobs ] == [ os.path.join(archive_path, name) for name, data in MEMBERS ]
+        assert [ reader.read(job) for job in jobs ] == [ data for name, data in MEMBERS ]
+
+    # Listed in a file list.
+    write_tar(str(tmp_path / 'a.tar.gz'), 'w:gz')
+    job = member_job(os.path.join(str(tmp_path / 'a.tar.gz'), 'img/2.jpg'))
+    assert reader.read(job) == MEMBERS[2][1]
+    reader.close()
+
+
+def test_compressed_tar_is_a_single_job(tmp_path):
+    archive_path = write_tar(str(tmp_path / 'a.tar.gz'), 'w:gz')
+    for granularity in ('shard', 'member'):
+        assert list(archive_jobs(archive_path, granularity)) == [{'file' : archive_path, 'segment' : None, 'shard' : True}]
+
+
+def test_archive_members_are_counted(tmp_path):
+    assert count_members(write_tar(str(tmp_path / 'a.tar'))) == len(MEMBERS)
+    assert count_members(write_zip(str(tmp_path / 'a.zip'))) == len(MEMBERS)
+    # Estimated from the size of compressed tars.
+    assert count_members(write_tar(str(tmp_path / 'a.tar.gz'), 'w:gz')) == 1
+
+
+def test_archives_are_read_in_stored_order_skipping_done_members(tmp_path):
+    for archive_path in (write_tar(str(tmp_path / 'a.tar')), write_zip(str(tmp_path / 'a.zip')),
+            write_tar(str(tmp_path / 'a.tar.gz'), 'w:gz')):
+        members = [ (os.path.join(archive_path, name), data) for name, data in MEMBERS ]
+        assert list(iter_archive(archive_path)) == members
+
+        done = set([members[1][0]])
+        assert list(iter_archive(archive_path, lambda file_path: file_path in done)) == [members[0], members[2]]
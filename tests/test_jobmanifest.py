@@ -0,0 +1,123 @@
+import os
+
+from jobmanifest import JobManifest
+
+
+COMPONENTS_CFG = [
+    {'name' : 'det', 'type' : 'detector', 'inputs' : ['files'], 'params' : {'threshold' : 0.5}},
+    {'name' : 'report', 'type' : 'jsonreportwriter', 'inputs' : ['det']}
+]
+
+
+def make_job(tmp_path):
+    input_directory = str(tmp_path / 'in')
+    output_directory = str(tmp_path / 'out')
+    os.makedirs(input_directory)
+    os.makedirs(output_directory)
+
+    input_file = os.path.join(input_directory, 'a.jpg')
+    with open(input_file, 'wb') as f:
+        f.write(b'photo')
+
+    output_file = os.path.join(output_directory, 'a.json')
+    with open(output_file, 'w') as f:
+        f.write('{}')
+
+    return input_directory, output_directory, input_file, output_file
+
+
+def record_done(manifest, input_file, output_file):
+    outputs = {'det' : {'reports' : []}, 'report' : {'file' : output_file}}
+    manifest.record_done(input_file, None, manifest.file_state(input_file), outputs)
+
+
+def test_done_file_is_skipped(tmp_path):
+    input_directory, output_directory, input_file, output_file = make_job(tmp_path)
+
+    manifest = JobManifest(input_directory, output_directory, COMPONENTS_CFG, {})
+    assert not manifest.is_done(input_file)
+    record_done(manifest, input_file, output_file)
+    manifest.close()
+
+    # Checked by the next run.
+    manifest = JobManifest(input_directory, output_directory, COMPONENTS_CFG, {})
+    assert manifest.is_done(input_file)
+    manifest.close()
+
+
+def test_changed_file_is_not_skipped(tmp_path):
+    input_directory, output_directory, input_file, output_file = make_job(tmp_path)
+
+    manifest = JobManifest(input_directory, output_directory, COMPONENTS_CFG, {})
+    record_done(manifest, input_file, output_file)
+
+    with open(input_file, 'ab') as f:
+        f.write(b' changed')
+    assert not manifest.is_done(input_file)
+    manifest.close()
+
+
+def test_file_with_deleted_output_is_not_skipped(tmp_path):
+    input_directory, output_directory, input_file, output_file = make_job(tmp_path)
+
+    manifest = JobManifest(input_directory, output_directory, COMPONENTS_CFG, {})
+    record_done(manifest, input_file, output_file)
+
+    os.remove(output_file)
+    assert not manifest.is_done(input_file)
+    manifest.close()
+
+
+def test_changed_component_is_not_skipped(tmp_path):
+    input_directory, output_directory, input_file, output_file = make_job(tmp_path)
+
+    manifest = JobManifest(input_directory, output_directory, COMPONENTS_CFG, {})
+    record_done(manifest, input_file, output_file)
+    manifest.close()
+
+    changed_cfg = [ dict(comp_cfg) for comp_cfg in COMPONENTS_CFG ]
+    changed_cfg[0]['params'] = {'threshold' : 0.7}
+    manifest = JobManifest(input_directory, output_directory, changed_cfg, {})
+    assert not manifest.is_done(input_file)
+    manifest.close()
+
+
+def test_touched_file_is_skipped_with_content_check(tmp_path):
+    input_directory, output_directory, input_file, output_file = make_job(tmp_path)
+
+    options = {'manifest_check' : 'content'}
+    manifest = JobManifest(input_directory, output_directory, COMPONENTS_CFG, options)
+    record_done(manifest, input_file, output_file)
+
+    st = os.stat(input_file)
+    os.utime(input_file, (st.st_atime, st.st_mtime + 10))
+    assert manifest.is_done(input_file)
+    manifest.close()
+
+
+def test_failed_file_is_not_skipped(tmp_path):
+    input_directory, output_directory, input_file, output_file = make_job(tmp_path)
+
+    manifest = JobManifest(input_directory, output_directory, COMPONENTS_CFG, {})
+    manifest.record_failed(input_file, None, manifest.file_state(input_file), 'error')
+    assert not manifest.is_done(input_file)
+    manifest.close()
+
+
+def test_stitched_video_is_skipped_only_if_all_segments_were_done(tmp_path):
+    input_directory, output_directory, input_file, output_file = make_job(tmp_path)
+    segments = [(0, 100), (100, None)]
+
+    manifest = JobManifest(input_directory, output_directory, COMPONENTS_CFG, {})
+    file_state = manifest.file_state(input_file)
+    manifest.record_done(input_file, segments[0], file_state, {'report' : {}})
+    manifest.record_failed(input_file, segments[1], file_state, 'error')
+
+    manifest.record_stitched(input_file, segments, {'report' : output_file})
+    assert manifest.is_done(input_file, segments[0])
+    assert not manifest.is_done(input_file)
+
+    manifest.record_done(input_file, segments[1], file_state, {'report' : {}})
+    manifest.record_stitched(input_file, segments, {'report' : output_file})
+    assert manifest.is_done(input_file)
+    manifest.close()
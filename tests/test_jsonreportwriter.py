@@ -0,0 +1,69 @@
+import json
+import os
+
+from jsonreportwriter import JSONReportWriter, read_jsonl_report, convert_jsonl_report
+
+
+def video_frames(input_file):
+    '''
+    Yields input data of the frames of a video with detections of a component 'det'.
+    '''
+    for frame_num in range(5):
+        reports = [ {'rect' : [frame_num, 10, 20, 30], 'labels' : [{'label' : 'cat', 'confidence' : 0.5}]} ]
+        if frame_num % 2:
+            reports.append({'rect' : [1, 2, 3, 4], 'labels' : ['dog']})
+        yield {
+            'file' : input_file,
+            'isphoto' : False,
+            'isvideo' : True,
+            'frame' : frame_num,
+            'timestamp' : frame_num / 25.0,
+            'det' : {'reports' : reports, 'carriedforward' : frame_num == 3}
+        }
+
+
+def write_report(params, input_directory, output_directory):
+    writer = JSONReportWriter({'name' : 'report', 'type' : 'jsonreportwriter', 'inputs' : ['det'], 'params' : params})
+    input_data = None
+    for input_data in video_frames(os.path.join(input_directory, 'v.mp4')):
+        writer.execute(input_data, input_directory, output_directory)
+    return writer.completed(input_data, input_directory, output_directory)['file']
+
+
+def test_jsonl_report_has_the_frames_of_json_report(tmp_path):
+    input_directory = str(tmp_path)
+
+    json_filepath = write_report({}, input_directory, str(tmp_path / 'json'))
+    jsonl_filepath = write_report({'format' : 'jsonl', 'flush_frames' : 2}, input_directory, str(tmp_path / 'jsonl'))
+    assert jsonl_filepath.endswith('.jsonl')
+
+    with open(json_filepath, 'r') as f:
+        report = json.load(f)
+    assert read_jsonl_report(jsonl_filepath) == report
+    assert [ frame['inferred'] for frame in report['frames'] ] == [True, True, True, False, True]
+
+
+def test_converted_jsonl_report_is_identical_to_json_report(tmp_path):
+    input_directory = str(tmp_path)
+
+    json_filepath = write_report({}, input_directory, str(tmp_path / 'json'))
+    jsonl_filepath = write_report({'format' : 'jsonl'}, input_directory, str(tmp_path / 'jsonl'))
+
+    converted_filepath = str(tmp_path / 'converted.json')
+    convert_jsonl_report(jsonl_filepath, converted_filepath)
+
+    with open(json_filepath, 'r') as f, open(converted_filepath, 'r') as g:
+        assert g.read() == f.read()
+
+
+def test_unfinished_jsonl_report_is_deleted_on_failure(tmp_path):
+    input_directory = str(tmp_path)
+    output_directory = str(tmp_path / 'out')
+    input_file = os.path.join(input_directory, 'v.mp4')
+
+    writer = JSONReportWriter({'name' : 'report', 'type' : 'jsonreportwriter', 'inputs' : ['det'], 'params' : {'format' : 'jsonl'}})
+    for input_data in video_frames(input_file):
+        writer.execute(input_data, input_directory, output_directory)
+    writer.failed(input_file, None)
+
+    assert os.listdir(output_directory) == []
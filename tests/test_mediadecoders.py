@@ -0,0 +1,65 @@
+import struct
+
+import pytest
+
+from mediadecoders import sniff_media_type
+
+
+BMP_HEADER = b'BM' + struct.pack('<IIII', 1000, 0, 54, 40) + b'\x00' * 36
+
+PHOTO_HEADERS = [
+    b'\xff\xd8\xff\xe0\x00\x10JFIF',
+    b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR',
+    b'GIF89a\x01\x00',
+    BMP_HEADER,
+    b'II*\x00\x08\x00\x00\x00',
+    b'RIFF\x00\x10\x00\x00WEBPVP8 ',
+    b'P6\n640 480\n255\n',
+    b'P5 640 480 255\n',
+    b'\x00\x00\x00\x0cjP  \r\n\x87\n',
+    b'\xff\x4f\xff\x51\x00\x2f',
+    b'\x00\x00\x00\x18ftypheic\x00\x00\x00\x00',
+]
+
+VIDEO_HEADERS = [
+    b'\x00\x00\x00\x20ftypisom\x00\x00\x02\x00',
+    b'\x00\x00\x00\x14ftypqt  \x00\x00\x00\x00',
+    b'RIFF\x00\x10\x00\x00AVI LIST',
+    b'\x1a\x45\xdf\xa3\x01\x00\x00\x00',
+    b'FLV\x01\x05',
+    b'\x00\x00\x01\xba\x44\x00',
+    b'OggS\x00\x02',
+    b'\x47\x40\x00\x10' + b'\xff' * 184 + b'\x47\x40\x00\x11',
+]
+
+
+@pytest.mark.parametrize('header', PHOTO_HEADERS)
+def test_photos_are_recognized_by_first_bytes(header):
+    # Whatever the extension.
+    assert sniff_media_type('file.bin', header + b'\x00' * 64) == 'photo'
+
+
+@pytest.mark.parametrize('header', VIDEO_HEADERS)
+def test_videos_are_recognized_by_first_bytes(header):
+    assert sniff_media_type('file.jpg', header + b'\x00' * 64) == 'video'
+
+
+def test_unrecognized_bytes_fall_back_to_extension():
+    data = b'\x00\x00\x00\x01\x67\x42'
+    assert sniff_media_type('video.h264', data) == 'video'
+    assert sniff_media_type('photo.PPM', data) == 'photo'
+    assert sniff_media_type('notes.txt', data) is None
+
+
+def test_text_starting_like_headers_is_not_a_photo():
+    assert sniff_media_type('notes.txt', b'BMW service history\n' + b' ' * 64) is None
+    assert sniff_media_type('notes.txt', b'Pancakes\n') is None
+
+
+def test_files_are_read(tmp_path):
+    photo_path = str(tmp_path / 'photo')
+    with open(photo_path, 'wb') as f:
+        f.write(PHOTO_HEADERS[0])
+
+    assert sniff_media_type(photo_path) == 'photo'
+    assert sniff_media_type(str(tmp_path / 'missing.jpg')) is None
@@ -0,0 +1,102 @@
+import json
+import os
+
+from videosegments import plan_segments, segment_suffix, existing_segment_files
+from jsonreportwriter import JSONReportWriter
+from outputsink import ShardedOutputSink, read_output
+
+
+def test_short_video_is_not_split():
+    assert plan_segments(150, 4, 100) == [(0, None)]
+    assert plan_segments(1000, 1, 100) == [(0, None)]
+    assert plan_segments(None, 4, 100) == [(0, None)]
+
+
+def test_segments_cover_video_in_frame_order():
+    segments = plan_segments(1000, 4, 100)
+    assert segments == [(0, 250), (250, 500), (500, 750), (750, None)]
+
+
+def test_segments_are_not_shorter_than_minimum():
+    segments = plan_segments(1000, 8, 300)
+    assert segments == [(0, 300), (300, 600), (600, None)]
+
+
+def test_segment_suffixes_sort_in_frame_order():
+    segments = plan_segments(100000, 16, 100)
+    suffixes = [ segment_suffix(segment) for segment in segments ]
+    assert sorted(suffixes) == suffixes
+
+
+def test_only_trailing_segments_may_be_missing(tmp_path):
+    paths = [ str(tmp_path / ('v' + segment_suffix((start, None)) + '.json')) for start in (0, 100, 200) ]
+    for path in paths[:2]:
+        open(path, 'w').close()
+    assert existing_segment_files('v.mp4', paths) == paths[:2]
+
+    os.remove(paths[0])
+    assert existing_segment_files('v.mp4', paths) is None
+
+
+def write_segment_report(output_directory, segment, frames):
+    report = {'file' : 'v.mp4', 'type' : 'video', 'frames' : [ {'frame' : f, 'det' : []} for f in frames ]}
+    with open(os.path.join(output_directory, 'v' + segment_suffix(segment) + '.json'), 'w') as f:
+        json.dump(report, f)
+
+
+def test_json_reports_are_stitched_in_frame_order(tmp_path):
+    input_directory = str(tmp_path / 'in')
+    output_directory = str(tmp_path / 'out')
+    os.makedirs(output_directory)
+
+    segments = [(0, 3), (3, 6), (6, None)]
+    # Written out of order, like segments finishing in different pipelines.
+    write_segment_report(output_directory, segments[2], [6, 7])
+    write_segment_report(output_directory, segments[0], [0, 1, 2])
+    write_segment_report(output_directory, segments[1], [3, 4, 5])
+
+    cfg = {'name' : 'report', 'type' : 'jsonreportwriter', 'inputs' : ['det']}
+    output = JSONReportWriter.stitch_segments(cfg, os.path.join(input_directory, 'v.mp4'), segments,
+        input_directory, output_directory)
+
+    with open(output['file'], 'r') as f:
+        report = json.load(f)
+    assert [ frame['frame'] for frame in report['frames'] ] == list(range(8))
+    assert sorted(os.listdir(output_directory)) == ['v.json']
+
+
+def test_segments_are_not_stitched_if_one_is_missing(tmp_path):
+    input_directory = str(tmp_path / 'in')
+    output_directory = str(tmp_path / 'out')
+    os.makedirs(output_directory)
+
+    segments = [(0, 3), (3, 6), (6, None)]
+    write_segment_report(output_directory, segments[0], [0, 1, 2])
+    write_segment_report(output_directory, segments[2], [6, 7])
+
+    cfg = {'name' : 'report', 'type' : 'jsonreportwriter', 'inputs' : ['det']}
+    output = JSONReportWriter.stitch_segments(cfg, os.path.join(input_directory, 'v.mp4'), segments,
+        input_directory, output_directory)
+
+    assert output is None
+    assert len(os.listdir(output_directory)) == 2
+
+
+def test_stitched_report_is_written_to_output_sink(tmp_path):
+    input_directory = str(tmp_path / 'in')
+    output_directory = str(tmp_path / 'out')
+    os.makedirs(output_directory)
+
+    segments = [(0, 3), (3, None)]
+    write_segment_report(output_directory, segments[0], [0, 1, 2])
+    write_segment_report(output_directory, segments[1], [3, 4])
+
+    cfg = {'name' : 'report', 'type' : 'jsonreportwriter', 'inputs' : ['det']}
+    output_sink = ShardedOutputSink(output_directory)
+    output = JSONReportWriter.stitch_segments(cfg, os.path.join(input_directory, 'v.mp4'), segments,
+        input_directory, output_directory, output_sink)
+    output_sink.close()
+
+    assert not os.path.exists(output['file'])
+    report = json.loads(read_output(output_directory, output['file']).decode('utf-8'))
+    assert [ frame['frame'] for frame in report['frames'] ] == list(range(5))
@@ -0,0 +1,157 @@
+import imageio
+
+import math
+import os
+import os.path
+import subprocess
+import tempfile
+
+# Helpers for splitting a long video into frame-range segments that can be
+# processed by different pipeline processors, and for stitching the per-segment
+# outputs back together.
+#
+# A segment is a (start_frame, end_frame) tuple where end_frame is exclusive.
+# The last segment of a video has end_frame None, meaning "till end of video",
+# because the frame count reported by ffmpeg is only an estimate for many
+# containers.
+
+def probe_frame_count(input_file):
+    '''
+    Returns estimated number of frames in the video, or None if input_file
+    is not a video or its length can't be determined without decoding it.
+    '''
+    try:
+        video = imageio.get_reader(input_file, 'ffmpeg')
+    except:
+        return None
+
+    try:
+        nframes = video.get_length()
+        if nframes and nframes != float('inf'):
+            return int(nframes)
+
+        # Many containers don't record number of frames. Estimate it from
+        # duration and frame rate instead of decoding the whole video.
+        meta = video.get_meta_data()
+        duration = meta.get('duration')
+        fps = meta.get('fps')
+        if duration and fps:
+            return int(round(duration * fps))
+
+        return None
+    finally:
+        video.close()
+
+
+
+def plan_segments(nframes, num_workers, min_segment_frames):
+    '''
+    Splits a video of nframes frames into at most num_workers segments,
+    none shorter than min_segment_frames.
+    Returns list of (start_frame, end_frame) tuples in frame order.
+    '''
+    if not nframes or num_workers <= 1 or nframes < 2 * min_segment_frames:
+        return [(0, None)]
+
+    segment_frames = max(min_segment_frames, int(math.ceil(nframes / float(num_workers))))
+
+    segments = []
+    for start in range(0, nframes, segment_frames):
+        segments.append((start, start + segment_frames))
+
+    # A too short last segment is merged into the previous one. The last
+    # segment always extends till end of video since nframes is just an estimate.
+    if len(segments) > 1 and (nframes - segments[-1][0]) < min_segment_frames:
+        segments.pop()
+    segments[-1] = (segments[-1][0], None)
+
+    return segments
+
+
+
+def segment_suffix(frame_range):
+    '''
+    Returns the suffix added to names of partial outputs written for a segment.
+    '''
+    return '.segment-%09d' % frame_range[0]
+
+
+
+def existing_segment_files(input_file, segment_filepaths):
+    '''
+    Returns those of the partial outputs of the segments of input_file, given in frame
+    order, that exist. A segment has no output if it turned out to be past end of video,
+    because segments are planned on an estimated frame count, so only the last ones can
+    be missing. If an earlier one is missing, returns None, so that the segments are not
+    stitched into an output with missing frames.
+    '''
+    existing = [ p for p in segment_filepaths if os.path.exists(p) ]
+    if existing != segment_filepaths[:len(existing)]:
+        print("Warning: outputs of some segments of %s are missing. Not stitching them" % input_file)
+        return None
+    return existing
+
+
+
+def ffmpeg_exe():
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except ImportError:
+        # Older imageio versions bundle ffmpeg themselves.
+        return imageio.plugins.ffmpeg.get_exe()
+
+
+
+def concat_videos(segment_filepaths, output_filepath):
+    '''
+    Concatenates segment videos, in the given order, into a single video
+    without re-encoding. All segments should have been written by the
+    same writer with same codec and size, which is the case for segments
+    of one input video.
+    '''
+    list_fd, list_filepath = tempfile.mkstemp(suffix='.txt', dir=os.path.dirname(output_filepath))
+    try:
+        with os.fdopen(list_fd, 'w') as f:
+            for p in segment_filepaths:
+                # Escape single quotes as required by ffmpeg concat demuxer.
+                f.write("file '%s'\n" % os.path.abspath(p).replace("'", "'\\''"))
+
+        cmd = [ffmpeg_exe(), '-y', '-loglevel', 'error',
+            '-f', 'concat', '-safe', '0', '-i', list_filepath,
+            '-c', 'copy', output_filepath]
+        subprocess.check_call(cmd)
+
+    finally:
+        os.remove(list_filepath)
+
+
+
+def video_frames(video, segment, stride=1):
+    '''
+    Generates (frame number, image) for all frames of an opened video, or only
+    for frames in segment's range. With stride N, only every Nth frame counting 
+    from start of video is generated.
+    '''
+    if not segment and stride == 1:
+        for frame_num, img in enumerate(video):
+            yield frame_num, img
+        return
+        
+    start_frame, end_frame = segment or (0, None)
+    
+    # First frame at or after start_frame that's a multiple of stride, so that
+    # segments of a video are sampled as if the video were not segmented.
+    frame_num = (start_frame + stride - 1) // stride * stride
+    while end_frame is None or frame_num < end_frame:
+        # The reader seeks to the frame on first read, and when skipping far ahead. 
+        # It reads following frames sequentially, only discarding raw frames that
+        # are skipped, without converting them.
+        try:
+            img = video.get_data(frame_num)
+        except (IndexError, StopIteration, RuntimeError):
+            # Reached end of video.
+            return
+            
+        yield frame_num, img
+        frame_num += stride
@@ -5,6 +5,7 @@ import os.path
 import sys
 
 from pipeline import Pipeline, MultiPipelineExecutor
+from inputsources import is_archive, is_file_list
 
 # - Pipelines:
 #   - deepdetect + basicdetect + facerecognize
@@ -16,9 +17,12 @@ from pipeline import Pipeline, MultiPipelineExecutor
 #
 # User inputs:
 # - for detection/recognition:
-#   - Input directory containing photos and videos
+#   - Input directory containing photos and videos, or an archive or file list 
+#     of them. See inputsources.py.
 #   - Output directory for reports 
 #   - Pipeline file
+#
+# - for daemon mode, 'serve' followed by the same inputs
 # 
 # - for deep detection training
 #   - TODO
@@ -30,15 +34,21 @@ from pipeline import Pipeline, MultiPipelineExecutor
 def detect(input_path, output_directory, pipeline_file):
     # if input_path is just a single file, we don't need all the multicore
     # setup.
-    if os.path.isfile(input_path):
+    if os.path.isfile(input_path) and not is_archive(input_path) and not is_file_list(input_path):
         pipeline = Pipeline(pipeline_file, os.path.dirname(input_path), output_directory)
         pipeline.execute(input_path)
+        pipeline.close()
         
-    elif os.path.isdir(input_path):
+    elif os.path.exists(input_path):
         multiexecutor = MultiPipelineExecutor()
         multiexecutor.execute(pipeline_file, input_path, output_directory)
     else:
-        print("Input is not an image file or directory:", input_path)
+        print("Input is not an image file, directory, archive or file list:", input_path)
     
 if __name__ == '__main__':
-    detect(sys.argv[1], sys.argv[2], sys.argv[3])
+    if sys.argv[1] == 'serve':
+        # Daemon mode. See pipelinedaemon.py.
+        from pipelinedaemon import serve
+        serve(sys.argv[2], sys.argv[3], sys.argv[4])
+    else:
+        detect(sys.argv[1], sys.argv[2], sys.argv[3])
@@ -0,0 +1,264 @@
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import time
+import traceback
+
+import cv2
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+
+# How the cores and memory of the machine are split between pipeline processes.
+# Without limits, every pipeline process lets OpenCV and TensorFlow start thread
+# pools as wide as the machine, so N processes run N times as many busy threads
+# as there are cores.
+#
+# Pipeline options:
+#
+#   workers: 4                          # number of pipeline processes, or auto
+#   opencv_threads: 2                   # per process. Default is cores / workers
+#   tensorflow_intra_op_threads: 2      # per process. Default is cores / workers
+#   tensorflow_inter_op_threads: 1      # per process. Default is 1
+#   worker_memory_limit_mb: 4096        # per process address space limit. Default is no limit.
+#   calibration:                        # for workers: auto
+#     sample_files: 2
+#     frames: 50
+
+
+class WorkerBudget(object):
+    '''
+    Number of pipeline processes, and the threads and memory each of them can use.
+    '''
+    def __init__(self, workers, opencv_threads, tensorflow_intra_op_threads, tensorflow_inter_op_threads,
+            memory_limit_mb=None):
+        self.workers = workers
+        self.opencv_threads = opencv_threads
+        self.tensorflow_intra_op_threads = tensorflow_intra_op_threads
+        self.tensorflow_inter_op_threads = tensorflow_inter_op_threads
+        self.memory_limit_mb = memory_limit_mb
+
+
+    def __repr__(self):
+        return "%d workers with %d OpenCV threads, %d/%d TensorFlow intra/inter op threads, memory limit %s MB each" % (
+            self.workers, self.opencv_threads, self.tensorflow_intra_op_threads, self.tensorflow_inter_op_threads,
+            self.memory_limit_mb or 'none')
+
+
+
+def plan_budget(options, cpu_count, workers=None):
+    '''
+    Returns the WorkerBudget given by pipeline options, with workers as the number of
+    pipeline processes if given, and with defaults that split cpu_count cores evenly.
+    '''
+    if workers is None:
+        workers = options.get('workers', cpu_count)
+        if workers == 'auto':
+            workers = cpu_count
+
+    if isinstance(workers, bool) or not isinstance(workers, int) or workers < 1:
+        raise ValueError("workers should be a positive number of processes or auto, not %r" % (workers,))
+
+    threads = max(1, cpu_count // workers)
+
+    return WorkerBudget(workers,
+        options.get('opencv_threads', threads),
+        options.get('tensorflow_intra_op_threads', threads),
+        options.get('tensorflow_inter_op_threads', 1),
+        options.get('worker_memory_limit_mb'))
+
+
+
+# Thread counts TensorFlow sessions created in this process should use, or None
+# for TensorFlow's defaults. Set by apply_budget().
+tensorflow_threads = None
+
+def apply_budget(budget):
+    '''
+    Applies budget to this process. Should be called at start of a pipeline process,
+    before any models are loaded.
+    '''
+    global tensorflow_threads
+
+    # Read by OpenMP and MKL when TensorFlow is loaded, which happens only later
+    # when a darkflow model is loaded.
+    os.environ['OMP_NUM_THREADS'] = str(budget.tensorflow_intra_op_threads)
+    os.environ['MKL_NUM_THREADS'] = str(budget.tensorflow_intra_op_threads)
+
+    tensorflow_threads = (budget.tensorflow_intra_op_threads, budget.tensorflow_inter_op_threads)
+
+    cv2.setNumThreads(budget.opencv_threads)
+
+    if budget.memory_limit_mb:
+        if resource is None:
+            print("Warning: worker memory limit is not supported on this platform")
+        else:
+            limit = budget.memory_limit_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+
+def candidate_budgets(options, cpu_count):
+    '''
+    Returns the budgets tried by calibration: from one worker per core with 1 thread
+    each, down to a single worker with all the cores, halving the workers every time.
+    '''
+    budgets = []
+    workers = cpu_count
+    while workers >= 1:
+        budgets.append(plan_budget(options, cpu_count, workers))
+        workers //= 2
+    return budgets
+
+
+
+def calibrate(pipeline_file, input_directory, sample_files, options, cpu_count):
+    '''
+    Runs the pipeline on sample_files with each candidate budget, and returns the
+    budget that processed the most images per second. Each candidate runs its number
+    of workers, each processing all the sample files, and only upto 'frames' frames
+    of a video, with the model servers the pipeline would run with the candidate.
+    '''
+    calibration_cfg = options.get('calibration') or {}
+    max_frames = calibration_cfg.get('frames', 50)
+
+    best_budget = None
+    best_throughput = 0.0
+
+    for budget in candidate_budgets(options, cpu_count):
+        output_directory = tempfile.mkdtemp(prefix='calibration-')
+        try:
+            throughput = measure_throughput(pipeline_file, input_directory, sample_files, budget, max_frames,
+                output_directory, cpu_count)
+        finally:
+            shutil.rmtree(output_directory, ignore_errors=True)
+
+        print("Calibration: %r: %.1f images/s" % (budget, throughput))
+
+        if throughput > best_throughput:
+            best_budget, best_throughput = budget, throughput
+
+    return best_budget or plan_budget(options, cpu_count)
+
+
+
+def measure_throughput(pipeline_file, input_directory, sample_files, budget, max_frames, output_directory,
+        cpu_count):
+    # Imported here because these modules import this module.
+    import modelserver
+    from pipeline import load_pipeline_file
+
+    components_cfg, options = load_pipeline_file(pipeline_file)
+    model_servers, model_server_connections = modelserver.start_model_servers(
+        components_cfg, budget.workers, cpu_count)
+    try:
+        return measure_workers_throughput(pipeline_file, input_directory, sample_files, budget, max_frames,
+            output_directory, model_server_connections)
+    finally:
+        modelserver.stop_model_servers(model_servers)
+
+
+
+def measure_workers_throughput(pipeline_file, input_directory, sample_files, budget, max_frames,
+        output_directory, model_server_connections):
+    results = multiprocessing.Queue()
+    processes = [ CalibrationProcess(pipeline_file, input_directory, sample_files, budget, max_frames,
+            output_directory, results, model_server_connections[i])
+        for i in range(budget.workers) ]
+
+    for p in processes:
+        p.start()
+
+    images = 0
+    slowest = 0.0
+    for p in processes:
+        try:
+            result = results.get(timeout=600)
+        except queue.Empty:
+            result = "Calibration timed out"
+
+        if isinstance(result, str):
+            print("Calibration failed for %r:\n%s" % (budget, result))
+            images = 0
+            break
+
+        images += result[0]
+        slowest = max(slowest, result[1])
+
+    for p in processes:
+        p.join(1)
+        if p.is_alive():
+            p.terminate()
+
+    return images / slowest if slowest else 0.0
+
+
+
+class CalibrationProcess(multiprocessing.Process):
+    '''
+    Runs the pipeline on sample files with a budget and reports
+    (number of images processed, seconds taken), not including time to load models.
+    Reports an error message string instead, if there was an error.
+    '''
+    def __init__(self, pipeline_file, input_directory, sample_files, budget, max_frames, output_directory, results,
+            model_server_connections=None):
+        multiprocessing.Process.__init__(self)
+        self.daemon = True
+
+        self.pipeline_file = pipeline_file
+        self.input_directory = input_directory
+        self.sample_files = sample_files
+        self.budget = budget
+        self.max_frames = max_frames
+        self.output_directory = output_directory
+        self.results = results
+        self.model_server_connections = model_server_connections or {}
+
+
+    def run(self):
+        # Imported here because these modules import this module.
+        import modelserver
+        from pipeline import Pipeline, is_photo_job
+
+        try:
+            apply_budget(self.budget)
+
+            modelserver.connect(self.model_server_connections)
+            
+            # Waits for the model servers to load their models, so that isn't measured.
+            for name in self.model_server_connections:
+                modelserver.client(name).input_size()
+
+            # Each process writes to its own directory.
+            output_directory = os.path.join(self.output_directory, self.name)
+            pipeline = Pipeline(self.pipeline_file, self.input_directory, output_directory)
+            
+            # Results cached by an earlier candidate would make later candidates look faster.
+            if pipeline.result_cache:
+                pipeline.result_cache.close()
+                pipeline.result_cache = None
+
+            start = time.time()
+            for sample_file in self.sample_files:
+                if is_photo_job({'file' : sample_file, 'segment' : None}):
+                    pipeline.execute(sample_file)
+                else:
+                    pipeline.execute(sample_file, (0, self.max_frames))
+
+            # Only the images actually processed, since videos may be shorter than 
+            # max_frames, and files that aren't photos or videos are ignored.
+            seconds = time.time() - start
+            images = pipeline.images_read
+            pipeline.close()
+            modelserver.close_clients()
+
+            self.results.put((images, seconds))
+
+        except:
+            self.results.put(traceback.format_exc())